@@ -29,6 +29,11 @@ leap.common.events.register():
 >>> from leap.common.events import catalog
 >>> register(catalog.CLIENT_UID, lambda sig, content: do_something(content))
 
+A single callback may also be registered for all the events whose labels
+start with a prefix:
+
+>>> register(catalog.match("SOLEDAD_*"), lambda sig, *content: log(sig))
+
 To emit an event, use leap.common.events.emit():
 
 >>> from leap.common.events import emit
@@ -40,6 +45,7 @@ import argparse
 
 from leap.common.events import client
 from leap.common.events import txclient
+from leap.common.events import rpc
 from leap.common.events import server
 from leap.common.events import flags
 from leap.common.events.flags import set_events_enabled
@@ -59,12 +65,14 @@ __all__ = [
 logger = logging.getLogger(__name__)
 
 
-def register(event, callback, uid=None, replace=False):
+def register(event, callback, uid=None, replace=False, replay=None,
+             key=None, where=None):
     """
     Register a callback to be executed when an event is received.
 
-    :param event: The event that triggers the callback.
-    :type event: str
+    :param event: The event that triggers the callback, or a wildcard
+                  matching all the events that trigger it.
+    :type event: Event or Prefix
     :param callback: The callback to be executed.
     :type callback: callable(event, content)
     :param uid: The callback uid.
@@ -72,6 +80,16 @@ def register(event, callback, uid=None, replace=False):
     :param replace: Wether an eventual callback with same ID should be
                     replaced.
     :type replace: bool
+    :param replay: The kind of replay of the events kept by the server,
+                   'recent' or 'last', or None for no replay.
+    :type replay: str
+    :param key: If not None, only run the callback for events about this
+                key, usually the uuid or userid of an account.
+    :type key: hashable
+    :param where: If not None, the values the content of an event must have,
+                  by position, for the callback to be run. The server only
+                  sends the events that match.
+    :type where: dict
 
     :return: The callback uid.
     :rtype: str
@@ -80,12 +98,15 @@ def register(event, callback, uid=None, replace=False):
             identified by the given uid and replace is False.
     """
     if flags.EVENTS_ENABLED:
-        return client.register(event, callback, uid, replace)
+        return client.register(
+            event, callback, uid, replace, replay, key, where)
 
 
-def register_async(event, callback, uid=None, replace=False):
+def register_async(event, callback, uid=None, replace=False, replay=None,
+                   key=None, where=None):
     if flags.EVENTS_ENABLED:
-        return txclient.register(event, callback, uid, replace)
+        return txclient.register(
+            event, callback, uid, replace, replay, key, where)
 
 
 def unregister(event, uid=None):
@@ -127,6 +148,30 @@ def emit_async(event, *content):
         return txclient.emit(event, *content)
 
 
+def call_async(event, *args, **kwargs):
+    """
+    Call an event, and get the result of the component responding to it.
+
+    :param event: The called event.
+    :type event: Event
+    :param args: The arguments of the call.
+    :type args: list
+    :param timeout: The maximum time, in seconds, to wait for the reply.
+                    Passed as a keyword.
+    :type timeout: float
+
+    :return: A deferred that fires with the result of the call.
+    :rtype: twisted.internet.defer.Deferred
+    """
+    if flags.EVENTS_ENABLED:
+        return rpc.call(event, *args, **kwargs)
+
+
+def respond_async(event, handler, concurrency=1, backlog=100):
+    if flags.EVENTS_ENABLED:
+        return rpc.respond(event, handler, concurrency, backlog)
+
+
 if __name__ == "__main__":
 
     def _echo(event, *content):
@@ -151,6 +196,27 @@ if __name__ == "__main__":
             "--reg-addr",
             help="The address in which to listen for registration for events.",
             default=server.REG_ADDR)
+        server_parser.add_argument(
+            "--replay-size", type=int, default=None,
+            help="keep this many recent events to replay to new clients")
+        server_parser.add_argument(
+            "--last-values", type=int, default=None,
+            help="keep the last value of this many events for new clients")
+        server_parser.add_argument(
+            "--rpc-addr",
+            help="The address in which to route remote calls.",
+            default=server.RPC_ADDR)
+        server_parser.add_argument(
+            "--journal", default=None,
+            help="append relayed events to a journal in this directory")
+        server_parser.add_argument(
+            "--priority-emit-addr", default=None,
+            help="The address in which to listen for high priority events "
+                 "(e.g. %s)." % server.PRIORITY_EMIT_ADDR)
+        server_parser.add_argument(
+            "--priority-reg-addr", default=None,
+            help="The address in which to listen for registration for high "
+                 "priority events (e.g. %s)." % server.PRIORITY_REG_ADDR)
 
         # client options
         client_parser = subparsers.add_parser(
@@ -164,7 +230,8 @@ if __name__ == "__main__":
             help="The address in which to register for events.",
             default=server.REG_ADDR)
         group = client_parser.add_mutually_exclusive_group(required=True)
-        group.add_argument('--reg', help="register an event")
+        group.add_argument(
+            '--reg', help="register an event, or a prefix ending in *")
         group.add_argument('--emit', help="send an event")
         client_parser.add_argument(
             '--content', help="the content of the event", default=None)
@@ -181,11 +248,46 @@ if __name__ == "__main__":
             help="The address in which to register for events.",
             default=server.REG_ADDR)
         group = txclient_parser.add_mutually_exclusive_group(required=True)
-        group.add_argument('--reg', help="register an event")
+        group.add_argument(
+            '--reg', help="register an event, or a prefix ending in *")
         group.add_argument('--emit', help="send an event")
         txclient_parser.add_argument(
             '--content', help="the content of the event", default=None)
 
+        # bench options
+        bench_parser = subparsers.add_parser(
+            "bench", help="Benchmark a local events server.")
+        bench_parser.add_argument(
+            "--emitters", "-n", type=int, default=1,
+            help="the number of emitting clients")
+        bench_parser.add_argument(
+            "--subscribers", "-m", type=int, default=1,
+            help="the number of subscribed clients")
+        bench_parser.add_argument(
+            "--count", type=int, default=10000,
+            help="the number of events sent by each emitter")
+        bench_parser.add_argument(
+            "--size", type=int, default=0,
+            help="the size of the padding added to each event")
+        bench_parser.add_argument(
+            "--transport", action="append", choices=["ipc", "tcp"],
+            help="benchmark this transport (default: all)")
+        bench_parser.add_argument(
+            "--curve", choices=["on", "off", "both"], default="both",
+            help="whether to use CURVE encryption")
+        bench_parser.add_argument(
+            "--client", action="append", choices=["thread", "tx"],
+            help="benchmark this client type (default: all)")
+        bench_parser.add_argument(
+            "--processes", action="store_true",
+            help="run each client in its own process")
+        bench_parser.add_argument(
+            "--timeout", type=float, default=30,
+            help="how long subscribers wait for the events")
+        bench_parser.add_argument(
+            "--json", action="store_true",
+            help="print the results as JSON")
+
         return parser.parse_args()
 
     args = _parse_args()
@@ -195,12 +297,17 @@ if __name__ == "__main__":
 
     if args.command == "server":
         # run server
-        server.ensure_server(emit_addr=args.emit_addr, reg_addr=args.reg_addr)
+        server.ensure_server(
+            emit_addr=args.emit_addr, reg_addr=args.reg_addr,
+            replay_size=args.replay_size, last_values=args.last_values,
+            rpc_addr=args.rpc_addr, journal_dir=args.journal,
+            priority_emit_addr=args.priority_emit_addr,
+            priority_reg_addr=args.priority_reg_addr)
         from twisted.internet import reactor
         reactor.run()
     elif args.command == "client":
         if args.reg:
-            event = getattr(catalog, args.reg)
+            event = catalog.match(args.reg)
             # run client and register to a signal
             register(event, _echo)
             # make sure we stop on CTRL+C
@@ -216,12 +323,27 @@ if __name__ == "__main__":
             event = getattr(catalog, args.emit)
             emit(event, args.content)
             client.shutdown()
+    elif args.command == "bench":
+        import json
+        from leap.common.events import bench
+        curves = {"on": (True,), "off": (False,), "both": (False, True)}
+        results = bench.bench_suite(
+            transports=args.transport or bench.TRANSPORTS,
+            curves=curves[args.curve],
+            clients=args.client or bench.CLIENTS,
+            emitters=args.emitters, subscribers=args.subscribers,
+            count=args.count, size=args.size, processes=args.processes,
+            timeout=args.timeout)
+        if args.json:
+            print(json.dumps(results, indent=2, sort_keys=True))
+        else:
+            print(bench.format_results(results['results']))
     elif args.command == "txclient":
         from leap.common.events import txclient
         register = txclient.register
         emit = txclient.emit
         if args.reg:
-            event = getattr(catalog, args.reg)
+            event = catalog.match(args.reg)
             # run client and register to a signal
             register(event, _echo)
             from twisted.internet import reactor
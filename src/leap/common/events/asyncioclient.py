@@ -0,0 +1,750 @@
+# -*- coding: utf-8 -*-
+# asyncioclient.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+The client end point of the events mechanism, implemented using asyncio.
+
+This client runs in the asyncio event loop of the application, so callbacks
+are run directly in that loop. Like pyzmq's asyncio sockets, it must be used
+from within the running loop. It needs python 3 and pyzmq's asyncio support.
+
+Registering waits until the server reports the subscription, so the events
+emitted afterwards reach the callback. Besides the usual callbacks, events may
+be consumed with ``async for``:
+
+    client = EventsAsyncioClient.instance()
+    await client.register(catalog.MAIL_UNREAD_MESSAGES, callback)
+    await client.emit(catalog.MAIL_UNREAD_MESSAGES, userid, 3)
+    async for event, content in client.subscribe(catalog.VPN_STATUS_CHANGED):
+        ...
+"""
+import sys
+
+if sys.version_info < (3, 5):
+    raise ImportError("The asyncio events client needs python 3.5 or later.")
+
+import asyncio
+import collections
+import logging
+import os
+
+import zmq
+import zmq.asyncio
+
+from zmq.utils.monitor import parse_monitor_message
+
+from leap.common.config import flags, get_path_prefix
+from leap.common.zmq_utils import zmq_has_curve
+from leap.common.zmq_utils import get_keyring
+from leap.common.zmq_utils import MONITOR_EVENTS
+
+from leap.common.events import client
+from leap.common.events import codec as codecs
+from leap.common.events import executors
+from leap.common.events import wire
+from leap.common.events.client import EMIT_RETRY_DELAY
+from leap.common.events.client import EventsClient
+from leap.common.events.client import configure_client
+from leap.common.events.server import EMIT_ADDR
+from leap.common.events.server import REG_ADDR
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    "configure_client",
+    "EventsAsyncioClient",
+    "Subscription",
+    "register",
+    "unregister",
+    "emit",
+    "subscribe",
+    "shutdown",
+]
+
+
+# how long to wait for the server to report new subscriptions, as servers
+# that don't report them (like the proxy server) never will
+SUBSCRIBED_TIMEOUT = 1.0
+
+
+class Subscription(object):
+    """
+    An asynchronous iterator over the events received by a client.
+
+    Each item is an (event, content) tuple. Items are queued until they are
+    consumed, the oldest ones being dropped once maxsize items are waiting.
+    Only one consumer may wait for items at a time.
+    """
+
+    def __init__(self, client, event, maxsize=1000):
+        """
+        Initialize the subscription and register it in the client.
+
+        :param client: The client that receives the events.
+        :type client: EventsAsyncioClient
+        :param event: The event to subscribe to.
+        :type event: Event
+        :param maxsize: The maximum number of events waiting to be consumed.
+        :type maxsize: int
+        """
+        self.event = event
+        self.dropped = 0
+        self._client = client
+        self._items = collections.deque(maxlen=maxsize)
+        self._waiter = None
+        self._closed = False
+        # registered right away, the caller waits for the server if needed
+        self._uid = EventsClient.register(client, event, self._put)
+
+    def _put(self, event, *content):
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result((event, content))
+            self._waiter = None
+            return
+        if len(self._items) == self._items.maxlen:
+            self.dropped += 1
+        self._items.append((event, content))
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        """
+        Return an awaitable for the next event.
+
+        :rtype: asyncio.Future
+        """
+        future = self._client.loop.create_future()
+        if self._items:
+            future.set_result(self._items.popleft())
+        elif self._closed:
+            raise StopAsyncIteration()
+        else:
+            self._waiter = future
+        return future
+
+    def close(self):
+        """
+        Unregister the subscription, ending the iteration once the queued
+        events are consumed.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._client.unregister(self.event, uid=self._uid)
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_exception(StopAsyncIteration())
+        self._waiter = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class EventsAsyncioClient(EventsClient):
+    """
+    An asyncio events client that listens for events in one address and
+    publishes those events to another address.
+    """
+
+    def __init__(self, emit_addr=EMIT_ADDR, reg_addr=REG_ADDR,
+                 path_prefix=None, enable_curve=True,
+                 codec=codecs.DEFAULT_CODEC, accept_codecs=None,
+                 legacy_wire=False, suppress_unobserved=False,
+                 compact_topics=False, coalesce_window=None,
+                 deliver_locally=False, metrics=False, heartbeat=None,
+                 emit_buffer=None, emit_overflow=executors.DROP_OLDEST,
+                 priority_emit_addr=None, priority_reg_addr=None,
+                 blob_threshold=None):
+        """
+        Initialize the events client.
+
+        :raises ValueError: if emit_overflow is executors.BLOCK, as waiting
+                            for room in the buffer would block the loop
+                            that makes room in it.
+        """
+        if emit_buffer is not None and emit_overflow == executors.BLOCK:
+            raise ValueError("The asyncio client can't block on emit.")
+        EventsClient.__init__(
+            self, emit_addr, reg_addr, codec=codec,
+            accept_codecs=accept_codecs, legacy_wire=legacy_wire,
+            suppress_unobserved=suppress_unobserved,
+            compact_topics=compact_topics, coalesce_window=coalesce_window,
+            deliver_locally=deliver_locally, metrics=metrics,
+            heartbeat=heartbeat, emit_buffer=emit_buffer,
+            emit_overflow=emit_overflow,
+            priority_emit_addr=priority_emit_addr,
+            priority_reg_addr=priority_reg_addr,
+            blob_threshold=blob_threshold)
+        if path_prefix is None:
+            path_prefix = get_path_prefix(flags.STANDALONE)
+        self._config_prefix = os.path.join(path_prefix, "leap", "events")
+        if enable_curve:
+            self.use_curve = zmq_has_curve()
+        else:
+            self.use_curve = False
+        self.loop = asyncio.get_event_loop()
+        self._context = zmq.asyncio.Context()
+        self._calls = set()
+        self._flush_call = None
+        # the pending receive of each socket that is read, and the monitor
+        # sockets
+        self._receiving = {}
+        self._monitors = []
+        # futures waiting for the server to report subscriptions, by topic
+        self._subscribed_waiters = collections.defaultdict(list)
+        # connect SUB first, otherwise we might miss some event sent from this
+        # same client
+        self._priority_sub = self._priority_push = None
+        if priority_reg_addr is not None:
+            self._priority_sub = self._zmq_connect(zmq.SUB, priority_reg_addr)
+            self._priority_push = self._zmq_connect(
+                zmq.PUSH, priority_emit_addr)
+        self._sub = self._zmq_connect(zmq.SUB, reg_addr)
+        if suppress_unobserved:
+            self._subscribe(wire.SUBSCRIPTIONS_TOPIC)
+        self._push = self._zmq_connect(zmq.PUSH, emit_addr)
+        if self._priority_sub is not None:
+            self.loop.call_soon(
+                self._receive, self._priority_sub, self._on_message)
+            self.loop.call_soon(
+                self._receive, self._sub, self._on_normal_message)
+        else:
+            self.loop.call_soon(self._receive, self._sub, self._on_message)
+
+    @classmethod
+    def _create_instance(cls):
+        """
+        Create a new client instance using the module configuration.
+        """
+        return cls(
+            client._emit_addr, client._reg_addr,
+            enable_curve=client._enable_curve, codec=client._codec,
+            accept_codecs=client._accept_codecs,
+            legacy_wire=client._legacy_wire,
+            suppress_unobserved=client._suppress_unobserved,
+            compact_topics=client._compact_topics,
+            coalesce_window=client._coalesce_window,
+            deliver_locally=client._deliver_locally,
+            metrics=client._metrics, heartbeat=client._heartbeat,
+            emit_buffer=client._emit_buffer,
+            emit_overflow=client._emit_overflow,
+            priority_emit_addr=client._priority_emit_addr,
+            priority_reg_addr=client._priority_reg_addr,
+            blob_threshold=client._blob_threshold)
+
+    def _zmq_connect(self, socktype, address):
+        """
+        Connect to an address using with a zmq socktype.
+
+        :param socktype: The ZMQ socket type.
+        :type socktype: int
+        :param address: The address to connect to.
+        :type address: str
+
+        :return: A ZMQ socket.
+        :rtype: zmq.asyncio.Socket
+        """
+        logger.debug("Connecting %s to %s." % (socktype, address))
+        socket = self._context.socket(socktype)
+        # configure curve authentication
+        if self.use_curve:
+            keyring = get_keyring(self._config_prefix)
+            public, private = keyring.keypair("client")
+            socket.curve_publickey = public
+            socket.curve_secretkey = private
+            socket.curve_serverkey = keyring.public_key("server")
+        for option, value in self._socket_options(address):
+            socket.setsockopt(option, value)
+        if self._monitored and address in self._links:
+            # before connecting, so no event is missed
+            monitor = socket.get_monitor_socket(MONITOR_EVENTS)
+            self._monitors.append((socket, monitor))
+            self.loop.call_soon(
+                self._receive, monitor,
+                lambda message: self._on_monitor_event(
+                    address, parse_monitor_message(message)))
+        socket.connect(address)
+        return socket
+
+    def _receive(self, socket, handler):
+        """
+        Wait for the next message in a socket.
+
+        :param socket: The socket.
+        :type socket: zmq.asyncio.Socket
+        :param handler: The function that handles the message.
+        :type handler: callable(frames)
+        """
+        if socket.closed:
+            return
+        receiving = socket.recv_multipart()
+        self._receiving[socket] = receiving
+        receiving.add_done_callback(
+            lambda future: self._on_receive(socket, handler, future))
+
+    def _on_receive(self, socket, handler, future):
+        """
+        Handle a message received in a socket and wait for the next one.
+
+        :param socket: The socket.
+        :type socket: zmq.asyncio.Socket
+        :param handler: The function that handles the message.
+        :type handler: callable(frames)
+        :param future: The future of the receive operation.
+        :type future: asyncio.Future
+        """
+        if future.cancelled():
+            return
+        try:
+            frames = future.result()
+        except zmq.ZMQError as e:
+            if socket.closed:
+                return
+            logger.error("Error receiving events: %s" % e)
+        else:
+            try:
+                handler(frames)
+            except Exception:
+                logger.exception("Error handling event.")
+        self._receive(socket, handler)
+
+    def _on_normal_message(self, frames):
+        """
+        Handle a message of the normal lane, after the messages waiting in
+        the high priority lane.
+
+        :param frames: The frames of the received message.
+        :type frames: list of str
+        """
+        while True:
+            # non-blocking receives are done right away
+            waiting = self._priority_sub.recv_multipart(zmq.NOBLOCK)
+            if waiting.exception() is not None:
+                break
+            self._on_message(waiting.result())
+        self._on_message(frames)
+
+    def _on_message(self, frames):
+        """
+        Handle an incoming message in a SUB socket.
+
+        :param frames: The frames of the received message.
+        :type frames: list of str
+        """
+        EventsClient._on_message(self, frames)
+        if frames[0] == wire.SUBSCRIPTIONS_TOPIC and self._subscribed_waiters:
+            topics = frames[1:]
+            for topic in list(self._subscribed_waiters):
+                # subscriptions are prefixes of the topics they match
+                if any(topic.startswith(t) for t in topics):
+                    for future in self._subscribed_waiters.pop(topic):
+                        self._resolve_subscribed(future, True)
+
+    def _subscribe(self, tag, priority=False):
+        """
+        Subscribe to a tag on the zmq SUB socket.
+
+        :param tag: The tag to be subscribed.
+        :type tag: str
+        :param priority: Whether to subscribe in the high priority lane.
+        :type priority: bool
+        """
+        sub = self._priority_sub if priority else self._sub
+        sub.setsockopt(zmq.SUBSCRIBE, tag)
+
+    def _unsubscribe(self, tag, priority=False):
+        """
+        Unsubscribe from a tag on the zmq SUB socket.
+
+        :param tag: The tag to be unsubscribed.
+        :type tag: str
+        :param priority: Whether to unsubscribe in the high priority lane.
+        :type priority: bool
+        """
+        sub = self._priority_sub if priority else self._sub
+        sub.setsockopt(zmq.UNSUBSCRIBE, tag)
+
+    def _send(self, frames, priority=False):
+        """
+        Send a message through PUSH socket.
+
+        :param frames: The frames of the message to be sent.
+        :type frames: list of str
+        :param priority: Whether to send it through the high priority lane,
+                         which is not buffered.
+        :type priority: bool
+
+        :return: A future that is done when the message is queued in zmq,
+                 or None if it waits in the outbox.
+        :rtype: asyncio.Future
+        """
+        if priority:
+            return self._priority_push.send_multipart(frames)
+        if self._outbox is None:
+            return self._push.send_multipart(frames)
+        self._outbox.put(frames)
+        self._flush_outbox()
+
+    def _flush_outbox(self):
+        """
+        Send the events in the outbox through the PUSH socket, while it is
+        connected and has room for them.
+        """
+        if self._flush_call is not None:
+            # already waiting for room
+            return
+        while self._links[self._emit_addr] and len(self._outbox):
+            frames = self._outbox.get(timeout=0)
+            # non-blocking sends are usually done right away
+            sent = self._push.send_multipart(frames, zmq.NOBLOCK)
+            if sent.done() and isinstance(sent.exception(), zmq.Again):
+                # no room yet, keep it first in line and try again later
+                self._outbox.put(frames, force=True, front=True)
+                self._flush_call = self.loop.call_later(
+                    EMIT_RETRY_DELAY, self._retry_flush)
+                return
+
+    def _retry_flush(self):
+        """
+        Send the events in the outbox after waiting for room for them.
+        """
+        self._flush_call = None
+        self._flush_outbox()
+
+    def _resume_emitting(self):
+        """
+        Send the events buffered while the client was disconnected.
+        """
+        if self._outbox is not None:
+            self._flush_outbox()
+
+    def _call_later(self, delay, function):
+        """
+        Call a function in the event loop after a delay.
+
+        :param delay: The delay, in seconds.
+        :type delay: float
+        :param function: The function to be called.
+        :type function: callable
+        """
+        def call():
+            self._calls.discard(handle)
+            function()
+
+        handle = self.loop.call_later(delay, call)
+        self._calls.add(handle)
+
+    def _run_callback(self, callback, event, content):
+        """
+        Run a callback.
+
+        Callbacks that are coroutine functions are scheduled as tasks. The
+        errors of a callback are logged, so they don't prevent the other
+        callbacks of the event from running.
+
+        :param callback: The callback to be run.
+        :type callback: callable(event, *content)
+        :param event: The event to be sent.
+        :type event: Event
+        :param content: The content of the event.
+        :type content: list
+        """
+        try:
+            result = callback(event, *content)
+        except Exception:
+            logger.exception("Error running event callback.")
+            return
+        if asyncio.iscoroutine(result):
+            task = self.loop.create_task(result)
+            task.add_done_callback(self._on_callback_done)
+
+    def _on_callback_done(self, task):
+        """
+        Log the error of a callback that ran as a task.
+
+        :param task: The task.
+        :type task: asyncio.Task
+        """
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(
+                "Error running event callback.", exc_info=task.exception())
+
+    def register(self, event, callback, uid=None, replace=False,
+                 replay=None, key=None, where=None,
+                 timeout=SUBSCRIBED_TIMEOUT):
+        """
+        Register a callback to be executed when an event is received.
+
+        The callback is registered right away, and the returned future is
+        done once the server reports the subscriptions it needs, so the
+        events emitted afterwards are known to reach it. See
+        EventsClient.register() for the other parameters.
+
+        :param timeout: How long to wait for the server's report.
+        :type timeout: float
+
+        :return: A future that is done with the callback uid when the
+                 server reports the subscriptions, or when the timeout
+                 expires.
+        :rtype: asyncio.Future
+
+        :raises CallbackAlreadyRegisteredError: when there's already a callback
+                identified by the given uid and replace is False.
+        """
+        uid = EventsClient.register(
+            self, event, callback, uid=uid, replace=replace, replay=replay,
+            key=key, where=where)
+        registered = self.loop.create_future()
+        waiting = asyncio.gather(*[
+            self._topic_subscribed(topic, timeout)
+            for topic, _ in sorted(self._wanted_topics(event))])
+
+        def done(_):
+            if not registered.done():
+                registered.set_result(uid)
+
+        waiting.add_done_callback(done)
+        return registered
+
+    def emit(self, event, *content):
+        """
+        Send an event.
+
+        :param event: The event to be sent.
+        :type event: Event
+        :param content: The content of the event.
+        :type content: list
+
+        :return: A future that is done when the event is queued in zmq, or
+                 right away if the event is not sent now.
+        :rtype: asyncio.Future
+        """
+        sent = EventsClient.emit(self, event, *content)
+        if sent is None:
+            sent = self.loop.create_future()
+            sent.set_result(None)
+        return sent
+
+    def subscribe(self, event, maxsize=1000):
+        """
+        Return an asynchronous iterator over the received events of a kind.
+
+        :param event: The event to subscribe to.
+        :type event: Event
+        :param maxsize: The maximum number of events waiting to be consumed.
+        :type maxsize: int
+
+        :rtype: Subscription
+        """
+        return Subscription(self, event, maxsize=maxsize)
+
+    def subscribed(self, event, timeout=SUBSCRIBED_TIMEOUT):
+        """
+        Wait until the server reports a subscription to an event, so events
+        emitted from now on are known to reach this client.
+
+        :param event: The registered event.
+        :type event: Event
+        :param timeout: How long to wait for the server's report.
+        :type timeout: float
+
+        :return: A future that is done with True when the subscription is
+                 reported, or with False when the timeout expires.
+        :rtype: asyncio.Future
+        """
+        return self._topic_subscribed(self._topic(event), timeout)
+
+    def _topic_subscribed(self, topic, timeout):
+        """
+        Wait until the server reports a subscription to a topic.
+
+        :param topic: The topic.
+        :type topic: str
+        :param timeout: How long to wait for the server's report.
+        :type timeout: float
+
+        :return: A future that is done with True when the subscription is
+                 reported, or with False when the timeout expires.
+        :rtype: asyncio.Future
+        """
+        future = self.loop.create_future()
+        self._subscribed_waiters[topic].append(future)
+        # a repeated subscription to the subscriptions topic makes the server
+        # report all subscriptions, after the ones already sent by us
+        self._subscribe(wire.SUBSCRIPTIONS_TOPIC)
+
+        def expire():
+            waiters = self._subscribed_waiters.get(topic, [])
+            if future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._subscribed_waiters[topic]
+                self._resolve_subscribed(future, False)
+
+        self._call_later(timeout, expire)
+        return future
+
+    def _resolve_subscribed(self, future, subscribed):
+        """
+        Resolve a future returned by subscribed().
+
+        :param future: The future.
+        :type future: asyncio.Future
+        :param subscribed: Whether the server reported the subscription.
+        :type subscribed: bool
+        """
+        self._unsubscribe(wire.SUBSCRIPTIONS_TOPIC)
+        if not future.done():
+            future.set_result(subscribed)
+
+    def shutdown(self):
+        """
+        Close the client's sockets and terminate its zmq context.
+
+        Messages not yet sent have up to client.SHUTDOWN_TIMEOUT seconds to
+        reach the server.
+        """
+        for handle in self._calls:
+            handle.cancel()
+        self._calls.clear()
+        self._flush_coalesced(force=True)
+        if self._flush_call is not None:
+            self._flush_call.cancel()
+            self._flush_call = None
+        if self._outbox is not None and len(self._outbox):
+            logger.warning("Dropped %d buffered events on shutdown."
+                           % self._outbox.clear())
+        for receiving in self._receiving.values():
+            receiving.cancel()
+        self._receiving.clear()
+        for socket, monitor in self._monitors:
+            socket.disable_monitor()
+            monitor.close(linger=0)
+        self._monitors = []
+        for sub in (self._sub, self._priority_sub):
+            if sub is not None:
+                sub.close(linger=0)
+        for push in (self._push, self._priority_push):
+            if push is not None:
+                push.close(linger=int(client.SHUTDOWN_TIMEOUT * 1000))
+        # returns once queued messages are sent, or the linger time is over
+        self._context.term()
+        EventsClient.shutdown(self)
+
+
+def register(event, callback, uid=None, replace=False, replay=None,
+             key=None, where=None, timeout=SUBSCRIBED_TIMEOUT):
+    """
+    Register a callback to be executed when an event is received, and wait
+    until the server reports the subscription.
+
+    :param event: The event that triggers the callback, or a wildcard
+                  matching all the events that trigger it.
+    :type event: Event or Prefix
+    :param callback: The callback to be executed.
+    :type callback: callable(event, content)
+    :param uid: The callback uid.
+    :type uid: str
+    :param replace: Wether an eventual callback with same ID should be
+                    replaced.
+    :type replace: bool
+    :param replay: The kind of replay of the events kept by the server,
+                   'recent' or 'last', or None for no replay.
+    :type replay: str
+    :param key: If not None, only run the callback for events about this
+                key, usually the uuid or userid of an account.
+    :type key: hashable
+    :param where: If not None, the values the content of an event must have,
+                  by position, for the callback to be run.
+    :type where: dict
+    :param timeout: How long to wait for the server's report.
+    :type timeout: float
+
+    :return: A future that is done with the callback uid.
+    :rtype: asyncio.Future
+
+    :raises CallbackAlreadyRegisteredError: when there's already a callback
+            identified by the given uid and replace is False.
+    """
+    return EventsAsyncioClient.instance().register(
+        event, callback, uid=uid, replace=replace, replay=replay, key=key,
+        where=where, timeout=timeout)
+
+
+def unregister(event, uid=None):
+    """
+    Unregister callbacks for an event.
+
+    If uid is not None, then only the callback identified by the given uid is
+    removed. Otherwise, all callbacks for the event are removed.
+
+    :param event: The event that triggers the callback.
+    :type event: str
+    :param uid: The callback uid.
+    :type uid: str
+    """
+    return EventsAsyncioClient.instance().unregister(event, uid=uid)
+
+
+def emit(event, *content):
+    """
+    Send an event.
+
+    :param event: The event to be sent.
+    :type event: str
+    :param content: The content of the event.
+    :type content: list
+
+    :return: A future that is done when the event is queued in zmq.
+    :rtype: asyncio.Future
+    """
+    return EventsAsyncioClient.instance().emit(event, *content)
+
+
+def subscribe(event, maxsize=1000):
+    """
+    Return an asynchronous iterator over the received events of a kind.
+
+    :param event: The event to subscribe to.
+    :type event: Event
+    :param maxsize: The maximum number of events waiting to be consumed.
+    :type maxsize: int
+
+    :rtype: Subscription
+    """
+    return EventsAsyncioClient.instance().subscribe(event, maxsize=maxsize)
+
+
+def shutdown():
+    """
+    Shutdown the events client.
+    """
+    EventsAsyncioClient.instance().shutdown()
+
+
+def instance():
+    """
+    Return an instance of the events client.
+
+    :return: An instance of the events client.
+    :rtype: EventsAsyncioClient
+    """
+    return EventsAsyncioClient.instance()
@@ -17,6 +17,13 @@
 """
 ZAP authentication, twisted style.
 """
+import os
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 from zmq import PAIR
 from zmq.auth.base import Authenticator, VERSION
 from txzmq.connection import ZmqConnection
@@ -26,6 +33,42 @@ from twisted.python import log
 
 from txzmq.connection import ZmqEndpoint, ZmqEndpointType
 
+from leap.common.zmq_utils import PUBLIC_KEYS_PREFIX
+from leap.common.zmq_utils import get_keyring
+
+
+class KeyringCertificates(Mapping):
+    """
+    The public keys of a keyring, as a read-only mapping in the format
+    zmq's Authenticator uses for the certificates of a domain.
+
+    Keys are looked up in the keyring on each authentication, so keys added
+    to the public keys directory are accepted without configuring the
+    authenticator again.
+    """
+
+    def __init__(self, keyring):
+        self._keyring = keyring
+
+    def __getitem__(self, key):
+        return self._keyring.public_keys()[key]
+
+    def __iter__(self):
+        return iter(self._keyring.public_keys())
+
+    def __len__(self):
+        return len(self._keyring.public_keys())
+
+
+def _keyring_for(location):
+    """
+    Return the keyring whose public keys directory is location, if any.
+    """
+    location = os.path.normpath(location)
+    if not location.endswith(os.sep + PUBLIC_KEYS_PREFIX):
+        return None
+    return get_keyring(location[:-len(os.sep + PUBLIC_KEYS_PREFIX)])
+
 
 class TxAuthenticator(ZmqConnection):
 
@@ -61,7 +104,14 @@ class TxAuthenticator(ZmqConnection):
         elif command == b'CURVE':
             domain = u(msg[1], self.encoding)
             location = u(msg[2], self.encoding)
-            self.authenticator.configure_curve(domain, location)
+            keyring = _keyring_for(location)
+            if keyring is None:
+                self.authenticator.configure_curve(domain, location)
+            else:
+                # share the keys already loaded by the other components
+                self.authenticator.allow_any = False
+                self.authenticator.certs[domain] = KeyringCertificates(
+                    keyring)
 
     def _send_zap_reply(self, request_id, status_code, status_text,
                         user_id='user'):
@@ -0,0 +1,692 @@
+# -*- coding: utf-8 -*-
+# bench.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmarks for the events mechanism.
+
+Besides microbenchmarks of the codecs and of the threaded client's emit and
+receive pipelines, bench_load() runs an events server with N emitting and M
+subscribed clients, each role in its own worker processes, and measures
+throughput, emit-to-delivery latency and CPU time per message.
+bench_suite() repeats it over transports, CURVE and client types.
+
+Run with:
+
+    python -m leap.common.events.bench
+
+or, for the load benchmarks:
+
+    python leap/common/events/__init__.py bench --help
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import zmq
+
+from leap.common.config import flags as config_flags
+from leap.common.zmq_utils import zmq_has_curve
+from leap.common.zmq_utils import maybe_create_and_get_certificates
+from leap.common.events import catalog
+from leap.common.events import codec as codecs
+from leap.common.events import wire
+from leap.common.events.client import EventsClientThread
+
+
+# content shapes of real catalog events, see the comments in catalog.py
+PAYLOADS = {
+    "address": ("user@example.org",),
+    "uuid_userid": ("2b5c6a1e0e8d4f3aa1c4d0c2e4a9f7b1", "user@example.org"),
+    "userid_number": ("user@example.org", 42),
+    "userid_dest": ("user@example.org", "friend@example.net"),
+    "sync_status": ({"uuid": "2b5c6a1e0e8d4f3aa1c4d0c2e4a9f7b1",
+                     "userid": "user@example.org",
+                     "received": 120, "total": 4096},),
+}
+
+# payload sizes, in bytes, of the receive benchmark
+RECEIVE_SIZES = (100, 1024, 10 * 1024, 100 * 1024, 1024 * 1024)
+
+# load benchmark parameters
+IPC = "ipc"
+TCP = "tcp"
+TRANSPORTS = (IPC, TCP)
+
+THREADED = "thread"
+TWISTED = "tx"
+CLIENTS = (THREADED, TWISTED)
+
+# the event carrying the load, and the one subscribers use to make sure the
+# server knows about their subscriptions
+LOAD_EVENT = catalog.CLIENT_UID
+PING_EVENT = catalog.CLIENT_SESSION_ID
+
+_SERVER = "server"
+_EMITTER = "emitter"
+_SUBSCRIBER = "subscriber"
+
+
+def bench_emit(count=50000, batch_size=None, batch_linger=None):
+    """
+    Measure how many events per second the threaded client can push.
+
+    Events are pulled by a bare zmq socket instead of an events server, so
+    only the client's emit pipeline is measured.
+
+    :param count: The number of events to emit.
+    :type count: int
+    :param batch_size: The batch size passed to the client.
+    :type batch_size: int
+    :param batch_linger: The batch linger time passed to the client.
+    :type batch_linger: float
+
+    :return: The number of events per second.
+    :rtype: float
+    """
+    context = zmq.Context()
+    pull = context.socket(zmq.PULL)
+    port = pull.bind_to_random_port("tcp://127.0.0.1")
+    client = EventsClientThread(
+        "tcp://127.0.0.1:%d" % port, "tcp://127.0.0.1:%d" % port,
+        enable_curve=False, batch_size=batch_size, batch_linger=batch_linger)
+    event = catalog.SOLEDAD_SYNC_RECEIVE_STATUS
+    try:
+        client.ensure_client()
+        # make sure the connection is up before starting the clock
+        client.emit(event)
+        pull.recv()
+        start = time.time()
+        for i in range(count):
+            client.emit(event, i, count)
+        for _ in range(count):
+            pull.recv()
+        elapsed = time.time() - start
+    finally:
+        client.shutdown()
+        pull.close()
+        context.term()
+    return count / elapsed
+
+
+def bench_receive(sizes=RECEIVE_SIZES, volume=32 * 1024 * 1024,
+                  zero_copy=True, timeout=30):
+    """
+    Measure how fast the threaded client receives and decodes events of
+    several payload sizes.
+
+    Events are published by a bare zmq socket instead of an events server,
+    so only the client's receive pipeline is measured.
+
+    :param sizes: The payload sizes, in bytes.
+    :type sizes: tuple of int
+    :param volume: About how many bytes to receive for each size.
+    :type volume: int
+    :param zero_copy: Passed to the client.
+    :type zero_copy: bool
+    :param timeout: How long to wait for the events of each size, in
+                    seconds.
+    :type timeout: float
+
+    :return: A dict mapping each size to (events per second, megabytes per
+             second).
+    :rtype: dict
+    """
+    context = zmq.Context()
+    pub = context.socket(zmq.PUB)
+    # queue everything, the client must get every event
+    pub.setsockopt(zmq.SNDHWM, 0)
+    port = pub.bind_to_random_port("tcp://127.0.0.1")
+    client = EventsClientThread(
+        "tcp://127.0.0.1:%d" % port, "tcp://127.0.0.1:%d" % port,
+        enable_curve=False, zero_copy=zero_copy)
+    received = []
+    done = threading.Event()
+    expected = [0]
+
+    def on_load(event, payload):
+        received.append(len(payload))
+        if len(received) == expected[0]:
+            done.set()
+
+    ping = threading.Event()
+    results = {}
+    try:
+        client.register(LOAD_EVENT, on_load)
+        client.register(PING_EVENT, lambda event: ping.set())
+        # make sure the subscriptions are up before starting the clock
+        while not ping.wait(0.01):
+            pub.send_multipart(wire.pack(
+                PING_EVENT.label_topic, codecs.encode(())))
+        for size in sizes:
+            count = max(10, min(20000, volume // size))
+            frames = wire.pack(
+                LOAD_EVENT.label_topic, codecs.encode((b'x' * size,)))
+            del received[:]
+            done.clear()
+            expected[0] = count
+            start = time.time()
+            for _ in range(count):
+                pub.send_multipart(frames)
+            if not done.wait(timeout):
+                raise RuntimeError(
+                    "Received %d of %d events of %d bytes."
+                    % (len(received), count, size))
+            elapsed = time.time() - start
+            results[size] = (
+                count / elapsed, count * size / elapsed / (1024 * 1024))
+    finally:
+        client.shutdown()
+        pub.close()
+        context.term()
+    return results
+
+
+def bench_codecs(count=20000):
+    """
+    Measure the encode and decode cost of every registered codec.
+
+    :param count: The number of encode/decode round trips per payload.
+    :type count: int
+
+    :return: A dict mapping (codec, payload) to (size, encode usec,
+             decode usec).
+    :rtype: dict
+    """
+    results = {}
+    for name in codecs.available_codecs():
+        codec = codecs.get_codec(name)
+        for shape, content in sorted(PAYLOADS.items()):
+            data = codec.encode(content)
+            start = time.time()
+            for _ in range(count):
+                codec.encode(content)
+            encode_time = time.time() - start
+            start = time.time()
+            for _ in range(count):
+                codecs.decode(data)
+            decode_time = time.time() - start
+            results[(name, shape)] = (
+                len(data), encode_time * 1e6 / count,
+                decode_time * 1e6 / count)
+    return results
+
+
+def bench_load(transport=TCP, curve=False, client=THREADED, emitters=1,
+               subscribers=1, count=10000, size=0, processes=False,
+               timeout=30):
+    """
+    Measure an events server relaying events from emitting to subscribed
+    clients.
+
+    The server, the emitters and the subscribers run in worker processes.
+    Emitters send count events each, as fast as they can, and every
+    subscriber expects all of them.
+
+    :param transport: The transport between clients and server, IPC or TCP.
+    :type transport: str
+    :param curve: Whether to use CURVE encryption.
+    :type curve: bool
+    :param client: The client type, THREADED or TWISTED.
+    :type client: str
+    :param emitters: The number of emitting clients.
+    :type emitters: int
+    :param subscribers: The number of subscribed clients.
+    :type subscribers: int
+    :param count: The number of events sent by each emitter.
+    :type count: int
+    :param size: The size of the padding added to the content of events.
+    :type size: int
+    :param processes: Whether to run each client in its own process. If
+                      False, all emitters share one process, and all
+                      subscribers another, each client with its own thread
+                      (threaded clients) or all in the same reactor (twisted
+                      clients).
+    :type processes: bool
+    :param timeout: How long subscribers wait for the events, in seconds.
+    :type timeout: float
+
+    :return: The benchmark parameters and results: events emitted and
+             delivered, throughput (delivered events per second), latency
+             percentiles (seconds) and CPU time of all processes per
+             delivered event (seconds).
+    :rtype: dict
+
+    :raises ValueError: if CURVE is requested but not available.
+    """
+    if curve and not zmq_has_curve():
+        raise ValueError("CURVE is not available.")
+    workdir = tempfile.mkdtemp(prefix="leap-events-bench-")
+    workers = []
+    try:
+        if curve:
+            # create the client keys once, not racing in every worker
+            maybe_create_and_get_certificates(
+                os.path.join(workdir, "config", "leap", "events"), "client")
+        if transport == IPC:
+            emit_addr = "ipc://%s" % os.path.join(workdir, "emit")
+            reg_addr = "ipc://%s" % os.path.join(workdir, "reg")
+        else:
+            emit_addr = reg_addr = "tcp://127.0.0.1:0"
+        options = {
+            'workdir': workdir, 'curve': curve, 'client': client,
+            'count': count, 'size': size, 'timeout': timeout,
+            'expected': emitters * count}
+
+        server = _Worker(dict(
+            options, role=_SERVER, emit_addr=emit_addr, reg_addr=reg_addr))
+        workers.append(server)
+        options.update(server.read())
+
+        def spawn(role, total):
+            group = [1] * total if processes else [total]
+            spawned = [_Worker(dict(options, role=role, clients=clients))
+                       for clients in group]
+            workers.extend(spawned)
+            for worker in spawned:
+                worker.read()
+            return spawned
+
+        subs = spawn(_SUBSCRIBER, subscribers)
+        emits = spawn(_EMITTER, emitters)
+        for worker in workers:
+            worker.send("start")
+        # subscribers are done when they got every event or timed out
+        for worker in emits + subs:
+            worker.read()
+        for worker in workers:
+            worker.send("stop")
+        results = dict((worker, worker.read()) for worker in workers)
+    finally:
+        for worker in workers:
+            worker.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    latencies = sorted(
+        latency for worker in subs for latency in results[worker]['latency'])
+    delivered = len(latencies)
+    started = min(results[worker]['started'] for worker in emits)
+    finished = max(results[worker]['finished'] for worker in subs)
+    elapsed = max(finished - started, 1e-9)
+    cpu = sum(result['cpu'] for result in results.values())
+    return {
+        'transport': transport,
+        'curve': curve,
+        'client': client,
+        'emitters': emitters,
+        'subscribers': subscribers,
+        'processes': processes,
+        'count': count,
+        'size': size,
+        'emitted': emitters * count,
+        'delivered': delivered,
+        'lost': emitters * count * subscribers - delivered,
+        'elapsed': elapsed,
+        'throughput': delivered / elapsed,
+        'latency': {
+            'p50': _percentile(latencies, 0.5),
+            'p99': _percentile(latencies, 0.99),
+            'max': latencies[-1] if latencies else 0.0,
+        },
+        'cpu_per_message': cpu / delivered if delivered else None,
+    }
+
+
+def bench_suite(transports=TRANSPORTS, curves=(False, True),
+                clients=CLIENTS, **options):
+    """
+    Run the load benchmark for every combination of transport, CURVE and
+    client type. Combinations that need CURVE are skipped if it is not
+    available.
+
+    :param transports: The transports to benchmark.
+    :type transports: tuple of str
+    :param curves: The CURVE settings to benchmark.
+    :type curves: tuple of bool
+    :param clients: The client types to benchmark.
+    :type clients: tuple of str
+    :param options: Other bench_load() parameters.
+
+    :return: The environment the benchmarks ran in, and their results.
+    :rtype: dict
+    """
+    import platform
+    import leap.common
+    results = []
+    for transport in transports:
+        for curve in curves:
+            if curve and not zmq_has_curve():
+                continue
+            for client in clients:
+                results.append(bench_load(
+                    transport=transport, curve=curve, client=client,
+                    **options))
+    return {
+        'version': leap.common.__version__,
+        'python': platform.python_version(),
+        'pyzmq': zmq.pyzmq_version(),
+        'libzmq': zmq.zmq_version(),
+        'time': time.time(),
+        'results': results,
+    }
+
+
+def format_results(results):
+    """
+    Format load benchmark results for humans.
+
+    :param results: The results, as returned by bench_load().
+    :type results: list of dict
+
+    :rtype: str
+    """
+    lines = []
+    for result in results:
+        cpu = result['cpu_per_message']
+        lines.append(
+            "%(transport)s curve=%(curve)-5s %(client)-6s "
+            "%(emitters)dx%(subscribers)d: " % result
+            + "%8.0f msg/s  p50 %7.3f ms  p99 %7.3f ms  "
+            "cpu %s us/msg  lost %d" % (
+                result['throughput'],
+                result['latency']['p50'] * 1e3,
+                result['latency']['p99'] * 1e3,
+                "%.1f" % (cpu * 1e6) if cpu is not None else "-",
+                result['lost']))
+    return "\n".join(lines)
+
+
+def _percentile(values, fraction):
+    """
+    Return a percentile of sorted values.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def _cpu_time():
+    """
+    Return the CPU time used by this process, in seconds.
+    """
+    times = os.times()
+    return times[0] + times[1]
+
+
+class _Worker(object):
+    """
+    A worker process of the load benchmark, driven through its standard
+    input and output, one JSON message per line.
+    """
+
+    def __init__(self, options):
+        self._process = subprocess.Popen(
+            [sys.executable, "-m", "leap.common.events.bench", "worker",
+             json.dumps(options)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def send(self, command):
+        self._process.stdin.write(command.encode('ascii') + b"\n")
+        self._process.stdin.flush()
+
+    def read(self):
+        line = self._process.stdout.readline()
+        if not line:
+            raise RuntimeError("Benchmark worker died.")
+        return json.loads(line.decode('ascii'))
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+
+
+def _report(**message):
+    """
+    Send a message to the benchmark driver.
+    """
+    sys.stdout.write(json.dumps(message) + "\n")
+    sys.stdout.flush()
+
+
+def _command():
+    """
+    Wait for a command from the benchmark driver.
+    """
+    return sys.stdin.readline().strip()
+
+
+class _Subscription(object):
+    """
+    Collect the latency of the load events received by a client.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.latency = []
+        self.finished = None
+        self.pinged = threading.Event()
+        self.done = threading.Event()
+
+    def on_load(self, event, seq, emitted, padding):
+        now = time.time()
+        self.latency.append(now - emitted)
+        self.finished = now
+        if len(self.latency) >= self.expected:
+            self.done.set()
+
+    def on_ping(self, event, *content):
+        self.pinged.set()
+
+
+def _result(subscriptions, started, cpu):
+    """
+    Report the results of a worker.
+    """
+    finished = [s.finished for s in subscriptions if s.finished]
+    _report(
+        cpu=_cpu_time() - cpu, started=started,
+        finished=max(finished) if finished else started,
+        latency=[value for s in subscriptions for value in s.latency])
+
+
+def _run_server(options):
+    from twisted.internet import reactor
+    from leap.common.events import server
+
+    events_server = server.ensure_server(
+        options['emit_addr'], options['reg_addr'],
+        enable_curve=options['curve'])
+    emit_addr, reg_addr = options['emit_addr'], options['reg_addr']
+    if emit_addr.startswith("tcp://"):
+        emit_addr = "tcp://127.0.0.1:%d" % events_server.pull_port
+        reg_addr = "tcp://127.0.0.1:%d" % events_server.pub_port
+    _report(emit_addr=emit_addr, reg_addr=reg_addr)
+
+    def commands():
+        _command()
+        cpu = _cpu_time()
+        _command()
+        _report(cpu=_cpu_time() - cpu)
+        reactor.callFromThread(reactor.stop)
+
+    threading.Thread(target=commands).start()
+    reactor.run()
+
+
+def _run_threaded(options):
+    clients = [
+        EventsClientThread(
+            options['emit_addr'], options['reg_addr'],
+            enable_curve=options['curve'])
+        for _ in range(options['clients'])]
+    subscriptions = []
+    if options['role'] == _SUBSCRIBER:
+        for client in clients:
+            subscription = _Subscription(options['expected'])
+            client.register(LOAD_EVENT, subscription.on_load)
+            client.register(PING_EVENT, subscription.on_ping)
+            subscriptions.append(subscription)
+        for client, subscription in zip(clients, subscriptions):
+            while not subscription.pinged.wait(0.05):
+                client.emit(PING_EVENT)
+    else:
+        for client in clients:
+            client.ensure_client()
+    _report(ready=True)
+
+    _command()
+    cpu = _cpu_time()
+    started = time.time()
+    if options['role'] == _SUBSCRIBER:
+        deadline = started + options['timeout']
+        for subscription in subscriptions:
+            subscription.done.wait(max(0, deadline - time.time()))
+    else:
+        padding = "x" * options['size']
+
+        def emit(client):
+            for i in range(options['count']):
+                client.emit(LOAD_EVENT, i, time.time(), padding)
+
+        threads = [threading.Thread(target=emit, args=(client,))
+                   for client in clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    _report(done=True)
+
+    _command()
+    _result(subscriptions, started, cpu)
+    for client in clients:
+        client.shutdown()
+        client.join()
+
+
+def _run_twisted(options):
+    from twisted.internet import reactor
+    from twisted.internet import task
+    from twisted.internet import defer
+    from leap.common.events.txclient import EventsTxClient
+
+    clients = [
+        EventsTxClient(
+            options['emit_addr'], options['reg_addr'],
+            enable_curve=options['curve'])
+        for _ in range(options['clients'])]
+    subscriptions = []
+    state = {}
+
+    def ping():
+        pending = [(c, s) for c, s in zip(clients, subscriptions)
+                   if not s.pinged.is_set()]
+        for client, _ in pending:
+            client.emit(PING_EVENT)
+        if not pending:
+            pinging.stop()
+            _report(ready=True)
+
+    def emit(client, padding):
+        for i in range(options['count']):
+            client.emit(LOAD_EVENT, i, time.time(), padding)
+            if i % 100 == 99:
+                # let the reactor send what was emitted
+                yield None
+
+    def check():
+        if (all(s.done.is_set() for s in subscriptions)
+                or time.time() > state['started'] + options['timeout']):
+            checking.stop()
+            _report(done=True)
+
+    def start():
+        state['cpu'] = _cpu_time()
+        state['started'] = time.time()
+        if options['role'] == _SUBSCRIBER:
+            checking.start(0.01)
+        else:
+            padding = "x" * options['size']
+            d = defer.gatherResults([
+                task.cooperate(emit(client, padding)).whenDone()
+                for client in clients])
+            d.addCallback(lambda _: _report(done=True))
+
+    def stop():
+        _result(subscriptions, state['started'], state['cpu'])
+        for client in clients:
+            client.shutdown()
+        reactor.stop()
+
+    def commands():
+        _command()
+        reactor.callFromThread(start)
+        _command()
+        reactor.callFromThread(stop)
+
+    checking = task.LoopingCall(check)
+    pinging = task.LoopingCall(ping)
+    if options['role'] == _SUBSCRIBER:
+        for client in clients:
+            subscription = _Subscription(options['expected'])
+            client.register(LOAD_EVENT, subscription.on_load)
+            client.register(PING_EVENT, subscription.on_ping)
+            subscriptions.append(subscription)
+        pinging.start(0.05)
+    else:
+        _report(ready=True)
+    threading.Thread(target=commands).start()
+    reactor.run()
+
+
+def _run_worker(options):
+    """
+    Run a worker process of the load benchmark.
+
+    :param options: The worker options, see bench_load().
+    :type options: dict
+    """
+    # keep keys and sockets in the benchmark's directory
+    os.chdir(options['workdir'])
+    config_flags.STANDALONE = True
+    if options['role'] == _SERVER:
+        _run_server(options)
+    elif options['client'] == TWISTED:
+        _run_twisted(options)
+    else:
+        _run_threaded(options)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["worker"]:
+        _run_worker(json.loads(sys.argv[2]))
+        sys.exit(0)
+    for (name, shape), (size, enc, dec) in sorted(bench_codecs().items()):
+        print("codec %-8s %-14s %4d bytes  encode %5.2f us  decode %5.2f us"
+              % (name, shape, size, enc, dec))
+    for size, linger in [(None, None), (100, None), (1000, 0.001)]:
+        rate = bench_emit(batch_size=size, batch_linger=linger)
+        print("emit batch_size=%s batch_linger=%s: %.0f msg/s"
+              % (size, linger, rate))
+    for zero_copy in (False, True):
+        results = bench_receive(zero_copy=zero_copy)
+        for size, (rate, throughput) in sorted(results.items()):
+            print("receive zero_copy=%-5s %7d bytes: %8.0f msg/s %7.1f MB/s"
+                  % (zero_copy, size, rate, throughput))
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# blobs.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+A shared memory side channel for the content of large events.
+
+Clients configured with a blob threshold write the encoded content of events
+larger than it to a file of a blob directory, and send a small handle
+through the server instead: TAG followed by the name of the file. Receivers
+on the same host map the file read only and decode the content from the
+map, so a large payload is copied once, instead of once per subscriber.
+
+Blobs are not reference counted, as the emitter can't know how many clients
+will read them. They are removed once they are older than TTL seconds, by
+whichever store writes a blob after that, so the receivers of an event must
+read it within TTL seconds of its emission.
+"""
+import errno
+import mmap
+import os
+import re
+import time
+import uuid
+
+from leap.common.events import codec as codecs
+from leap.common.events.errors import CodecError
+
+
+# the directory of the blobs, in the events config prefix
+DIRECTORY = "blobs"
+
+# how long, in seconds, blobs are kept
+TTL = 60.0
+
+# the first byte of a handle, which no codec uses as tag
+TAG = b'S'
+
+_TMP_SUFFIX = '.tmp'
+
+_NAME = re.compile(r'^[0-9a-f]{32}$')
+
+
+def is_handle(data):
+    """
+    Return whether the content of a message is a blob handle.
+
+    :param data: The content of the message.
+    :type data: str or memoryview
+
+    :rtype: bool
+    """
+    return codecs.to_bytes(data[:1]) == TAG
+
+
+class BlobStore(object):
+    """
+    Writes and reads the blobs of a directory.
+    """
+
+    def __init__(self, directory, ttl=TTL):
+        """
+        Initialize the store.
+
+        :param directory: The directory of the blobs, created when the first
+                          blob is written.
+        :type directory: str
+        :param ttl: How long, in seconds, blobs are kept.
+        :type ttl: float
+        """
+        self.directory = directory
+        self._ttl = ttl
+        self._next_sweep = 0
+
+    def put(self, data):
+        """
+        Write a blob.
+
+        :param data: The encoded content of an event.
+        :type data: str
+
+        :return: The handle of the blob.
+        :rtype: str
+        """
+        now = time.time()
+        if now >= self._next_sweep:
+            self._makedirs()
+            self.sweep(now)
+            self._next_sweep = now + self._ttl
+        name = uuid.uuid4().hex
+        path = os.path.join(self.directory, name)
+        # receivers only ever see complete blobs
+        with open(path + _TMP_SUFFIX, 'wb') as f:
+            f.write(data)
+        os.rename(path + _TMP_SUFFIX, path)
+        return TAG + name.encode('ascii')
+
+    def load(self, handle, accept=None):
+        """
+        Decode the content of an event from a blob.
+
+        :param handle: The handle of the blob.
+        :type handle: str or memoryview
+        :param accept: The names of the codecs accepted, or None to accept
+                       all of them.
+        :type accept: set of str
+
+        :return: The content of the event.
+        :rtype: tuple
+
+        :raises CodecError: if the handle is malformed, the blob is gone or
+                            its content can't be decoded.
+        """
+        name = codecs.to_bytes(handle[1:]).decode('ascii', 'replace')
+        if not _NAME.match(name):
+            raise CodecError("Malformed blob handle.")
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                if not os.fstat(f.fileno()).st_size:
+                    raise CodecError("Empty blob: %s" % name)
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            raise CodecError("Blob expired: %s" % name)
+        try:
+            try:
+                view = memoryview(mapped)
+            except TypeError:
+                # old maps only have the old buffer interface
+                view = mapped[:]
+            try:
+                return codecs.decode(view, accept=accept)
+            finally:
+                if isinstance(view, memoryview):
+                    view.release()
+        finally:
+            try:
+                mapped.close()
+            except BufferError:
+                # the codec still holds a view, the map is closed with it
+                pass
+
+    def sweep(self, now=None):
+        """
+        Remove the blobs older than the TTL, including those of other stores
+        of the same directory.
+
+        :param now: The current time, or None for now.
+        :type now: float
+
+        :return: The number of blobs removed.
+        :rtype: int
+        """
+        if now is None:
+            now = time.time()
+        try:
+            names = os.listdir(self.directory)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+        removed = 0
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                if os.stat(path).st_mtime > now - self._ttl:
+                    continue
+                os.remove(path)
+                removed += 1
+            except OSError:
+                # already removed, or still mapped on some platforms
+                pass
+        return removed
+
+    def _makedirs(self):
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
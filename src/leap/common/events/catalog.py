@@ -19,6 +19,8 @@
 """
 Events catalog.
 """
+import struct
+import zlib
 
 
 EVENTS = [
@@ -77,13 +79,113 @@ EVENTS = [
     "BONAFIDE_AUTH_DONE",  # (uuid, userid)
 
     "VPN_STATUS_CHANGED",
+
+    "EVENTS_SERVER_STATS",  # (stats)
 ]
 
 
+# State events, of which only the latest value matters. Clients configured
+# with a coalescing window send at most one value of each state per window,
+# newer values replacing the ones still waiting to be sent. Each event maps
+# to the path, in its content, of the key that tells its states apart (e.g.
+# the uuid of the account being synced), or to an empty path if the event
+# has a single state.
+COALESCED_EVENTS = {
+    "SOLEDAD_SYNC_RECEIVE_STATUS": (0, "uuid"),
+    "SOLEDAD_SYNC_SEND_STATUS": (0, "uuid"),
+    "MAIL_UNREAD_MESSAGES": (0,),
+    "VPN_STATUS_CHANGED": (),
+}
+
+
+# The path, in the content of an event, of the key of the account (or other
+# party) the event is about, for events that don't carry it as the first
+# element of their content. Callbacks may be registered for a single key, so
+# clients serving many accounts only run the callbacks of the right one.
+CONTENT_KEYS = {
+    "SOLEDAD_CREATING_KEYS": (0, "uuid"),
+    "SOLEDAD_DONE_CREATING_KEYS": (0, "uuid"),
+    "SOLEDAD_DONE_DATA_SYNC": (0, "uuid"),
+    "SOLEDAD_DONE_DOWNLOADING_KEYS": (0, "uuid"),
+    "SOLEDAD_DONE_UPLOADING_KEYS": (0, "uuid"),
+    "SOLEDAD_DOWNLOADING_KEYS": (0, "uuid"),
+    "SOLEDAD_INVALID_AUTH_TOKEN": (0, "uuid"),
+    "SOLEDAD_SYNC_RECEIVE_STATUS": (0, "uuid"),
+    "SOLEDAD_SYNC_SEND_STATUS": (0, "uuid"),
+    "SOLEDAD_UPLOADING_KEYS": (0, "uuid"),
+}
+
+DEFAULT_CONTENT_KEY = (0,)
+
+
+# Priority classes. When clients and server are configured with a high
+# priority lane, the events of the high class go through their own sockets,
+# and are handled first, so floods of other events (e.g. sync progress) don't
+# delay them. Events not listed in PRIORITIES are of the normal class.
+PRIORITY_NORMAL = 'normal'
+PRIORITY_HIGH = 'high'
+
+PRIORITIES = {
+    "RAISE_WINDOW": PRIORITY_HIGH,
+    "SOLEDAD_INVALID_AUTH_TOKEN": PRIORITY_HIGH,
+    "IMAP_SERVICE_FAILED_TO_START": PRIORITY_HIGH,
+    "IMAP_UNHANDLED_ERROR": PRIORITY_HIGH,
+    "SMTP_SERVICE_FAILED_TO_START": PRIORITY_HIGH,
+    "SMTP_CONNECTION_LOST": PRIORITY_HIGH,
+}
+
+
+# compact topics can't be mistaken for, or be a prefix of, a label
+COMPACT_TOPIC_PREFIX = b'\x01'
+
+# a label ending with this matches all events whose labels start with the
+# rest of it, e.g. SOLEDAD_*
+WILDCARD = '*'
+
+
 class Event(object):
+    """
+    An event of the catalog.
+
+    Besides its label, every event has a compact numeric id, derived from
+    the label so it is stable across releases, and a short binary topic
+    built from that id that may be used on the wire instead of the label.
+    The label itself goes on the wire as label_topic, which is the same
+    string on python 2.
 
-    def __init__(self, label):
+    Events that carry state may be coalesced, see COALESCED_EVENTS, and
+    events about an account carry its key in their content, see
+    CONTENT_KEYS. Control events may be of a higher priority than the rest,
+    see PRIORITIES.
+    """
+
+    __slots__ = ('label', 'label_topic', 'id', 'topic', 'coalesce', 'key',
+                 'priority')
+
+    def __init__(self, label, coalesce=None, key=DEFAULT_CONTENT_KEY,
+                 priority=PRIORITY_NORMAL):
+        """
+        Initialize the event.
+
+        :param label: The label of the event.
+        :type label: str
+        :param coalesce: The path of the coalescing key in the content of the
+                         event, or None if the event is not coalesced.
+        :type coalesce: tuple
+        :param key: The path of the key of the account the event is about in
+                    its content.
+        :type key: tuple
+        :param priority: The priority class of the event, PRIORITY_NORMAL or
+                         PRIORITY_HIGH.
+        :type priority: str
+        """
         self.label = label
+        self.label_topic = label.encode('ascii')
+        self.id = zlib.crc32(self.label_topic) & 0xffffffff
+        self.topic = COMPACT_TOPIC_PREFIX + struct.pack('>I', self.id)
+        self.coalesce = coalesce
+        self.key = key
+        self.priority = priority
 
     def __repr__(self):
         return '<Event: %s>' % self.label
@@ -91,8 +193,206 @@ class Event(object):
     def __str__(self):
         return self.label
 
+    def __hash__(self):
+        return self.id
+
+    def __eq__(self, other):
+        return isinstance(other, Event) and self.id == other.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def coalesce_key(self, content):
+        """
+        Return the key of the state carried by some content of this event.
+
+        :param content: The content of the event.
+        :type content: tuple
+
+        :return: The key, as found by following the coalescing path into the
+                 content.
+
+        :raises LookupError: if the content has no such key.
+        :raises TypeError: if the content can't be indexed by the path.
+        """
+        return _follow(content, self.coalesce)
+
+    def content_key(self, content):
+        """
+        Return the key of the account some content of this event is about.
+
+        :param content: The content of the event.
+        :type content: tuple
+
+        :return: The key, as found by following the key path into the
+                 content.
+
+        :raises LookupError: if the content has no such key.
+        :raises TypeError: if the content can't be indexed by the path.
+        """
+        return _follow(content, self.key)
+
+
+def _follow(content, path):
+    """
+    Follow a path of indexes and keys into some content.
+    """
+    for step in path:
+        content = content[step]
+    return content
+
+
+class Prefix(object):
+    """
+    A wildcard that matches all events of the catalog whose labels start with
+    a prefix.
+
+    Callbacks may be registered for a prefix instead of an event. As
+    subscriptions of zmq SUB sockets are prefixes themselves, the prefix
+    goes on the wire as label_topic, and a single subscription receives all
+    the matching events.
+    """
+
+    __slots__ = ('label', 'prefix', 'label_topic')
+
+    def __init__(self, prefix):
+        """
+        Initialize the wildcard.
+
+        :param prefix: The prefix of the labels of the matching events.
+        :type prefix: str
+        """
+        self.label = prefix + WILDCARD
+        self.prefix = prefix
+        self.label_topic = prefix.encode('ascii')
+
+    def __repr__(self):
+        return '<Prefix: %s>' % self.label
+
+    def __str__(self):
+        return self.label
+
+    def __hash__(self):
+        return hash((Prefix, self.prefix))
+
+    def __eq__(self, other):
+        return isinstance(other, Prefix) and self.prefix == other.prefix
+
+    def __ne__(self, other):
+        return not self == other
+
+    def matches(self, event):
+        """
+        Return whether an event matches the wildcard.
+
+        :param event: The event.
+        :type event: Event
+
+        :rtype: bool
+        """
+        return event.label.startswith(self.prefix)
+
+    def events(self):
+        """
+        Return the events of the catalog that match the wildcard.
+
+        :rtype: list of Event
+        """
+        return [_by_label[label] for label in sorted(_by_label)
+                if label.startswith(self.prefix)]
+
+
+_by_label = {}
+_by_id = {}
+_by_topic = {}
+
+
+def add_event(label, coalesce=None, key=DEFAULT_CONTENT_KEY,
+              priority=PRIORITY_NORMAL):
+    """
+    Add an event to the catalog.
+
+    :param label: The label of the event.
+    :type label: str
+    :param coalesce: The path of the coalescing key in the content of the
+                     event, or None if the event is not coalesced.
+    :type coalesce: tuple
+    :param key: The path of the key of the account the event is about in
+                its content.
+    :type key: tuple
+    :param priority: The priority class of the event, PRIORITY_NORMAL or
+                     PRIORITY_HIGH.
+    :type priority: str
+
+    :return: The new event.
+    :rtype: Event
+
+    :raises ValueError: if the label, or its id, is already in use, or the
+                        priority class is unknown.
+    """
+    if priority not in (PRIORITY_NORMAL, PRIORITY_HIGH):
+        raise ValueError("Unknown priority class: %s" % priority)
+    event = Event(label, coalesce=coalesce, key=key, priority=priority)
+    if label in _by_label:
+        raise ValueError("Event already in catalog: %s" % label)
+    if event.id in _by_id:
+        raise ValueError("Event id of %s collides with %s, pick another "
+                         "label." % (label, _by_id[event.id]))
+    _by_label[label] = event
+    _by_id[event.id] = event
+    _by_topic[event.label_topic] = event
+    _by_topic[event.topic] = event
+    return event
+
+
+def get_event(topic):
+    """
+    Return the event identified by a topic received from the wire.
+
+    :param topic: The label or the compact topic of the event.
+    :type topic: str
+
+    :return: The event, or None if it is not in the catalog.
+    :rtype: Event
+    """
+    return _by_topic.get(topic)
+
+
+def get_event_by_id(event_id):
+    """
+    Return the event with a given id.
+
+    :param event_id: The id of the event.
+    :type event_id: int
+
+    :return: The event, or None if it is not in the catalog.
+    :rtype: Event
+    """
+    return _by_id.get(event_id)
+
+
+def match(label):
+    """
+    Return the event, or the wildcard, identified by a label.
+
+    :param label: The label of an event, or a prefix of labels followed by
+                  WILDCARD, e.g. SOLEDAD_*
+    :type label: str
+
+    :rtype: Event or Prefix
+
+    :raises KeyError: if the label is not a wildcard and there is no such
+                      event in the catalog.
+    """
+    if label.endswith(WILDCARD):
+        return Prefix(label[:-len(WILDCARD)])
+    return _by_label[label]
+
 
-# create local variables based on the event list above
-lcl = locals()
-for event in EVENTS:
-    lcl[event] = Event(event)
+# expose the events as attributes of this module, e.g. catalog.CLIENT_UID
+for label in EVENTS:
+    globals()[label] = add_event(
+        label, COALESCED_EVENTS.get(label),
+        CONTENT_KEYS.get(label, DEFAULT_CONTENT_KEY),
+        PRIORITIES.get(label, PRIORITY_NORMAL))
+del label
@@ -23,14 +23,14 @@ messages to other clients.
 
 When a client registers a callback for a given event, it also tells the
 server that it wants to be notified whenever events of that type are sent by
-some other client.
+some other client. Callbacks may also be registered for all the events whose
+labels start with a prefix, see catalog.Prefix.
 """
 import logging
 import collections
 import uuid
 import threading
 import time
-import pickle
 import os
 
 from abc import ABCMeta
@@ -39,23 +39,24 @@ from abc import abstractmethod
 import zmq
 from zmq.eventloop import zmqstream
 from zmq.eventloop import ioloop
-
-# XXX some distros don't package libsodium, so we have to be prepared for
-#     absence of zmq.auth
-try:
-    import zmq.auth
-except ImportError:
-    pass
+from zmq.utils.monitor import parse_monitor_message
 
 from leap.common.config import flags, get_path_prefix
 from leap.common.zmq_utils import zmq_has_curve
-from leap.common.zmq_utils import maybe_create_and_get_certificates
-from leap.common.zmq_utils import PUBLIC_KEYS_PREFIX
+from leap.common.zmq_utils import get_keyring
+from leap.common.zmq_utils import zmq_capabilities
+from leap.common.zmq_utils import MONITOR_EVENTS
 
 from leap.common.events.errors import CallbackAlreadyRegisteredError
+from leap.common.events.errors import CodecError
+from leap.common.events.metrics import Metrics
 from leap.common.events.server import EMIT_ADDR
 from leap.common.events.server import REG_ADDR
+from leap.common.events import blobs
 from leap.common.events import catalog
+from leap.common.events import codec as codecs
+from leap.common.events import executors
+from leap.common.events import wire
 
 
 logger = logging.getLogger(__name__)
@@ -65,16 +66,151 @@ _emit_addr = EMIT_ADDR
 _reg_addr = REG_ADDR
 _factory = None
 _enable_curve = True
-
-
-def configure_client(emit_addr, reg_addr, factory=None, enable_curve=True):
+_batch_size = None
+_batch_linger = None
+_codec = codecs.DEFAULT_CODEC
+_accept_codecs = None
+_legacy_wire = False
+_suppress_unobserved = False
+_compact_topics = False
+_executor = None
+_coalesce_window = None
+_deliver_locally = False
+_metrics = False
+_heartbeat = None
+_emit_buffer = None
+_emit_overflow = executors.DROP_OLDEST
+_priority_emit_addr = None
+_priority_reg_addr = None
+_blob_threshold = None
+
+
+# how long, in seconds, the threaded client waits on shutdown for queued
+# callbacks to run and queued messages to reach the server
+SHUTDOWN_TIMEOUT = 5.0
+
+
+# how many heartbeat intervals may pass without hearing from the server before
+# its connections are deemed dead
+HEARTBEAT_MISSES = 3
+
+
+# how long, in seconds, buffered events wait before sending them is tried
+# again, when the socket had no room for them
+EMIT_RETRY_DELAY = 0.05
+
+
+# the kinds of replay a callback may ask for when registered
+_REPLAY_KINDS = {
+    'recent': wire.REPLAY_RECENT,
+    'last': wire.REPLAY_LAST,
+}
+
+
+def configure_client(emit_addr, reg_addr, factory=None, enable_curve=True,
+                     batch_size=None, batch_linger=None,
+                     codec=codecs.DEFAULT_CODEC, accept_codecs=None,
+                     legacy_wire=False, suppress_unobserved=False,
+                     compact_topics=False, executor=None,
+                     coalesce_window=None, deliver_locally=False,
+                     metrics=False, heartbeat=None, emit_buffer=None,
+                     emit_overflow=executors.DROP_OLDEST,
+                     priority_emit_addr=None, priority_reg_addr=None,
+                     blob_threshold=None):
+    """
+    Configure the parameters used to create the client singletons.
+
+    :param batch_size: If not None, the threaded client queues emitted
+                       events and sends up to this many events on each
+                       ioloop iteration.
+    :type batch_size: int
+    :param batch_linger: The maximum time (in seconds) a batched event may
+                         wait in the queue before being sent.
+    :type batch_linger: float
+    :param codec: The name of the codec used to encode emitted events.
+    :type codec: str
+    :param accept_codecs: The names of the codecs accepted when decoding
+                          received events, or None to accept all of them.
+                          See codec.safe_codecs().
+    :type accept_codecs: list of str
+    :param legacy_wire: Whether to emit single frame messages, for servers
+                        that predate multipart messages.
+    :type legacy_wire: bool
+    :param suppress_unobserved: Whether to skip sending events that no
+                                client is subscribed to, as reported by the
+                                server.
+    :type suppress_unobserved: bool
+    :param compact_topics: Whether to use the events' compact binary topics
+                           instead of their labels on the wire. All clients
+                           must agree on this.
+    :type compact_topics: bool
+    :param executor: The executor that runs the callbacks of the threaded
+                     client, instead of its ioloop.
+    :type executor: leap.common.events.executors.PoolExecutor or
+                    leap.common.events.executors.SerialExecutor
+    :param coalesce_window: If not None, clients send at most one value of
+                            each state carried by coalesced events per this
+                            many seconds, see catalog.COALESCED_EVENTS.
+    :type coalesce_window: float
+    :param deliver_locally: Whether clients run their own callbacks for the
+                            events they emit directly, instead of when the
+                            server sends the events back.
+    :type deliver_locally: bool
+    :param metrics: Whether clients keep traffic and latency metrics, see
+                    EventsClient.stats().
+    :type metrics: bool
+    :param heartbeat: If not None, clients send zmq heartbeats to the server
+                      every this many seconds, and drop connections that are
+                      silent for HEARTBEAT_MISSES intervals.
+    :type heartbeat: float
+    :param emit_buffer: If not None, clients keep up to this many emitted
+                        events while the server is unreachable, and send
+                        them when they connect to it again.
+    :type emit_buffer: int
+    :param emit_overflow: What clients do with events emitted while their
+                          buffer is full, see executors.BoundedQueue.
+    :type emit_overflow: str
+    :param priority_emit_addr: If not None, the address to which clients
+                               send high priority events, see
+                               catalog.PRIORITIES.
+    :type priority_emit_addr: str
+    :param priority_reg_addr: If not None, the address in which clients
+                              listen for high priority events.
+    :type priority_reg_addr: str
+    :param blob_threshold: If not None, clients send the content of events
+                           larger than this many bytes through shared
+                           memory, see blobs.py.
+    :type blob_threshold: int
+    """
     global _emit_addr, _reg_addr, _factory, _enable_curve
+    global _batch_size, _batch_linger, _codec, _accept_codecs, _legacy_wire
+    global _suppress_unobserved, _compact_topics, _executor
+    global _coalesce_window, _deliver_locally, _metrics
+    global _heartbeat, _emit_buffer, _emit_overflow
+    global _priority_emit_addr, _priority_reg_addr, _blob_threshold
     logger.debug("Configuring client with addresses: (%s, %s)" %
                  (emit_addr, reg_addr))
     _emit_addr = emit_addr
     _reg_addr = reg_addr
     _factory = factory
     _enable_curve = enable_curve
+    _batch_size = batch_size
+    _batch_linger = batch_linger
+    _codec = codec
+    _accept_codecs = accept_codecs
+    _legacy_wire = legacy_wire
+    _suppress_unobserved = suppress_unobserved
+    _compact_topics = compact_topics
+    _executor = executor
+    _coalesce_window = coalesce_window
+    _deliver_locally = deliver_locally
+    _metrics = metrics
+    _heartbeat = heartbeat
+    _emit_buffer = emit_buffer
+    _emit_overflow = emit_overflow
+    _priority_emit_addr = priority_emit_addr
+    _priority_reg_addr = priority_reg_addr
+    _blob_threshold = blob_threshold
 
 
 class EventsClient(object):
@@ -87,14 +223,138 @@ class EventsClient(object):
     _instance = None
     _instance_lock = threading.Lock()
 
-    def __init__(self, emit_addr, reg_addr):
+    def __init__(self, emit_addr, reg_addr, codec=codecs.DEFAULT_CODEC,
+                 accept_codecs=None, legacy_wire=False,
+                 suppress_unobserved=False, compact_topics=False,
+                 coalesce_window=None, deliver_locally=False,
+                 metrics=False, heartbeat=None, emit_buffer=None,
+                 emit_overflow=executors.DROP_OLDEST,
+                 priority_emit_addr=None, priority_reg_addr=None,
+                 blob_threshold=None):
         """
         Initialize the events client.
+
+        :param codec: The name of the codec used to encode emitted events.
+        :type codec: str
+        :param accept_codecs: The names of the codecs accepted when decoding
+                              received events, or None to accept all of
+                              them. See codec.safe_codecs().
+        :type accept_codecs: list of str
+        :param legacy_wire: Whether to emit single frame messages, for
+                            servers that predate multipart messages.
+        :type legacy_wire: bool
+        :param suppress_unobserved: Whether to skip sending events that no
+                                    client is subscribed to, as reported by
+                                    the server.
+        :type suppress_unobserved: bool
+        :param compact_topics: Whether to use the events' compact binary
+                               topics instead of their labels on the wire.
+        :type compact_topics: bool
+        :param coalesce_window: If not None, send at most one value of each
+                                state carried by coalesced events per this
+                                many seconds, newer values replacing the
+                                ones waiting to be sent.
+        :type coalesce_window: float
+        :param deliver_locally: Whether to run this client's callbacks for
+                                the events it emits directly, with the
+                                emitted objects, instead of when the server
+                                sends the events back.
+        :type deliver_locally: bool
+        :param metrics: Whether to keep traffic and latency metrics. Emitted
+                        messages then carry their emission time.
+        :type metrics: bool
+        :param heartbeat: If not None, send zmq heartbeats to the server
+                          every this many seconds, and drop connections that
+                          are silent for HEARTBEAT_MISSES intervals.
+        :type heartbeat: float
+        :param emit_buffer: If not None, keep up to this many emitted events
+                            while the server is unreachable, and send them
+                            when connected to it again.
+        :type emit_buffer: int
+        :param emit_overflow: What to do with events emitted while the
+                              buffer is full, see executors.BoundedQueue.
+        :type emit_overflow: str
+        :param priority_emit_addr: If not None, the address to which send
+                                   high priority events, see
+                                   catalog.PRIORITIES.
+        :type priority_emit_addr: str
+        :param priority_reg_addr: If not None, the address in which to
+                                  listen for high priority events.
+        :type priority_reg_addr: str
+        :param blob_threshold: If not None, send the content of events
+                               larger than this many bytes through shared
+                               memory, see blobs.py. All subscribers must
+                               be in the same host.
+        :type blob_threshold: int
+
+        :raises ValueError: if legacy_wire is set together with
+                            compact_topics, as compact topics may contain
+                            null bytes, or with deliver_locally, as legacy
+                            messages can't tell their origin, or if only one
+                            of the high priority addresses is given.
         """
+        if legacy_wire and compact_topics:
+            raise ValueError("Compact topics need multipart messages.")
+        if legacy_wire and deliver_locally:
+            raise ValueError("Local delivery needs multipart messages.")
+        if (priority_emit_addr is None) != (priority_reg_addr is None):
+            raise ValueError(
+                "The high priority lane needs both of its addresses.")
         logger.debug("Creating client instance.")
-        self._callbacks = collections.defaultdict(dict)
+        # the callbacks of each event or wildcard, by uid, in the order they
+        # were registered, which is the order in which they run
+        self._callbacks = collections.defaultdict(collections.OrderedDict)
+        # the content keys of the callbacks registered for a single key and
+        # the filter topics of those registered with a filter, by event and
+        # uid, the wildcards registered, by prefix, and a fan-out table of the
+        # callbacks matching each event, filled as events arrive and dropped
+        # whenever callbacks are (un)registered
+        self._keys = {}
+        self._filters = {}
+        self._prefixes = {}
+        self._dispatch = {}
+        # the replays waiting for the server, by request head, as
+        # (event, uid, request topic) tuples
+        self._replays = {}
         self._emit_addr = emit_addr
         self._reg_addr = reg_addr
+        self._priority_emit_addr = priority_emit_addr
+        self._priority_reg_addr = priority_reg_addr
+        # the store of the blobs of large events, created on first use
+        self._blob_threshold = blob_threshold
+        self._blobs = None
+        self._codec = codecs.get_codec(codec)
+        self._accept_codecs = None
+        if accept_codecs is not None:
+            self._accept_codecs = set(accept_codecs)
+        self._legacy_wire = legacy_wire
+        self._suppress_unobserved = suppress_unobserved
+        self._compact_topics = compact_topics
+        # the topics subscribed in the server and a cache of which labels
+        # they match, or None until the server reports them
+        self._observed = None
+        # coalescing: the values waiting to be sent, and until when values
+        # of each state are held back, both indexed by (event, key)
+        self._coalesce_window = coalesce_window
+        self._coalesce_lock = threading.Lock()
+        self._coalesce_pending = collections.OrderedDict()
+        self._coalesce_until = {}
+        self._coalesce_scheduled = False
+        # the id by which we recognize our own events, when delivered locally
+        self._deliver_locally = deliver_locally
+        self._origin = uuid.uuid4().bytes
+        self._metrics = Metrics() if metrics else None
+        # whether the sockets connected to each address are connected, as
+        # reported by socket monitors when there is a heartbeat or an emit
+        # buffer, and how many times the connection to the server was lost
+        self._heartbeat = heartbeat
+        self._monitored = heartbeat is not None or emit_buffer is not None
+        self._links = {emit_addr: False, reg_addr: False}
+        self._disconnects = 0
+        # the events waiting for the server to be reachable
+        self._outbox = None
+        if emit_buffer is not None:
+            self._outbox = executors.BoundedQueue(emit_buffer, emit_overflow)
 
     @property
     def callbacks(self):
@@ -107,17 +367,42 @@ class EventsClient(object):
         """
         with cls._instance_lock:
             if cls._instance is None:
-                cls._instance = cls(
-                    _emit_addr, _reg_addr, factory=_factory,
-                    enable_curve=_enable_curve)
+                cls._instance = cls._create_instance()
         return cls._instance
 
-    def register(self, event, callback, uid=None, replace=False):
+    @classmethod
+    def _create_instance(cls):
+        """
+        Create a new client instance using the module configuration.
+        """
+        return cls(
+            _emit_addr, _reg_addr, factory=_factory,
+            enable_curve=_enable_curve, codec=_codec,
+            accept_codecs=_accept_codecs, legacy_wire=_legacy_wire,
+            suppress_unobserved=_suppress_unobserved,
+            compact_topics=_compact_topics,
+            coalesce_window=_coalesce_window,
+            deliver_locally=_deliver_locally, metrics=_metrics,
+            heartbeat=_heartbeat, emit_buffer=_emit_buffer,
+            emit_overflow=_emit_overflow,
+            priority_emit_addr=_priority_emit_addr,
+            priority_reg_addr=_priority_reg_addr,
+            blob_threshold=_blob_threshold)
+
+    def register(self, event, callback, uid=None, replace=False,
+                 replay=None, key=None, where=None):
         """
         Register a callback to be executed when an event is received.
 
-        :param event: The event that triggers the callback.
-        :type event: Event
+        The callbacks registered for any content of an event run first, then
+        those registered for the key of the content, each group in the order
+        they were registered, a replaced callback keeping its place.
+        Callbacks registered with a filter run for the copy of the event the
+        server sends under their filter, on its own.
+
+        :param event: The event that triggers the callback, or a wildcard
+                      matching all the events that trigger it.
+        :type event: Event or Prefix
         :param callback: The callback to be executed.
         :type callback: callable(event, *content)
         :param uid: The callback uid.
@@ -125,22 +410,129 @@ class EventsClient(object):
         :param replace: Wether an eventual callback with same ID should be
                         replaced.
         :type replace: bool
+        :param replay: If 'recent', also run the callback for the recent
+                       events kept by the server. If 'last', run it for the
+                       last event (or the last event of each state) kept by
+                       the server. Replayed events may overlap with the ones
+                       received right after registering.
+        :type replay: str
+        :param key: If not None, only run the callback for events about this
+                    key, usually the uuid or userid of an account, see
+                    catalog.CONTENT_KEYS.
+        :type key: hashable
+        :param where: If not None, the values the content of an event must
+                      have, by position, for the callback to be run. The
+                      server only sends the events that match, and only
+                      events encoded with a safe codec ever match.
+        :type where: dict
 
         :return: The callback uid.
         :rtype: str
 
         :raises CallbackAlreadyRegisteredError: when there's already a callback
                 identified by the given uid and replace is False.
+        :raises ValueError: if the kind of replay is unknown, or the filter
+                            is malformed, given for a wildcard or along with a
+                            key.
+        :raises TypeError: if the key is not hashable, or a value of the
+                           filter can't be encoded as JSON.
         """
         logger.debug("Subscribing to event: %s" % event)
+        if replay is not None and replay not in _REPLAY_KINDS:
+            raise ValueError("Unknown kind of replay: %r" % (replay,))
+        if key is not None:
+            hash(key)
+        filtered = None
+        if where is not None:
+            if isinstance(event, catalog.Prefix):
+                raise ValueError("Wildcards can't be filtered.")
+            if key is not None:
+                raise ValueError("A callback can't have a key and a filter.")
+            filtered = wire.filter_topic(self._topic(event), where)
+            if self._codec.name not in codecs.safe_codecs():
+                logger.warning(
+                    "The server never filters events encoded with the %s "
+                    "codec, so filtered callbacks of %s won't receive the "
+                    "events this client emits. Use a safe codec, like %s."
+                    % (self._codec.name, event, codecs.JSON))
+        callbacks = self._callbacks.get(event)
         if not uid:
             uid = uuid.uuid4()
-        elif uid in self._callbacks[event] and not replace:
+        elif callbacks and uid in callbacks and not replace:
             raise CallbackAlreadyRegisteredError()
+        subscribed = self._wanted_topics(event)
         self._callbacks[event][uid] = callback
-        self._subscribe(str(event))
+        self._forget_match(event, uid)
+        if key is not None:
+            self._keys.setdefault(event, {})[uid] = key
+        if filtered is not None:
+            self._filters.setdefault(event, {})[uid] = filtered
+        if isinstance(event, catalog.Prefix):
+            self._prefixes[event.prefix] = event
+        self._dispatch = {}
+        self._update_subscriptions(event, subscribed)
+        if replay is not None:
+            self._request_replay(event, uid, _REPLAY_KINDS[replay])
         return uid
 
+    def _request_replay(self, event, uid, kind):
+        """
+        Ask the server to replay the events it keeps to a callback.
+
+        :param event: The event, or wildcard, the callback is registered for.
+        :type event: Event or Prefix
+        :param uid: The callback uid.
+        :type uid: str
+        :param kind: The kind of replay, wire.REPLAY_RECENT or
+                     wire.REPLAY_LAST.
+        :type kind: str
+        """
+        # the server replays all kept messages in the normal lane
+        topics = set(topic for topic, _ in self._subscription_topics(event))
+        for topic in sorted(topics):
+            request = wire.replay_request(kind, topic)
+            head, _, _ = wire.parse_replay_request(request)
+            self._replays[head] = (event, uid, request)
+            self._subscribe(request)
+
+    def _on_replay(self, head, frames):
+        """
+        Handle a message replayed by the server.
+
+        :param head: The head of the replay request.
+        :type head: str
+        :param frames: The frames of the received message.
+        :type frames: list of str
+        """
+        replay = self._replays.get(head)
+        if replay is None:
+            return
+        registered, uid, request = replay
+        if len(frames) == 1:
+            # the end of the replay
+            del self._replays[head]
+            self._unsubscribe(request)
+            return
+        topic, data = wire.unpack(
+            [frames[0][len(head):]] + list(frames[1:]))
+        event = catalog.get_event(topic)
+        callback = self._callbacks.get(registered, {}).get(uid)
+        if event is None or callback is None:
+            return
+        content = self._decode(data)
+        if content is None:
+            return
+        keys = self._keys.get(registered)
+        if keys and uid in keys and keys[uid] != self._content_key(
+                event, content):
+            return
+        filters = self._filters.get(registered)
+        if filters and uid in filters and not self._filter_matches(
+                event, filters[uid], content):
+            return
+        logger.debug("Replaying event %s to callback %s." % (event, uid))
+        self._run_callback(callback, event, content)
+
     def unregister(self, event, uid=None):
         """
         Unregister callbacks for an event.
@@ -148,23 +540,87 @@ class EventsClient(object):
         If uid is not None, then only the callback identified by the given uid
         is removed. Otherwise, all callbacks for the event are removed.
 
-        :param event: The event that triggers the callback.
-        :type event: Event
+        :param event: The event, or wildcard, the callbacks were registered
+                      for.
+        :type event: Event or Prefix
         :param uid: The callback uid.
         :type uid: str
         """
+        self._dispatch = {}
+        subscribed = self._wanted_topics(event)
         if not uid:
             logger.debug(
                 "Unregistering all callbacks from event %s." % event)
             self._callbacks[event] = {}
+            self._keys.pop(event, None)
+            self._filters.pop(event, None)
         else:
             logger.debug(
                 "Unregistering callback %s from event %s." % (uid, event))
             if uid in self._callbacks[event]:
                 del self._callbacks[event][uid]
+            self._forget_match(event, uid)
         if not self._callbacks[event]:
             del self._callbacks[event]
-            self._unsubscribe(str(event))
+            if isinstance(event, catalog.Prefix):
+                self._prefixes.pop(event.prefix, None)
+        self._update_subscriptions(event, subscribed)
+
+    def _forget_match(self, event, uid):
+        """
+        Forget the content key or the filter a callback was registered for,
+        if any.
+
+        :param event: The event, or wildcard, the callback is registered for.
+        :type event: Event or Prefix
+        :param uid: The callback uid.
+        :type uid: str
+        """
+        for matches in (self._keys, self._filters):
+            registered = matches.get(event)
+            if registered is not None:
+                registered.pop(uid, None)
+                if not registered:
+                    del matches[event]
+
+    def _wanted_topics(self, event):
+        """
+        Return the topics to be subscribed on the wire for the callbacks
+        registered for an event or a wildcard.
+
+        :param event: The event or wildcard.
+        :type event: Event or Prefix
+
+        :return: The topics, and whether they go through the high priority
+                 lane.
+        :rtype: set of (str, bool)
+        """
+        callbacks = self._callbacks.get(event)
+        if not callbacks:
+            return set()
+        filters = self._filters.get(event, {})
+        wanted = set((filtered, self._on_priority_lane(event))
+                     for filtered in filters.values())
+        if len(filters) < len(callbacks):
+            # some callback wants all the events
+            wanted.update(self._subscription_topics(event))
+        return wanted
+
+    def _update_subscriptions(self, event, subscribed):
+        """
+        Subscribe and unsubscribe topics on the wire after the callbacks
+        registered for an event or a wildcard changed.
+
+        :param event: The event or wildcard.
+        :type event: Event or Prefix
+        :param subscribed: The topics that were wanted before the change.
+        :type subscribed: set of (str, bool)
+        """
+        wanted = self._wanted_topics(event)
+        for topic, priority in sorted(wanted - subscribed):
+            self._subscribe(topic, priority)
+        for topic, priority in sorted(subscribed - wanted):
+            self._unsubscribe(topic, priority)
 
     def emit(self, event, *content):
         """
@@ -175,11 +631,393 @@ class EventsClient(object):
         :param content: The content of the event.
         :type content: list
         """
+        if self._suppress_unobserved and not self._is_observed(event):
+            return
+        if (self._coalesce_window is not None
+                and event.coalesce is not None
+                and self._coalesce(event, content)):
+            return
+        return self._send_event(event, content)
+
+    def _send_event(self, event, content):
+        """
+        Encode an event and send it.
+
+        :param event: The event to be sent.
+        :type event: Event
+        :param content: The content of the event.
+        :type content: tuple
+
+        :return: Whatever the client's _send() returns.
+        """
         logger.debug("Emitting event: (%s, %s)" % (event, content))
-        payload = str(event) + b'\0' + pickle.dumps(content)
-        self._send(payload)
+        origin = None
+        timestamp = None
+        if self._metrics is not None:
+            timestamp = time.time()
+        if self._deliver_locally and self._has_callbacks(event):
+            deliveries = self._handle_event(event, content)
+            if self._metrics is not None:
+                self._metrics.received(
+                    event.label, 0, deliveries, emitted=timestamp)
+            # the server still sends it to other clients, and back to us
+            origin = self._origin
+        body = self._codec.encode(content)
+        if (self._blob_threshold is not None
+                and len(body) > self._blob_threshold):
+            # subscribers map it, instead of each getting a copy
+            body = self._blob_store().put(body)
+        frames = wire.pack(
+            self._topic(event), body, self._legacy_wire, origin=origin,
+            timestamp=timestamp)
+        if self._metrics is not None:
+            self._metrics.sent(event.label, len(body))
+        return self._send(frames, self._on_priority_lane(event))
+
+    def _coalesce(self, event, content):
+        """
+        Hold back a value of a coalesced event if a value of the same state
+        was sent less than a coalescing window ago.
+
+        :param event: The event to be sent.
+        :type event: Event
+        :param content: The content of the event.
+        :type content: tuple
+
+        :return: Whether the value was held back, and must not be sent now.
+        :rtype: bool
+        """
+        try:
+            state = (event, event.coalesce_key(content))
+            hash(state)
+        except (LookupError, TypeError):
+            # not shaped as expected, don't risk merging unrelated values
+            return False
+        now = time.time()
+        with self._coalesce_lock:
+            until = self._coalesce_until.get(state)
+            if until is None or until <= now:
+                self._coalesce_until[state] = now + self._coalesce_window
+                return False
+            # replace any older value, keeping its place in the queue
+            self._coalesce_pending[state] = content
+            schedule = not self._coalesce_scheduled
+            self._coalesce_scheduled = True
+        if schedule:
+            self._call_later(until - now, self._flush_coalesced)
+        return True
+
+    def _flush_coalesced(self, force=False):
+        """
+        Send the held back values whose coalescing window has ended.
 
-    def _handle_event(self, event, content):
+        :param force: Whether to send all held back values.
+        :type force: bool
+        """
+        now = time.time()
+        ready = []
+        with self._coalesce_lock:
+            self._coalesce_scheduled = False
+            pending = self._coalesce_pending
+            for state in list(pending):
+                if force or self._coalesce_until[state] <= now:
+                    ready.append((state[0], pending.pop(state)))
+                    # sending starts a new window for the state
+                    self._coalesce_until[state] = now + self._coalesce_window
+            # forget states that went quiet
+            for state, until in list(self._coalesce_until.items()):
+                if until <= now and state not in pending:
+                    del self._coalesce_until[state]
+            delay = None
+            if pending:
+                delay = min(self._coalesce_until[state]
+                            for state in pending) - now
+                self._coalesce_scheduled = True
+        if delay is not None:
+            self._call_later(delay, self._flush_coalesced)
+        for event, content in ready:
+            self._send_event(event, content)
+
+    def _topic(self, event):
+        """
+        Return the topic used on the wire for an event.
+
+        :param event: The event.
+        :type event: Event
+
+        :rtype: str
+        """
+        if self._compact_topics:
+            return event.topic
+        return event.label_topic
+
+    def _on_priority_lane(self, event):
+        """
+        Return whether an event goes through the high priority lane.
+
+        :param event: The event.
+        :type event: Event
+
+        :rtype: bool
+        """
+        return (self._priority_emit_addr is not None
+                and event.priority == catalog.PRIORITY_HIGH)
+
+    def _subscription_topics(self, event):
+        """
+        Return the topics to subscribe to on the wire for an event or a
+        wildcard, and the lane of each one.
+
+        :param event: The event or wildcard.
+        :type event: Event or Prefix
+
+        :return: The topics, and whether they go through the high priority
+                 lane.
+        :rtype: list of (str, bool)
+        """
+        if isinstance(event, catalog.Prefix):
+            if self._compact_topics:
+                # compact topics don't share prefixes, so subscribe to each
+                # of the events already in the catalog
+                return [(e.topic, self._on_priority_lane(e))
+                        for e in event.events()]
+            if self._priority_emit_addr is not None:
+                # the prefix may match events of both lanes
+                return [(self._topic(event), False),
+                        (self._topic(event), True)]
+        elif self._on_priority_lane(event):
+            return [(self._topic(event), True)]
+        return [(self._topic(event), False)]
+
+    def _fanout(self, event):
+        """
+        Return the callbacks registered for an event, either exactly or
+        through a wildcard.
+
+        Exact registrations come first, followed by wildcards from the
+        longest prefix to the shortest one, and the callbacks of each one in
+        the order they were registered. Once computed, the result is kept
+        in a fan-out table, so routing an event costs a couple of lookups no
+        matter how many callbacks, or keys, are registered.
+
+        :param event: The event.
+        :type event: Event
+
+        :return: The uids and callbacks registered for any content, those
+                 registered for a single key, indexed by that key, and those
+                 registered with a filter, indexed by the filter topic.
+        :rtype: (tuple of (str, callable), dict, dict)
+        """
+        dispatch = self._dispatch
+        try:
+            return dispatch[event]
+        except KeyError:
+            pass
+        registrations = [event]
+        if self._prefixes:
+            label = event.label
+            for end in range(len(label), -1, -1):
+                prefix = self._prefixes.get(label[:end])
+                if prefix is not None:
+                    registrations.append(prefix)
+        callbacks = []
+        keyed = collections.defaultdict(list)
+        filtered = collections.defaultdict(list)
+        for registered in registrations:
+            keys = self._keys.get(registered, {})
+            filters = self._filters.get(registered, {})
+            for uid, callback in list(
+                    self._callbacks.get(registered, {}).items()):
+                if uid in filters:
+                    filtered[filters[uid]].append((uid, callback))
+                elif uid in keys:
+                    keyed[keys[uid]].append((uid, callback))
+                else:
+                    callbacks.append((uid, callback))
+        fanout = (tuple(callbacks),
+                  dict((key, tuple(c)) for key, c in keyed.items()),
+                  dict((topic, tuple(c)) for topic, c in filtered.items()))
+        dispatch[event] = fanout
+        return fanout
+
+    def _callbacks_for(self, event, content, topic=None):
+        """
+        Return the callbacks to be run for some content of an event.
+
+        Callbacks registered for the key of the content come after the ones
+        registered for any content, and those registered with a filter only
+        run for the copies the server sends under its filter topic.
+
+        :param event: The event.
+        :type event: Event
+        :param content: The content of the event.
+        :type content: tuple
+        :param topic: The topic the event arrived under, or None if it was
+                      delivered locally.
+        :type topic: str
+
+        :return: The uids and callbacks.
+        :rtype: tuple of (str, callable)
+        """
+        callbacks, keyed, filtered = self._fanout(event)
+        if topic is not None and topic.startswith(wire.FILTER_TOPIC):
+            return filtered.get(topic, ())
+        if keyed:
+            callbacks += keyed.get(self._content_key(event, content), ())
+        if topic is None:
+            # no filtered copy comes back from the server
+            for filter_topic, matching in filtered.items():
+                if self._filter_matches(event, filter_topic, content):
+                    callbacks += matching
+        return callbacks
+
+    def _filter_matches(self, event, filtered, content):
+        """
+        Return whether some content of an event matches a filter.
+
+        :param event: The event.
+        :type event: Event
+        :param filtered: The filter topic.
+        :type filtered: str
+        :param content: The content of the event.
+        :type content: tuple
+
+        :rtype: bool
+        """
+        _, fields = wire.parse_filter_topic(filtered)
+        return wire.content_filter_topic(
+            self._topic(event), tuple(fields), content) == filtered
+
+    def _has_callbacks(self, event):
+        """
+        Return whether any callback is registered for an event.
+
+        :param event: The event.
+        :type event: Event
+
+        :rtype: bool
+        """
+        callbacks, keyed, filtered = self._fanout(event)
+        return bool(callbacks or keyed or filtered)
+
+    def _content_key(self, event, content):
+        """
+        Return the key of the account some content of an event is about.
+
+        :param event: The event.
+        :type event: Event
+        :param content: The content of the event.
+        :type content: tuple
+
+        :return: The key, or None if the content has no hashable key.
+        """
+        try:
+            key = event.content_key(content)
+            hash(key)
+        except (LookupError, TypeError):
+            return None
+        return key
+
+    def _is_observed(self, event):
+        """
+        Return whether some client may be interested in an event.
+
+        :param event: The event.
+        :type event: Event
+
+        :rtype: bool
+        """
+        if self._has_callbacks(event):
+            return True
+        observed = self._observed
+        if observed is None:
+            return True
+        topics, matches = observed
+        try:
+            return matches[event]
+        except KeyError:
+            # subscriptions are prefixes of the topics they match
+            topic = self._topic(event)
+            match = any(topic.startswith(t) for t in topics)
+            matches[event] = match
+            return match
+
+    def _on_message(self, frames):
+        """
+        Handle an incoming message in the SUB socket.
+
+        :param frames: The frames of the received message. The content may
+                       be a memoryview.
+        :type frames: list of str
+        """
+        if frames[0] == wire.SUBSCRIPTIONS_TOPIC:
+            topics = set()
+            for topic in frames[1:]:
+                # a filtered subscription observes its event
+                parsed = wire.parse_filter_topic(topic)
+                topics.add(parsed[0] if parsed is not None else topic)
+            # replace both at once, emit() may be running in another thread
+            self._observed = (frozenset(topics), {})
+            return
+        if self._replays:
+            head = wire.replay_head(frames[0])
+            if head is not None:
+                self._on_replay(head, frames)
+                return
+        if self._deliver_locally and wire.origin(frames) == self._origin:
+            # already delivered when emitted
+            return
+        topic, data = wire.unpack(frames)
+        event_topic = topic
+        if topic.startswith(wire.FILTER_TOPIC):
+            parsed = wire.parse_filter_topic(topic)
+            if parsed is not None:
+                event_topic = parsed[0]
+        event = catalog.get_event(event_topic)
+        if event is None:
+            logger.warning("Dropping unknown event: %r" % topic)
+            return
+        content = self._decode(data)
+        if content is None:
+            return
+        deliveries = self._handle_event(event, content, topic)
+        if self._metrics is not None:
+            self._metrics.received(
+                event.label, len(data), deliveries,
+                emitted=wire.timestamp(frames))
+
+    def _decode(self, data):
+        """
+        Decode the content of a received event.
+
+        :param data: The encoded content.
+        :type data: str or memoryview
+
+        :return: The content of the event, or None if it could not be
+                 decoded.
+        :rtype: tuple
+        """
+        try:
+            if blobs.is_handle(data):
+                return self._blob_store().load(
+                    data, accept=self._accept_codecs)
+            return codecs.decode(data, accept=self._accept_codecs)
+        except CodecError as e:
+            logger.warning("Dropping event: %s" % e)
+            return None
+
+    def _blob_store(self):
+        """
+        Return the store of the blobs of large events.
+
+        :rtype: blobs.BlobStore
+        """
+        if self._blobs is None:
+            self._blobs = blobs.BlobStore(
+                os.path.join(self._config_prefix, blobs.DIRECTORY))
+        return self._blobs
+
+    def _handle_event(self, event, content, topic=None):
         """
         Handle an incoming event.
 
@@ -187,12 +1025,120 @@ class EventsClient(object):
         :type event: Event
         :param content: The content of the event.
         :type content: list
+        :param topic: The topic the event arrived under, or None if it was
+                      delivered locally.
+        :type topic: str
+
+        :return: The number of callbacks run.
+        :rtype: int
         """
         logger.debug("Handling event %s..." % event)
-        for uid in self._callbacks[event]:
-            callback = self._callbacks[event][uid]
+        # a snapshot, as callbacks may (un)register callbacks when run right
+        # away
+        callbacks = self._callbacks_for(event, content, topic)
+        for uid, callback in callbacks:
             logger.debug("Executing callback %s." % uid)
             self._run_callback(callback, event, content)
+        return len(callbacks)
+
+    def stats(self):
+        """
+        Return the traffic and latency metrics of the client.
+
+        :return: The metrics per event label, and the depth of the client's
+                 queues, or None if the client does not keep metrics.
+        :rtype: dict
+        """
+        if self._metrics is None:
+            return None
+        return self._metrics.snapshot(self._queue_depths())
+
+    def _queue_depths(self):
+        """
+        Return the number of items waiting in each of the client's queues.
+
+        :rtype: dict
+        """
+        depths = {'coalesced': len(self._coalesce_pending)}
+        if self._outbox is not None:
+            depths['outbox'] = len(self._outbox)
+            depths['outbox_dropped'] = self._outbox.dropped
+        if self._monitored:
+            depths['disconnects'] = self._disconnects
+        return depths
+
+    @property
+    def connected(self):
+        """
+        Whether the client is connected to the server, as far as it knows.
+
+        This is only tracked by clients with a heartbeat or an emit buffer.
+
+        :rtype: bool
+        """
+        return all(self._links.values())
+
+    def _socket_options(self, address):
+        """
+        Return the options of the socket that connects to an address.
+
+        :param address: The address.
+        :type address: str
+
+        :return: The options and their values.
+        :rtype: list of (int, int)
+        """
+        options = []
+        if address == self._emit_addr and self._outbox is not None:
+            # refuse messages while disconnected, instead of queueing them in
+            # zmq, so they wait in the bounded outbox
+            options.append((zmq.IMMEDIATE, 1))
+        if self._heartbeat is not None:
+            if zmq_capabilities().heartbeat:
+                interval = int(self._heartbeat * 1000)
+                timeout = interval * HEARTBEAT_MISSES
+                options.extend([
+                    (zmq.HEARTBEAT_IVL, interval),
+                    (zmq.HEARTBEAT_TIMEOUT, timeout),
+                    (zmq.HEARTBEAT_TTL, timeout)])
+            else:
+                logger.warning(
+                    "zmq has no heartbeats, a dead server will only be "
+                    "noticed when its connections are closed.")
+        return options
+
+    def _on_monitor_event(self, address, event):
+        """
+        Track whether the socket connected to an address is connected.
+
+        SUB sockets subscribe their topics again by themselves when they
+        reconnect, so only the events emitted meanwhile need care.
+
+        :param address: The address the socket connects to.
+        :type address: str
+        :param event: The socket event, as returned by
+                      parse_monitor_message().
+        :type event: dict
+        """
+        if event['event'] == zmq.EVENT_CONNECTED:
+            logger.debug("Connected to %s." % address)
+            self._links[address] = True
+            if address == self._emit_addr:
+                self._resume_emitting()
+        elif event['event'] == zmq.EVENT_DISCONNECTED:
+            logger.warning("Disconnected from %s." % address)
+            if self.connected:
+                self._disconnects += 1
+            self._links[address] = False
+            if address == self._reg_addr:
+                # a restarted server reports its subscriptions again
+                self._observed = None
+
+    def _resume_emitting(self):
+        """
+        Send the events buffered while the client was disconnected.
+        """
+        pass
 
     @abstractmethod
     def _run_callback(self, callback, event, content):
@@ -209,32 +1155,50 @@ class EventsClient(object):
         pass
 
     @abstractmethod
-    def _subscribe(self, tag):
+    def _subscribe(self, tag, priority=False):
         """
         Subscribe to a tag on the zmq SUB socket.
 
         :param tag: The tag to be subscribed.
         :type tag: str
+        :param priority: Whether to subscribe in the high priority lane.
+        :type priority: bool
         """
         pass
 
     @abstractmethod
-    def _unsubscribe(self, tag):
+    def _unsubscribe(self, tag, priority=False):
         """
         Unsubscribe from a tag on the zmq SUB socket.
 
         :param tag: The tag to be unsubscribed.
         :type tag: str
+        :param priority: Whether to unsubscribe in the high priority lane.
+        :type priority: bool
+        """
+        pass
+
+    @abstractmethod
+    def _send(self, frames, priority=False):
+        """
+        Send a message through PUSH socket.
+
+        :param frames: The frames of the message to be sent.
+        :type frames: list of str
+        :param priority: Whether to send it through the high priority lane.
+        :type priority: bool
         """
         pass
 
     @abstractmethod
-    def _send(self, data):
+    def _call_later(self, delay, function):
         """
-        Send data through PUSH socket.
+        Call a function in the client's event loop after a delay.
 
-        :param data: The data to be sent.
-        :type event: str
+        :param delay: The delay, in seconds.
+        :type delay: float
+        :param function: The function to be called.
+        :type function: callable
         """
         pass
 
@@ -253,22 +1217,44 @@ class EventsIOLoop(ioloop.ZMQIOLoop):
     in the queue before stopping.
     """
 
-    def stop(self, wait=False):
+    def stop(self, wait=False, timeout=None):
         """
         Stop the I/O loop.
 
+        This must be called from another thread than the loop's one.
+
         :param wait: Whether we should wait for callbacks in queue to finish
                      before stopping.
         :type wait: bool
+        :param timeout: The maximum time, in seconds, to wait for callbacks,
+                        or None to wait until they have all run.
+        :type timeout: float
+
+        :return: The number of callbacks left in the queue, which won't be
+                 run.
+        :rtype: int
         """
+        drained = None
         if wait:
-            # prevent new callbacks from being added
-            with self._callback_lock:
+            drained = threading.Event()
+            # prevent new callbacks from being added, and queue one that
+            # tells when the ones before it have run (tornado >= 4.5 dropped
+            # the callback lock, as add_callback() became lock-free)
+            lock = getattr(self, '_callback_lock', None)
+            if lock is not None:
+                with lock:
+                    self._closing = True
+                    self._callbacks.append(drained.set)
+            else:
                 self._closing = True
-            # wait until all callbacks have been executed
-            while self._callbacks:
-                time.sleep(0.1)
+                self._callbacks.append(drained.set)
+            self._waker.wake()
+            drained.wait(timeout)
         ioloop.ZMQIOLoop.stop(self)
+        dropped = len(self._callbacks)
+        if drained is not None and not drained.is_set():
+            dropped -= 1
+        return max(dropped, 0)
 
 
 class EventsClientThread(threading.Thread, EventsClient):
@@ -276,12 +1262,50 @@ class EventsClientThread(threading.Thread, EventsClient):
     A threaded version of the events client.
     """
 
-    def __init__(self, emit_addr, reg_addr, factory=None, enable_curve=True):
+    def __init__(self, emit_addr, reg_addr, factory=None, enable_curve=True,
+                 batch_size=None, batch_linger=None,
+                 codec=codecs.DEFAULT_CODEC, accept_codecs=None,
+                 legacy_wire=False, suppress_unobserved=False,
+                 compact_topics=False, executor=None,
+                 coalesce_window=None, deliver_locally=False,
+                 metrics=False, heartbeat=None, emit_buffer=None,
+                 emit_overflow=executors.DROP_OLDEST,
+                 priority_emit_addr=None, priority_reg_addr=None,
+                 zero_copy=True, blob_threshold=None):
         """
         Initialize the events client.
+
+        :param batch_size: If not None, emitted events are queued and the
+                           ioloop sends up to this many of them on each
+                           iteration, instead of scheduling one callback per
+                           event.
+        :type batch_size: int
+        :param batch_linger: The maximum time (in seconds) a queued event
+                             waits for a batch to fill up. If None, queued
+                             events are sent on the next ioloop iteration.
+        :type batch_linger: float
+        :param executor: The executor that runs callbacks. If None,
+                         callbacks are run in the client's ioloop.
+        :type executor: leap.common.events.executors.PoolExecutor or
+                        leap.common.events.executors.SerialExecutor
+        :param zero_copy: Whether to receive messages without copying them,
+                          and decode their content from the memory of the
+                          zmq frames.
+        :type zero_copy: bool
         """
         threading.Thread.__init__(self)
-        EventsClient.__init__(self, emit_addr, reg_addr)
+        EventsClient.__init__(
+            self, emit_addr, reg_addr, codec=codec,
+            accept_codecs=accept_codecs, legacy_wire=legacy_wire,
+            suppress_unobserved=suppress_unobserved,
+            compact_topics=compact_topics, coalesce_window=coalesce_window,
+            deliver_locally=deliver_locally, metrics=metrics,
+            heartbeat=heartbeat, emit_buffer=emit_buffer,
+            emit_overflow=emit_overflow,
+            priority_emit_addr=priority_emit_addr,
+            priority_reg_addr=priority_reg_addr,
+            blob_threshold=blob_threshold)
+        self._zero_copy = zero_copy
         self._lock = threading.Lock()
         self._initialized = threading.Event()
         self._config_prefix = os.path.join(
@@ -291,6 +1315,26 @@ class EventsClientThread(threading.Thread, EventsClient):
         self._context = None
         self._push = None
         self._sub = None
+        self._monitors = []
+        # the high priority lane. Its PUSH socket is not serviced by the
+        # ioloop, emitting threads send through it right away, in turns
+        self._priority_push = None
+        self._priority_sub = None
+        self._priority_lock = threading.Lock()
+        # emit batching
+        self._batch_size = batch_size
+        self._batch_linger = batch_linger
+        self._pending = collections.deque()
+        # whether a flush is scheduled, and whether it runs right away
+        # instead of after the linger timeout. Emitting threads and the
+        # ioloop both update them
+        self._flush_lock = threading.Lock()
+        self._flush_scheduled = False
+        self._flush_now = False
+        self._executor = executor
+        # until when queued messages may delay closing the sockets, set on
+        # shutdown
+        self._deadline = None
 
         if enable_curve:
             self.use_curve = zmq_has_curve()
@@ -306,6 +1350,13 @@ class EventsClientThread(threading.Thread, EventsClient):
         self._context = zmq.Context()
         # connect SUB first, otherwise we might miss some event sent from this
         # same client
+        if self._priority_reg_addr is not None:
+            self._priority_sub = self._zmq_connect(
+                zmq.SUB, self._priority_reg_addr)
+            self._priority_sub.on_recv(
+                self._on_recv, copy=not self._zero_copy)
+            self._priority_push = self._zmq_socket(
+                zmq.PUSH, self._priority_emit_addr)
         self._sub = self._zmq_connect_sub()
         self._push = self._zmq_connect_push()
 
@@ -321,21 +1372,41 @@ class EventsClientThread(threading.Thread, EventsClient):
         :return: A ZMQ connection stream.
         :rtype: ZMQStream
         """
+        return zmqstream.ZMQStream(
+            self._zmq_socket(socktype, address), self._loop)
+
+    def _zmq_socket(self, socktype, address):
+        """
+        Create a zmq socket and connect it to an address.
+
+        :param socktype: The ZMQ socket type.
+        :type socktype: int
+        :param address: The address to connect to.
+        :type address: str
+
+        :return: The connected socket.
+        :rtype: zmq.Socket
+        """
         logger.debug("Connecting %s to %s." % (socktype, address))
         socket = self._context.socket(socktype)
         # configure curve authentication
         if self.use_curve:
-            public, private = maybe_create_and_get_certificates(
-                self._config_prefix, "client")
-            server_public_file = os.path.join(
-                self._config_prefix, PUBLIC_KEYS_PREFIX, "server.key")
-            server_public, _ = zmq.auth.load_certificate(server_public_file)
+            keyring = get_keyring(self._config_prefix)
+            public, private = keyring.keypair("client")
             socket.curve_publickey = public
             socket.curve_secretkey = private
-            socket.curve_serverkey = server_public
-        stream = zmqstream.ZMQStream(socket, self._loop)
+            socket.curve_serverkey = keyring.public_key("server")
+        for option, value in self._socket_options(address):
+            socket.setsockopt(option, value)
+        if self._monitored and address in self._links:
+            # before connecting, so no event is missed
+            monitor = zmqstream.ZMQStream(
+                socket.get_monitor_socket(MONITOR_EVENTS), self._loop)
+            monitor.on_recv(lambda message: self._on_monitor_event(
+                address, parse_monitor_message(message)))
+            self._monitors.append(monitor)
         socket.connect(address)
-        return stream
+        return socket
 
     def _zmq_connect_push(self):
         """
@@ -354,48 +1425,240 @@ class EventsClientThread(threading.Thread, EventsClient):
         :rtype: ZMQStream
         """
         stream = self._zmq_connect(zmq.SUB, self._reg_addr)
-        stream.on_recv(self._on_recv)
+        if self._priority_sub is not None:
+            stream.on_recv(self._on_normal_message, copy=not self._zero_copy)
+        else:
+            stream.on_recv(self._on_recv, copy=not self._zero_copy)
+        if self._suppress_unobserved:
+            stream.socket.setsockopt(
+                zmq.SUBSCRIBE, wire.SUBSCRIPTIONS_TOPIC)
         return stream
 
-    def _on_recv(self, msg):
+    def _on_normal_message(self, frames):
         """
-        Handle an incoming message in the SUB socket.
+        Handle a message of the normal lane, after the messages waiting in
+        the high priority lane.
 
-        :param msg: The received message.
-        :type msg: str
+        :param frames: The frames of the received message.
+        :type frames: list of str or list of zmq.Frame
         """
-        ev_str, content_pickle = msg[0].split(b'\0', 1)  # undo txzmq tagging
-        event = getattr(catalog, ev_str)
-        content = pickle.loads(content_pickle)
-        self._handle_event(event, content)
+        socket = self._priority_sub.socket
+        while True:
+            try:
+                priority_frames = socket.recv_multipart(
+                    zmq.NOBLOCK, copy=not self._zero_copy)
+            except zmq.Again:
+                break
+            self._on_recv(priority_frames)
+        self._on_recv(frames)
+
+    def _on_recv(self, frames):
+        """
+        Handle a message received in a SUB socket.
+
+        Without copying, the frames arrive as zmq.Frame objects. The topic
+        and the small trailing frames are copied out of them, but the
+        content is decoded from a view of the memory of its frame.
 
-    def _subscribe(self, tag):
+        :param frames: The frames of the received message.
+        :type frames: list of str or list of zmq.Frame
+        """
+        if not self._zero_copy:
+            self._on_message(frames)
+            return
+        topic = frames[0].bytes
+        if len(frames) < 2 or topic == wire.SUBSCRIPTIONS_TOPIC:
+            # legacy and subscription messages have no separate content
+            self._on_message([frame.bytes for frame in frames])
+            return
+        self._on_message(
+            [topic, frames[1].buffer] + [frame.bytes for frame in frames[2:]])
+
+    def _subscribe(self, tag, priority=False):
         """
         Subscribe from a tag on the zmq SUB socket.
 
         :param tag: The tag to be subscribed.
         :type tag: str
+        :param priority: Whether to subscribe in the high priority lane.
+        :type priority: bool
         """
-        self._sub.socket.setsockopt(zmq.SUBSCRIBE, tag)
+        sub = self._priority_sub if priority else self._sub
+        # zmq sockets are not thread safe, so let the ioloop thread do it
+        self._loop.add_callback(sub.socket.setsockopt, zmq.SUBSCRIBE, tag)
 
-    def _unsubscribe(self, tag):
+    def _unsubscribe(self, tag, priority=False):
         """
         Unsubscribe from a tag on the zmq SUB socket.
 
         :param tag: The tag to be unsubscribed.
         :type tag: str
+        :param priority: Whether to unsubscribe in the high priority lane.
+        :type priority: bool
+        """
+        sub = self._priority_sub if priority else self._sub
+        # zmq sockets are not thread safe, so let the ioloop thread do it
+        self._loop.add_callback(sub.socket.setsockopt, zmq.UNSUBSCRIBE, tag)
+
+    def _send(self, frames, priority=False):
+        """
+        Send a message through PUSH socket.
+
+        :param frames: The frames of the message to be sent.
+        :type frames: list of str
+        :param priority: Whether to send it through the high priority lane.
+        :type priority: bool
+        """
+        if priority:
+            self._send_priority(frames)
+            return
+        if self._outbox is not None:
+            # emitting from the ioloop thread must not wait for it to make
+            # room in the outbox
+            force = (self._outbox.overflow == executors.BLOCK
+                     and threading.current_thread() is self)
+            if not self._outbox.put(frames, force=force):
+                return
+            queued = len(self._outbox)
+        elif self._batch_size is None:
+            # add send() as a callback for ioloop so it works between threads
+            self._loop.add_callback(lambda: self._push.send_multipart(frames))
+            return
+        else:
+            # deque.append() is atomic, so emitting threads never block here
+            self._pending.append(frames)
+            queued = len(self._pending)
+        # once the batch is full, do not wait for the linger timeout
+        full = self._batch_size is not None and queued >= self._batch_size
+        self._schedule_flush(now=full or not self._batch_linger)
+
+    def _schedule_flush(self, now=True, delay=None):
+        """
+        Schedule a flush of the queued events, unless one that runs as soon
+        is already scheduled.
+
+        :param now: Whether to flush in the next ioloop iteration.
+        :type now: bool
+        :param delay: If not now, the delay, in seconds, or None for the
+                      linger timeout.
+        :type delay: float
+        """
+        with self._flush_lock:
+            if self._flush_now or (self._flush_scheduled and not now):
+                return
+            self._flush_scheduled = True
+            self._flush_now = now
+        if now:
+            self._loop.add_callback(self._flush)
+        else:
+            if delay is None:
+                delay = self._batch_linger
+            self._loop.add_callback(self._loop.call_later, delay, self._flush)
+
+    def _send_priority(self, frames):
+        """
+        Send a message through the high priority PUSH socket, right away, so
+        it doesn't wait behind the messages and callbacks queued in the
+        ioloop.
+
+        :param frames: The frames of the message to be sent.
+        :type frames: list of str
+        """
+        with self._priority_lock:
+            if self._priority_push is None:
+                # already shut down
+                return
+            try:
+                self._priority_push.send_multipart(frames, zmq.NOBLOCK)
+            except zmq.Again:
+                logger.warning(
+                    "Dropping high priority event, too many of them are "
+                    "waiting for the server.")
+
+    def _call_later(self, delay, function):
+        """
+        Call a function in the client's ioloop after a delay.
+
+        :param delay: The delay, in seconds.
+        :type delay: float
+        :param function: The function to be called.
+        :type function: callable
+        """
+        self._loop.add_callback(self._loop.call_later, delay, function)
+
+    def _flush(self, drain=False):
         """
-        self._sub.socket.setsockopt(zmq.UNSUBSCRIBE, tag)
+        Send up to one batch of queued events through the PUSH socket.
+
+        This must be called from the ioloop thread.
 
-    def _send(self, data):
+        :param drain: Whether to send all queued events at once.
+        :type drain: bool
+        """
+        with self._flush_lock:
+            self._flush_scheduled = self._flush_now = False
+        if self._outbox is not None:
+            self._flush_outbox(drain)
+            return
+        socket = self._push.socket
+        limit = len(self._pending) if drain else self._batch_size
+        for _ in range(limit):
+            try:
+                frames = self._pending.popleft()
+            except IndexError:
+                return
+            if self._push.sending():
+                # keep ordering with messages already queued in the stream
+                self._push.send_multipart(frames)
+                continue
+            try:
+                socket.send_multipart(frames, zmq.NOBLOCK)
+            except zmq.Again:
+                # high-water mark reached, let the stream wait for POLLOUT
+                self._push.send_multipart(frames)
+        if self._pending:
+            # leave the rest for the next iteration so we don't starve I/O
+            self._schedule_flush()
+
+    def _flush_outbox(self, drain=False):
+        """
+        Send up to one batch of the events in the outbox through the PUSH
+        socket, while the socket has room for them.
+
+        This must be called from the ioloop thread.
+
+        :param drain: Whether to send all the events at once.
+        :type drain: bool
+        """
+        if not self._links[self._emit_addr]:
+            # sent once connected to the server again
+            return
+        socket = self._push.socket
+        limit = len(self._outbox)
+        if not drain and self._batch_size is not None:
+            limit = min(limit, self._batch_size)
+        for _ in range(limit):
+            frames = self._outbox.get(timeout=0)
+            if frames is None:
+                return
+            try:
+                socket.send_multipart(frames, zmq.NOBLOCK)
+            except zmq.Again:
+                # no room yet, keep it first in line and try again later
+                self._outbox.put(frames, force=True, front=True)
+                self._schedule_flush(now=False, delay=EMIT_RETRY_DELAY)
+                return
+        if len(self._outbox):
+            self._schedule_flush()
+
+    def _resume_emitting(self):
         """
-        Send data through PUSH socket.
+        Send the events buffered while the client was disconnected.
 
-        :param data: The data to be sent.
-        :type event: str
+        This is called from the ioloop thread.
         """
-        # add send() as a callback for ioloop so it works between threads
-        self._loop.add_callback(lambda: self._push.send(data))
+        if self._outbox is not None and not self._flush_scheduled:
+            self._flush()
 
     def _run_callback(self, callback, event, content):
         """
@@ -408,14 +1671,50 @@ class EventsClientThread(threading.Thread, EventsClient):
         :param content: The content of the event.
         :type content: list
         """
+        if self._executor is not None:
+            # the event is the ordering key, so a SerialExecutor runs the
+            # callbacks of each event in order. The ioloop thread must not
+            # wait for the executor to make room, or it would stop
+            # servicing the sockets
+            if threading.current_thread() is self:
+                submit = self._executor.submit_nowait
+            else:
+                submit = self._executor.submit
+            submit(event, callback, event, *content)
+            return
+        if (self._on_priority_lane(event)
+                and threading.current_thread() is self):
+            # don't queue it behind the callbacks of other events
+            try:
+                callback(event, *content)
+            except Exception:
+                logger.exception("Error running event callback.")
+            return
         self._loop.add_callback(lambda: callback(event, *content))
 
-    def register(self, event, callback, uid=None, replace=False):
+    def _queue_depths(self):
+        """
+        Return the number of items waiting in each of the client's queues.
+
+        :rtype: dict
+        """
+        depths = EventsClient._queue_depths(self)
+        depths['batched'] = len(self._pending)
+        if self._loop is not None:
+            depths['ioloop'] = len(getattr(self._loop, '_callbacks', ()))
+        if self._executor is not None:
+            depths['executor'] = self._executor.depth
+            depths['executor_dropped'] = self._executor.dropped
+        return depths
+
+    def register(self, event, callback, uid=None, replace=False,
+                 replay=None, key=None, where=None):
         """
         Register a callback to be executed when an event is received.
 
-        :param event: The event that triggers the callback.
-        :type event: Event
+        :param event: The event that triggers the callback, or a wildcard
+                      matching all the events that trigger it.
+        :type event: Event or Prefix
         :param callback: The callback to be executed.
         :type callback: callable(event, *content)
         :param uid: The callback uid.
@@ -423,6 +1722,15 @@ class EventsClientThread(threading.Thread, EventsClient):
         :param replace: Wether an eventual callback with same ID should be
                         replaced.
         :type replace: bool
+        :param replay: The kind of replay of kept events, 'recent' or
+                       'last', see EventsClient.register().
+        :type replay: str
+        :param key: If not None, only run the callback for events about this
+                    key, see EventsClient.register().
+        :type key: hashable
+        :param where: If not None, the values the content of an event must
+                      have, by position, see EventsClient.register().
+        :type where: dict
 
         :return: The callback uid.
         :rtype: str
@@ -432,7 +1740,8 @@ class EventsClientThread(threading.Thread, EventsClient):
         """
         self.ensure_client()
         return EventsClient.register(
-            self, event, callback, uid=uid, replace=replace)
+            self, event, callback, uid=uid, replace=replace, replay=replay,
+            key=key, where=where)
 
     def unregister(self, event, uid=None):
         """
@@ -461,6 +1770,26 @@ class EventsClientThread(threading.Thread, EventsClient):
         self.ensure_client()
         EventsClient.emit(self, event, *content)
 
+    @classmethod
+    def _create_instance(cls):
+        """
+        Create a new client instance using the module configuration.
+        """
+        return cls(
+            _emit_addr, _reg_addr, factory=_factory,
+            enable_curve=_enable_curve, batch_size=_batch_size,
+            batch_linger=_batch_linger, codec=_codec,
+            accept_codecs=_accept_codecs, legacy_wire=_legacy_wire,
+            suppress_unobserved=_suppress_unobserved,
+            compact_topics=_compact_topics, executor=_executor,
+            coalesce_window=_coalesce_window,
+            deliver_locally=_deliver_locally, metrics=_metrics,
+            heartbeat=_heartbeat, emit_buffer=_emit_buffer,
+            emit_overflow=_emit_overflow,
+            priority_emit_addr=_priority_emit_addr,
+            priority_reg_addr=_priority_reg_addr,
+            blob_threshold=_blob_threshold)
+
     def run(self):
         """
         Run the events client.
@@ -469,9 +1798,43 @@ class EventsClientThread(threading.Thread, EventsClient):
         self._init_zmq()
         self._initialized.set()
         self._loop.start()
+        self._close_zmq()
         self._loop.close()
         logger.debug("Ioloop finished.")
 
+    def _close_zmq(self):
+        """
+        Close ZMQ connections once the ioloop has stopped.
+
+        Messages still queued are given until the deadline set by shutdown()
+        to reach the server.
+        """
+        # hand the messages queued in the stream (e.g. while the high-water
+        # mark was reached) over to the socket, without blocking
+        self._push.flush(zmq.POLLOUT)
+        if self._outbox is not None and len(self._outbox):
+            # the server was unreachable until the end
+            logger.warning("Dropped %d buffered events on shutdown."
+                           % self._outbox.clear())
+        if self._monitors:
+            self._push.socket.disable_monitor()
+            self._sub.socket.disable_monitor()
+            for monitor in self._monitors:
+                monitor.close(linger=0)
+        remaining = _remaining(self._deadline)
+        linger = -1
+        if remaining is not None:
+            linger = int(remaining * 1000)
+        self._push.close(linger=linger)
+        self._sub.close(linger=0)
+        if self._priority_sub is not None:
+            self._priority_sub.close(linger=0)
+            with self._priority_lock:
+                self._priority_push.close(linger=linger)
+                self._priority_push = None
+        # returns once queued messages are sent, or the linger time is over
+        self._context.term()
+
     def ensure_client(self):
         """
         Make sure the events client thread is started.
@@ -482,30 +1845,80 @@ class EventsClientThread(threading.Thread, EventsClient):
                 self.start()
                 self._initialized.wait()
 
-    def shutdown(self):
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
         """
         Shutdown the events client thread.
+
+        Held back and batched events are sent, and callbacks already queued
+        are run, before the ioloop stops. Messages not yet sent then have
+        whatever is left of the timeout to reach the server.
+
+        :param timeout: The maximum time, in seconds, the shutdown may take,
+                        or None to wait for all callbacks and messages.
+        :type timeout: float
+
+        :return: The number of queued callbacks that were dropped.
+        :rtype: int
         """
         logger.debug("Shutting down client...")
+        dropped = 0
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
         with self._lock:
             if self.is_alive():
-                self._loop.stop(wait=True)
+                self._flush_coalesced(force=True)
+                if self._pending or (
+                        self._outbox is not None and len(self._outbox)):
+                    self._loop.add_callback(self._flush, True)
+                self._deadline = deadline
+                dropped = self._loop.stop(wait=True, timeout=timeout)
+                self.join(_remaining(deadline))
+        if dropped:
+            logger.warning("Dropped %d callbacks on shutdown." % dropped)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
         EventsClient.shutdown(self)
+        return dropped
 
 
-def shutdown():
+def _remaining(deadline):
+    """
+    Return the time left until a deadline.
+
+    :param deadline: The deadline, in seconds since the epoch, or None.
+    :type deadline: float
+
+    :return: The time left, in seconds, or None if there is no deadline.
+    :rtype: float
+    """
+    if deadline is None:
+        return None
+    return max(deadline - time.time(), 0)
+
+
+def shutdown(timeout=SHUTDOWN_TIMEOUT):
     """
     Shutdown the events client thread.
+
+    :param timeout: The maximum time, in seconds, the shutdown may take,
+                    or None to wait for all callbacks and messages.
+    :type timeout: float
+
+    :return: The number of queued callbacks that were dropped.
+    :rtype: int
     """
-    EventsClientThread.instance().shutdown()
+    return EventsClientThread.instance().shutdown(timeout=timeout)
 
 
-def register(event, callback, uid=None, replace=False):
+def register(event, callback, uid=None, replace=False, replay=None,
+             key=None, where=None):
     """
     Register a callback to be executed when an event is received.
 
-    :param event: The event that triggers the callback.
-    :type event: str
+    :param event: The event that triggers the callback, or a wildcard
+                  matching all the events that trigger it.
+    :type event: Event or Prefix
     :param callback: The callback to be executed.
     :type callback: callable(event, content)
     :param uid: The callback uid.
@@ -513,6 +1926,15 @@ def register(event, callback, uid=None, replace=False):
     :param replace: Wether an eventual callback with same ID should be
                     replaced.
     :type replace: bool
+    :param replay: The kind of replay of the events kept by the server,
+                   'recent' or 'last', or None for no replay.
+    :type replay: str
+    :param key: If not None, only run the callback for events about this
+                key, usually the uuid or userid of an account.
+    :type key: hashable
+    :param where: If not None, the values the content of an event must have,
+                  by position, for the callback to be run.
+    :type where: dict
 
     :return: The callback uid.
     :rtype: str
@@ -521,7 +1943,8 @@ def register(event, callback, uid=None, replace=False):
             identified by the given uid and replace is False.
     """
     return EventsClientThread.instance().register(
-        event, callback, uid=uid, replace=replace)
+        event, callback, uid=uid, replace=replace, replay=replay, key=key,
+        where=where)
 
 
 def unregister(event, uid=None):
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+# codec.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Wire codecs for the content of events.
+
+Every encoded payload starts with a one byte tag that identifies the codec
+used to encode it, so clients configured with different codecs can still
+understand each other.
+
+The pickle codec uses pickle protocol 2, whose streams always start with the
+'\\x80' opcode. That opcode doubles as the codec tag, so payloads encoded
+with it can still be loaded by clients that predate codec tags. Payloads
+sent by those older clients (pickle protocol 0, starting with '(') are also
+recognized.
+
+Payloads may be decoded from memoryviews of received zmq frames, without
+copying them, by the codecs whose loads function takes buffers.
+"""
+import json
+import marshal
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# msgpack is optional
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from leap.common.events.errors import CodecError
+
+
+PICKLE = "pickle"
+JSON = "json"
+MARSHAL = "marshal"
+MSGPACK = "msgpack"
+
+DEFAULT_CODEC = PICKLE
+
+
+class Codec(object):
+    """
+    A codec for the content of events.
+    """
+
+    def __init__(self, name, tag, dumps, loads, safe=False, aliases=(),
+                 buffers=False):
+        """
+        Initialize the codec.
+
+        :param name: The name of the codec.
+        :type name: str
+        :param tag: The one byte tag that prefixes encoded payloads.
+        :type tag: str
+        :param dumps: A function that serializes a content tuple.
+        :type dumps: callable(tuple) -> str
+        :param loads: A function that deserializes a content tuple.
+        :type loads: callable(str) -> tuple
+        :param safe: Whether it is safe to decode untrusted payloads.
+        :type safe: bool
+        :param aliases: Other tags that identify payloads of this codec.
+        :type aliases: tuple of str
+        :param buffers: Whether loads takes buffers, like memoryviews, so
+                        payloads are decoded without copying them.
+        :type buffers: bool
+        """
+        self.name = name
+        self.tag = tag
+        self.safe = safe
+        self.aliases = aliases
+        self.buffers = buffers
+        self._dumps = dumps
+        self._loads = loads
+
+    def encode(self, content):
+        """
+        Encode the content of an event, including the codec tag.
+
+        :param content: The content of the event.
+        :type content: tuple
+
+        :return: The encoded payload.
+        :rtype: str
+        """
+        return self.tag + self._dumps(content)
+
+    def decode(self, data):
+        """
+        Decode a payload, including the codec tag.
+
+        :param data: The encoded payload.
+        :type data: str or memoryview
+
+        :return: The content of the event.
+        :rtype: tuple
+        """
+        data = data[1:]
+        if not self.buffers:
+            data = to_bytes(data)
+        return tuple(self._loads(data))
+
+    def __repr__(self):
+        return '<Codec: %s>' % self.name
+
+
+class _PickleCodec(Codec):
+    """
+    A pickle codec whose tag is part of the pickle stream itself.
+    """
+
+    def encode(self, content):
+        return pickle.dumps(content, 2)
+
+    def decode(self, data):
+        if not self.buffers:
+            data = to_bytes(data)
+        return pickle.loads(data)
+
+
+def to_bytes(data):
+    """
+    Return the bytes of a payload, copying them out of a buffer if needed.
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return bytes(data)
+
+
+def _loads_buffers(loads, payload):
+    """
+    Return whether a loads function takes memoryviews, which depends on the
+    python version.
+
+    :param loads: The loads function.
+    :type loads: callable
+    :param payload: A payload it can load.
+    :type payload: str
+
+    :rtype: bool
+    """
+    try:
+        loads(memoryview(payload))
+    except Exception:
+        return False
+    return True
+
+
+def _json_dumps(content):
+    """
+    Serialize a content tuple to JSON, as bytes in every python version.
+    """
+    return json.dumps(content, separators=(',', ':')).encode('utf-8')
+
+
+def _json_loads(data):
+    """
+    Deserialize a content tuple from the JSON bytes of _json_dumps.
+    """
+    return json.loads(data.decode('utf-8'))
+
+
+_codecs = {}
+_codecs_by_tag = {}
+
+
+def register_codec(codec):
+    """
+    Register a codec.
+
+    :param codec: The codec to be registered.
+    :type codec: Codec
+
+    :raises CodecError: if the name or the tag is already in use.
+    """
+    tags = (codec.tag,) + tuple(codec.aliases)
+    if codec.name in _codecs:
+        raise CodecError("Codec name already in use: %s" % codec.name)
+    for tag in tags:
+        if len(tag) != 1:
+            raise CodecError("Codec tags must have exactly one byte.")
+        if tag in _codecs_by_tag:
+            raise CodecError("Codec tag already in use: %r" % tag)
+    _codecs[codec.name] = codec
+    for tag in tags:
+        _codecs_by_tag[tag] = codec
+
+
+def get_codec(name):
+    """
+    Return a registered codec.
+
+    :param name: The name of the codec.
+    :type name: str
+
+    :rtype: Codec
+
+    :raises CodecError: if there is no codec with that name.
+    """
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise CodecError("Unknown codec: %s" % name)
+
+
+def available_codecs():
+    """
+    Return the names of all registered codecs.
+
+    :rtype: list of str
+    """
+    return sorted(_codecs)
+
+
+def safe_codecs():
+    """
+    Return the names of the registered codecs that are safe to decode
+    payloads from untrusted peers, to be used as an accept set.
+
+    :rtype: frozenset of str
+    """
+    return frozenset(name for name, codec in _codecs.items() if codec.safe)
+
+
+def encode(content, codec=DEFAULT_CODEC):
+    """
+    Encode the content of an event.
+
+    :param content: The content of the event.
+    :type content: tuple
+    :param codec: The name of the codec to be used.
+    :type codec: str
+
+    :return: The encoded payload.
+    :rtype: str
+    """
+    return get_codec(codec).encode(content)
+
+
+def decode(data, accept=None):
+    """
+    Decode the content of an event, using the codec identified by its tag.
+
+    :param data: The encoded payload.
+    :type data: str or memoryview
+    :param accept: The names of the codecs that may be used to decode the
+                   payload, or None to accept any registered codec. Use
+                   safe_codecs() for payloads from untrusted peers.
+    :type accept: set of str
+
+    :return: The content of the event.
+    :rtype: tuple
+
+    :raises CodecError: if the codec is unknown or not accepted.
+    """
+    tag = to_bytes(data[:1])
+    codec = _codecs_by_tag.get(tag)
+    if codec is None:
+        raise CodecError("Unknown codec tag: %r" % tag)
+    if accept is not None and codec.name not in accept:
+        raise CodecError("Codec not accepted: %s" % codec.name)
+    return codec.decode(data)
+
+
+register_codec(_PickleCodec(
+    PICKLE, b'\x80', None, None, aliases=(b'(',),
+    buffers=_loads_buffers(pickle.loads, pickle.dumps((), 2))))
+register_codec(Codec(
+    JSON, b'J', _json_dumps, _json_loads, safe=True))
+register_codec(Codec(
+    MARSHAL, b'M', lambda c: marshal.dumps(c, 2), marshal.loads,
+    buffers=_loads_buffers(marshal.loads, marshal.dumps((), 2))))
+if msgpack is not None:
+    register_codec(Codec(
+        MSGPACK, b'K', msgpack.packb,
+        lambda d: msgpack.unpackb(d, use_list=False), safe=True,
+        buffers=_loads_buffers(msgpack.unpackb, msgpack.packb(()))))
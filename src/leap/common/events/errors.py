@@ -21,3 +21,39 @@ class CallbackAlreadyRegisteredError(Exception):
     Raised when trying to register an already registered callback.
     """
     pass
+
+
+class CodecError(Exception):
+    """
+    Raised when an event payload can't be encoded or decoded.
+    """
+    pass
+
+
+class RpcError(Exception):
+    """
+    Raised when a remote call fails, e.g. because the responder raised an
+    error.
+    """
+    pass
+
+
+class RpcTimeoutError(RpcError):
+    """
+    Raised when a remote call is not answered in time.
+    """
+    pass
+
+
+class NoResponderError(RpcError):
+    """
+    Raised when nobody responds to the called event.
+    """
+    pass
+
+
+class ResponderBusyError(RpcError):
+    """
+    Raised when the responder has too many calls waiting to be answered.
+    """
+    pass
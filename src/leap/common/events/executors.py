@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+# executors.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Executors for the callbacks of the threaded events client.
+
+By default the threaded client runs callbacks in the same ioloop that
+services its sockets, so one slow callback delays every other event. An
+executor moves callbacks to worker threads, with a bounded queue and an
+overflow policy for when callbacks arrive faster than they are run.
+"""
+import collections
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+
+# overflow policies
+BLOCK = "block"
+DROP_NEWEST = "drop-newest"
+DROP_OLDEST = "drop-oldest"
+
+OVERFLOW_POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+
+
+class BoundedQueue(object):
+    """
+    A thread safe FIFO queue with a maximum size and an overflow policy.
+    """
+
+    def __init__(self, maxsize, overflow=BLOCK):
+        """
+        Initialize the queue.
+
+        :param maxsize: The maximum number of items in the queue.
+        :type maxsize: int
+        :param overflow: What to do when putting an item in a full queue:
+                         wait for room (BLOCK), discard the new item
+                         (DROP_NEWEST) or discard the oldest queued item
+                         (DROP_OLDEST).
+        :type overflow: str
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item, force=False, front=False):
+        """
+        Put an item in the queue, applying the overflow policy if it is full.
+
+        :param item: The item.
+        :param force: Whether to queue the item even if the queue is full.
+        :type force: bool
+        :param front: Whether to put the item at the front of the queue.
+        :type front: bool
+
+        :return: Whether the item was queued.
+        :rtype: bool
+        """
+        with self._lock:
+            if not force and len(self._items) >= self.maxsize:
+                if self.overflow == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif self.overflow == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._items) >= self.maxsize:
+                        self._not_full.wait()
+            if front:
+                self._items.appendleft(item)
+            else:
+                self._items.append(item)
+            self._not_empty.notify()
+            return True
+
+    def get(self, timeout=None):
+        """
+        Remove and return the oldest item, waiting for one if needed.
+
+        :param timeout: How long to wait for an item, or None to wait
+                        forever.
+        :type timeout: float
+
+        :return: The item, or None if the timeout expired.
+        """
+        with self._lock:
+            if not self._items and timeout != 0:
+                self._not_empty.wait(timeout)
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._not_full.notify()
+            return item
+
+    def clear(self):
+        """
+        Remove all items from the queue.
+
+        :return: The number of removed items.
+        :rtype: int
+        """
+        with self._lock:
+            count = len(self._items)
+            self._items.clear()
+            self._not_full.notify_all()
+            return count
+
+
+_STOP = object()
+
+
+class _Worker(threading.Thread):
+    """
+    A thread that runs the callbacks from a queue.
+    """
+
+    def __init__(self, queue, name):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self._queue = queue
+
+    def run(self):
+        while True:
+            # wake up periodically, python 2 can't interrupt untimed waits
+            task = self._queue.get(timeout=1)
+            if task is None:
+                continue
+            if task is _STOP:
+                return
+            callback, args = task
+            try:
+                callback(*args)
+            except Exception:
+                logger.exception("Error running event callback.")
+
+
+class _BaseExecutor(object):
+    """
+    Common code for executors backed by worker threads with their own
+    queues.
+    """
+
+    def __init__(self, workers, max_queue, overflow):
+        """
+        Initialize the executor. Worker threads are started on the first
+        submitted callback.
+
+        :param workers: The number of worker threads.
+        :type workers: int
+        :param max_queue: The maximum number of callbacks waiting to be run
+                          by each worker.
+        :type max_queue: int
+        :param overflow: The overflow policy of the queues, see
+                         BoundedQueue.
+        :type overflow: str
+        """
+        self._queues = [BoundedQueue(max_queue, overflow)
+                        for _ in range(workers)]
+        self._workers = []
+        self._lock = threading.Lock()
+
+    @property
+    def depth(self):
+        """
+        The number of callbacks waiting to be run.
+
+        :rtype: int
+        """
+        return sum(len(queue) for queue in self._queues)
+
+    @property
+    def dropped(self):
+        """
+        The number of callbacks dropped because of full queues.
+
+        :rtype: int
+        """
+        return sum(queue.dropped for queue in self._queues)
+
+    @property
+    def overflow(self):
+        """
+        The overflow policy of the queues.
+
+        :rtype: str
+        """
+        return self._queues[0].overflow
+
+    def _ensure_started(self):
+        with self._lock:
+            if not self._workers:
+                name = self.__class__.__name__
+                self._workers = [
+                    _Worker(queue, "%s-%d" % (name, i))
+                    for i, queue in enumerate(self._queues)]
+                for worker in self._workers:
+                    worker.start()
+
+    def _queue_for(self, key):
+        raise NotImplementedError(self)
+
+    def submit(self, key, callback, *args):
+        """
+        Schedule a callback to be run.
+
+        :param key: The key that identifies the callback's ordering domain,
+                    usually its event.
+        :param callback: The callback.
+        :type callback: callable
+        :param args: The callback arguments.
+
+        :return: Whether the callback was scheduled.
+        :rtype: bool
+        """
+        if not self._workers:
+            self._ensure_started()
+        return self._queue_for(key).put((callback, args))
+
+    def submit_nowait(self, key, callback, *args):
+        """
+        Schedule a callback to be run, without ever waiting for room in a
+        full queue: with the BLOCK overflow policy the callback is queued
+        anyway, with the other policies it is applied as usual.
+
+        Threads that must stay responsive, like the ioloop of the threaded
+        client, submit callbacks this way.
+
+        :param key: The key that identifies the callback's ordering domain,
+                    usually its event.
+        :param callback: The callback.
+        :type callback: callable
+        :param args: The callback arguments.
+
+        :return: Whether the callback was scheduled.
+        :rtype: bool
+        """
+        if not self._workers:
+            self._ensure_started()
+        queue = self._queue_for(key)
+        return queue.put((callback, args), force=queue.overflow == BLOCK)
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads once they have run the queued callbacks.
+
+        The executor may be used again afterwards, new workers will be
+        started.
+
+        :param wait: Whether to wait for the workers to finish.
+        :type wait: bool
+        """
+        with self._lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            # when waiting, stop only after the queued callbacks have run
+            worker._queue.put(_STOP, force=True, front=not wait)
+        if wait:
+            for worker in workers:
+                if worker is not threading.current_thread():
+                    worker.join()
+
+
+class PoolExecutor(_BaseExecutor):
+    """
+    Run callbacks in a pool of worker threads, in no particular order.
+
+    When the queue is full, the oldest callback waiting in it is dropped by
+    default, so submitting never waits for a slow callback.
+    """
+
+    def __init__(self, workers=4, max_queue=1000, overflow=DROP_OLDEST):
+        _BaseExecutor.__init__(self, 1, max_queue, overflow)
+        # all workers share a single queue
+        self._queues = self._queues * workers
+
+    @property
+    def depth(self):
+        return len(self._queues[0])
+
+    @property
+    def dropped(self):
+        return self._queues[0].dropped
+
+    def _queue_for(self, key):
+        return self._queues[0]
+
+
+class SerialExecutor(_BaseExecutor):
+    """
+    Run callbacks in worker threads, preserving the order of the callbacks
+    of each event.
+
+    Every event is always handled by the same worker, so callbacks of
+    different events may run concurrently while callbacks of the same event
+    run one after the other, in the order they were submitted.
+
+    As with PoolExecutor, the oldest callback waiting in a full queue is
+    dropped by default.
+    """
+
+    def __init__(self, workers=4, max_queue=1000, overflow=DROP_OLDEST):
+        _BaseExecutor.__init__(self, workers, max_queue, overflow)
+
+    def _queue_for(self, key):
+        return self._queues[hash(key) % len(self._queues)]
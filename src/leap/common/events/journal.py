@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+# journal.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+An append-only journal of the messages relayed by the events server.
+
+The journal is a directory of segments, each one a pair of files: a log with
+the records and an index with one entry per record. Records are appended in
+the order the server relays them, with their frames as they were received,
+and written in batches. A segment is closed when its log reaches the
+segment size, and a new one is started every time the journal is opened.
+
+A record in the log is a header, with the size of the whole record, the time
+it was relayed, the id of its event and its number of frames, followed by
+each frame prefixed by its length. An entry in the index has the time, the
+event id and the offset of a record in the log, so queries by time and event
+only read the index, and then the matching records.
+
+>>> reader = JournalReader('/var/log/leap/events')
+>>> for record in reader.read(since=time.time() - 3600,
+...                           events=[catalog.SOLEDAD_DONE_DATA_SYNC]):
+...     print record.timestamp, record.event, record.content()
+"""
+import bisect
+import collections
+import errno
+import glob
+import logging
+import mmap
+import os
+import struct
+import time
+
+from leap.common.events import catalog
+from leap.common.events import codec as codecs
+from leap.common.events import wire
+
+
+logger = logging.getLogger(__name__)
+
+
+# the maximum size, in bytes, of the log of a segment
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+# how many bytes of records are kept in memory before writing them
+BATCH_BYTES = 256 * 1024
+
+# how often, in seconds, the server writes the records kept in memory
+FLUSH_INTERVAL = 1.0
+
+
+_LOG_SUFFIX = '.log'
+_INDEX_SUFFIX = '.idx'
+
+# size, timestamp, event id and number of frames
+_RECORD = struct.Struct('>IdIH')
+_FRAME = struct.Struct('>I')
+# timestamp, event id and offset
+_ENTRY = struct.Struct('>dIQ')
+
+
+def _segment_path(directory, number, suffix):
+    return os.path.join(directory, '%020d%s' % (number, suffix))
+
+
+def _segment_numbers(directory):
+    """
+    Return the numbers of the segments in a journal directory, in order.
+
+    :rtype: list of int
+    """
+    paths = glob.glob(os.path.join(directory, '*' + _LOG_SUFFIX))
+    names = (os.path.basename(path)[:-len(_LOG_SUFFIX)] for path in paths)
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+class Journal(object):
+    """
+    Appends relayed messages to the segments of a journal directory.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE,
+                 batch_bytes=BATCH_BYTES):
+        """
+        Initialize the journal, starting a new segment.
+
+        :param directory: The directory of the journal, created if needed.
+        :type directory: str
+        :param segment_size: The maximum size, in bytes, of the log of a
+                             segment.
+        :type segment_size: int
+        :param batch_bytes: How many bytes of records to keep in memory
+                            before writing them.
+        :type batch_bytes: int
+        """
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self.directory = directory
+        self._segment_size = segment_size
+        self._batch_bytes = batch_bytes
+        numbers = _segment_numbers(directory)
+        self._number = numbers[-1] if numbers else 0
+        self._log = None
+        self._index = None
+        self._offset = 0
+        # the chunks of the records and index entries not yet written
+        self._records = []
+        self._entries = []
+        self._pending = 0
+        self.records = 0
+        self._open_segment()
+
+    def _open_segment(self):
+        """
+        Close the current segment, if any, and start a new one.
+        """
+        self._close_segment()
+        self._number += 1
+        self._log = open(
+            _segment_path(self.directory, self._number, _LOG_SUFFIX), 'ab')
+        self._index = open(
+            _segment_path(self.directory, self._number, _INDEX_SUFFIX), 'ab')
+        self._offset = 0
+
+    def _close_segment(self):
+        if self._log is not None:
+            self.flush()
+            self._log.close()
+            self._index.close()
+            self._log = self._index = None
+
+    def append(self, message, timestamp=None):
+        """
+        Append a relayed message to the journal.
+
+        :param message: The frames of the message, with the topic and the
+                        body in separate frames.
+        :type message: list of zmq.Frame or str
+        :param timestamp: The time the message was relayed, or None for now.
+        :type timestamp: float
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        topic = message[0]
+        if not isinstance(topic, bytes):
+            topic = topic.bytes
+        event = catalog.get_event(topic)
+        event_id = event.id if event is not None else 0
+        # frames are written from their own buffers, without copying them
+        chunks = [None]
+        size = _RECORD.size
+        for frame in message:
+            if not isinstance(frame, bytes):
+                frame = frame.buffer
+            chunks.append(_FRAME.pack(len(frame)))
+            chunks.append(frame)
+            size += _FRAME.size + len(frame)
+        chunks[0] = _RECORD.pack(size, timestamp, event_id, len(message))
+        if self._offset and self._offset + size > self._segment_size:
+            self._open_segment()
+        self._records.extend(chunks)
+        self._entries.append(_ENTRY.pack(timestamp, event_id, self._offset))
+        self._offset += size
+        self._pending += size
+        self.records += 1
+        if self._pending >= self._batch_bytes:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the records kept in memory.
+        """
+        if not self._entries:
+            return
+        # the log first, so readers never find entries of missing records.
+        # each chunk is written on its own: the writelines of python 2
+        # files only takes strings, not the buffers of the frames
+        write = self._log.write
+        for chunk in self._records:
+            write(chunk)
+        self._log.flush()
+        self._index.writelines(self._entries)
+        self._index.flush()
+        self._records = []
+        self._entries = []
+        self._pending = 0
+
+    def close(self):
+        """
+        Write the records kept in memory and close the journal.
+        """
+        self._close_segment()
+
+
+class JournalRecord(collections.namedtuple(
+        'JournalRecord', ['timestamp', 'event_id', 'frames'])):
+    """
+    A message read from the journal.
+    """
+
+    __slots__ = ()
+
+    @property
+    def event(self):
+        """
+        The event of the message, or None if it is not in the catalog.
+
+        :rtype: Event
+        """
+        return catalog.get_event_by_id(self.event_id)
+
+    def content(self, accept=None):
+        """
+        Decode the content of the message.
+
+        :param accept: The names of the codecs accepted, or None to accept
+                       all of them.
+        :type accept: set of str
+
+        :rtype: tuple
+
+        :raises CodecError: if the content can't be decoded.
+        """
+        _, body = wire.unpack(list(self.frames))
+        return codecs.decode(body, accept=accept)
+
+
+class _Timestamps(object):
+    """
+    The timestamps of the entries of a mapped index, as a sequence that can
+    be bisected.
+    """
+
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return len(self._index) // _ENTRY.size
+
+    def __getitem__(self, i):
+        return _ENTRY.unpack_from(self._index, i * _ENTRY.size)[0]
+
+
+class JournalReader(object):
+    """
+    Reads the records of a journal directory through memory maps.
+
+    Records are read as the journal is being written, up to the last batch
+    written when each segment is reached. Queries by time assume the clock
+    of the server does not go back.
+    """
+
+    def __init__(self, directory):
+        """
+        Initialize the reader.
+
+        :param directory: The directory of the journal.
+        :type directory: str
+        """
+        self.directory = directory
+
+    def read(self, since=None, until=None, events=None):
+        """
+        Iterate over the records of the journal, oldest first.
+
+        :param since: If not None, skip records older than this time.
+        :type since: float
+        :param until: If not None, stop at records newer than this time.
+        :type until: float
+        :param events: If not None, only the records of these events.
+        :type events: list of Event
+
+        :rtype: iterator of JournalRecord
+        """
+        ids = None
+        if events is not None:
+            ids = frozenset(event.id for event in events)
+        for number in _segment_numbers(self.directory):
+            segment = self._map(number)
+            if segment is None:
+                continue
+            index, log = segment
+            try:
+                timestamps = _Timestamps(index)
+                count = len(timestamps)
+                if until is not None and timestamps[0] > until:
+                    return
+                if since is not None and timestamps[count - 1] < since:
+                    continue
+                start = 0
+                if since is not None:
+                    start = bisect.bisect_left(timestamps, since)
+                for i in range(start, count):
+                    timestamp, event_id, offset = _ENTRY.unpack_from(
+                        index, i * _ENTRY.size)
+                    if until is not None and timestamp > until:
+                        return
+                    if ids is not None and event_id not in ids:
+                        continue
+                    yield JournalRecord(
+                        timestamp, event_id, self._frames(log, offset))
+            finally:
+                index.close()
+                log.close()
+
+    def _map(self, number):
+        """
+        Map the index and the log of a segment.
+
+        :param number: The number of the segment.
+        :type number: int
+
+        :return: The mapped index and log, or None if the segment is empty.
+        :rtype: tuple of mmap.mmap
+        """
+        # the index first, as its records are already in the log
+        index = self._map_file(
+            _segment_path(self.directory, number, _INDEX_SUFFIX),
+            unit=_ENTRY.size)
+        if index is None:
+            return None
+        log = self._map_file(
+            _segment_path(self.directory, number, _LOG_SUFFIX))
+        if log is None:
+            index.close()
+            return None
+        return index, log
+
+    def _map_file(self, path, unit=1):
+        """
+        Map a file, read only.
+
+        :param path: The path of the file.
+        :type path: str
+        :param unit: The size of the items in the file. Only whole items are
+                     mapped, as a batch may be half written.
+        :type unit: int
+
+        :return: The map, or None if the file is missing or empty.
+        :rtype: mmap.mmap
+        """
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                size -= size % unit
+                if not size:
+                    return None
+                return mmap.mmap(
+                    f.fileno(), size, access=mmap.ACCESS_READ)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def _frames(self, log, offset):
+        """
+        Read the frames of the record at an offset of a log.
+
+        :rtype: tuple of str
+        """
+        _, _, _, count = _RECORD.unpack_from(log, offset)
+        position = offset + _RECORD.size
+        frames = []
+        for _ in range(count):
+            length, = _FRAME.unpack_from(log, position)
+            position += _FRAME.size
+            frames.append(log[position:position + length])
+            position += length
+        return tuple(frames)
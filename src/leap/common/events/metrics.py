@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+# metrics.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Traffic and latency metrics of events clients and servers.
+
+Metrics are kept per event: the number and size of sent and received
+messages, how many callbacks ran for them, and a histogram of the time since
+they were emitted, taken from the timestamp emitters add to the messages.
+"""
+import bisect
+import threading
+import time
+
+
+# the label under which the metrics of all the messages of unknown events are
+# kept, so stray topics can't add any number of series
+UNKNOWN_LABEL = "unknown"
+
+# upper bounds, in seconds, of the buckets of latency histograms
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0,
+)
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets.
+    """
+
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        Initialize the histogram.
+
+        :param bounds: The sorted upper bounds of the buckets. Values above
+                       the last one are counted in an extra bucket.
+        :type bounds: tuple of float
+        """
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        """
+        Add a value to the histogram.
+
+        :param value: The value.
+        :type value: float
+        """
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        Return an upper bound of a percentile of the observed values.
+
+        :param fraction: The percentile, as a fraction (e.g. 0.99).
+        :type fraction: float
+
+        :return: The upper bound of the bucket where the percentile falls,
+                 or the maximum value if it falls above the last bucket.
+        :rtype: float
+        """
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        Return the state of the histogram.
+
+        :rtype: dict
+        """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'bounds': list(self.bounds),
+            'counts': list(self.counts),
+        }
+
+
+class EventMetrics(object):
+    """
+    The metrics of one event.
+    """
+
+    __slots__ = ('sent', 'sent_bytes', 'received', 'received_bytes',
+                 'deliveries', 'latency')
+
+    def __init__(self):
+        self.sent = 0
+        self.sent_bytes = 0
+        self.received = 0
+        self.received_bytes = 0
+        # callbacks run for the received messages, i.e. the local fan-out
+        self.deliveries = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        """
+        Return the state of the metrics.
+
+        :rtype: dict
+        """
+        return {
+            'sent': self.sent,
+            'sent_bytes': self.sent_bytes,
+            'received': self.received,
+            'received_bytes': self.received_bytes,
+            'deliveries': self.deliveries,
+            'latency': self.latency.snapshot(),
+        }
+
+
+class Metrics(object):
+    """
+    The metrics of an events client or server, safe to update from several
+    threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = {}
+        self.started = time.time()
+
+    def _get(self, label):
+        try:
+            return self._events[label]
+        except KeyError:
+            return self._events.setdefault(label, EventMetrics())
+
+    def sent(self, label, size):
+        """
+        Count a sent message.
+
+        :param label: The label of the event.
+        :type label: str
+        :param size: The size of the encoded content.
+        :type size: int
+        """
+        with self._lock:
+            metrics = self._get(label)
+            metrics.sent += 1
+            metrics.sent_bytes += size
+
+    def received(self, label, size, deliveries=0, emitted=None):
+        """
+        Count a received message.
+
+        :param label: The label of the event.
+        :type label: str
+        :param size: The size of the encoded content.
+        :type size: int
+        :param deliveries: The number of callbacks run for the message.
+        :type deliveries: int
+        :param emitted: When the message was emitted, if known.
+        :type emitted: float
+        """
+        with self._lock:
+            metrics = self._get(label)
+            metrics.received += 1
+            metrics.received_bytes += size
+            metrics.deliveries += deliveries
+            if emitted is not None:
+                # clocks of other hosts may be off, don't go negative
+                metrics.latency.observe(max(0.0, time.time() - emitted))
+
+    def snapshot(self, queues=None):
+        """
+        Return the state of the metrics.
+
+        :param queues: The current depth of the queues of the component.
+        :type queues: dict
+
+        :rtype: dict
+        """
+        with self._lock:
+            events = dict((label, metrics.snapshot())
+                          for label, metrics in self._events.items())
+        return {
+            'uptime': time.time() - self.started,
+            'events': events,
+            'queues': queues or {},
+        }
+
+    def reset(self):
+        """
+        Forget all the metrics.
+        """
+        with self._lock:
+            self._events = {}
+            self.started = time.time()
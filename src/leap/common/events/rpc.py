@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+# rpc.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Remote calls through the events server, implemented using txzmq.
+
+A component responds to an event with a handler, and any other component
+may then call that event with some arguments and get the handler's result
+back. Calls go through the server's RPC socket (see server.RPC_ADDR), which
+routes each call to one of the components responding to the event, and the
+reply to the caller only, instead of broadcasting them to all subscribers.
+
+>>> from leap.common.events import rpc
+>>> rpc.respond(catalog.CLIENT_UID, lambda event, name: name.upper())
+>>> d = rpc.call(catalog.CLIENT_UID, "foo", timeout=5)
+"""
+import logging
+import threading
+import uuid
+
+import txzmq
+
+from twisted.internet import defer
+from twisted.internet import reactor
+from zmq import constants
+
+from leap.common.events.errors import CodecError
+from leap.common.events.errors import NoResponderError
+from leap.common.events.errors import ResponderBusyError
+from leap.common.events.errors import RpcError
+from leap.common.events.errors import RpcTimeoutError
+from leap.common.events.server import RPC_ADDR
+from leap.common.events.zmq_components import TxZmqClientComponent
+from leap.common.events import catalog
+from leap.common.events import codec as codecs
+from leap.common.events import wire
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = [
+    "configure_rpc",
+    "EventsRpcClient",
+    "call",
+    "respond",
+    "unrespond",
+    "shutdown",
+]
+
+
+# how long, in seconds, a call waits for its reply by default
+CALL_TIMEOUT = 30.0
+
+
+_rpc_addr = RPC_ADDR
+_factory = None
+_enable_curve = True
+_codec = codecs.DEFAULT_CODEC
+_accept_codecs = None
+
+
+def configure_rpc(rpc_addr, factory=None, enable_curve=True,
+                  codec=codecs.DEFAULT_CODEC, accept_codecs=None):
+    """
+    Configure the parameters used to create the RPC client singleton.
+
+    :param rpc_addr: The address of the server's RPC socket.
+    :type rpc_addr: str
+    :param codec: The name of the codec used to encode arguments and
+                  results.
+    :type codec: str
+    :param accept_codecs: The names of the codecs accepted when decoding
+                          arguments and results, or None to accept all of
+                          them.
+    :type accept_codecs: list of str
+    """
+    global _rpc_addr, _factory, _enable_curve, _codec, _accept_codecs
+    logger.debug("Configuring RPC client with address: %s" % rpc_addr)
+    _rpc_addr = rpc_addr
+    _factory = factory
+    _enable_curve = enable_curve
+    _codec = codec
+    _accept_codecs = accept_codecs
+
+
+class ZmqDealerConnection(txzmq.ZmqConnection):
+    """
+    A DEALER connection that hands over the raw frames of the messages it
+    receives.
+
+    Subclass or override :meth:`onMessage`.
+    """
+
+    socketType = constants.DEALER
+
+    def messageReceived(self, message):
+        self.onMessage(message)
+
+    def onMessage(self, message):
+        """
+        Called when a message is received.
+
+        :param message: The frames of the message.
+        :type message: list of str
+        """
+        raise NotImplementedError(self)
+
+
+class _Responder(object):
+    """
+    A handler responding to an event, and the calls it is answering.
+    """
+
+    def __init__(self, handler, concurrency, backlog):
+        self.handler = handler
+        self.backlog = backlog
+        self.semaphore = defer.DeferredSemaphore(concurrency)
+
+    @property
+    def busy(self):
+        """
+        Whether as many calls as allowed are already waiting for a turn.
+        """
+        return len(self.semaphore.waiting) >= self.backlog
+
+
+class EventsRpcClient(TxZmqClientComponent):
+    """
+    A twisted client that calls events, and responds to them, through the
+    events server.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, rpc_addr=RPC_ADDR, path_prefix=None, factory=None,
+                 enable_curve=True, codec=codecs.DEFAULT_CODEC,
+                 accept_codecs=None):
+        """
+        Initialize the RPC client.
+
+        :param rpc_addr: The address of the server's RPC socket.
+        :type rpc_addr: str
+        :param codec: The name of the codec used to encode arguments and
+                      results.
+        :type codec: str
+        :param accept_codecs: The names of the codecs accepted when decoding
+                              arguments and results, or None to accept all
+                              of them.
+        :type accept_codecs: list of str
+        """
+        TxZmqClientComponent.__init__(
+            self, path_prefix=path_prefix, factory=factory,
+            enable_curve=enable_curve)
+        self._codec = codecs.get_codec(codec)
+        self._accept_codecs = None
+        if accept_codecs is not None:
+            self._accept_codecs = set(accept_codecs)
+        # the calls waiting for replies, by call id, as (event, deferred,
+        # timeout call) tuples, and the responders, by event
+        self._calls = {}
+        self._responders = {}
+        self._dealer = self._zmq_connect(ZmqDealerConnection, rpc_addr)
+        self._dealer.onMessage = self._onMessage
+
+    @classmethod
+    def instance(cls):
+        """
+        Return a singleton EventsRpcClient instance.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls(
+                    _rpc_addr, factory=_factory, enable_curve=_enable_curve,
+                    codec=_codec, accept_codecs=_accept_codecs)
+        return cls._instance
+
+    @classmethod
+    def reset(cls):
+        with cls._instance_lock:
+            cls._instance = None
+
+    def call(self, event, *args, **kwargs):
+        """
+        Call an event.
+
+        :param event: The called event.
+        :type event: Event
+        :param args: The arguments of the call.
+        :type args: list
+        :param timeout: The maximum time, in seconds, to wait for the reply,
+                        or None to wait forever. Passed as a keyword.
+        :type timeout: float
+
+        :return: A deferred that fires with the result of the responder's
+                 handler, or fails with an RpcError.
+        :rtype: twisted.internet.defer.Deferred
+        """
+        timeout = kwargs.pop('timeout', CALL_TIMEOUT)
+        if kwargs:
+            raise TypeError(
+                "Unexpected keyword arguments: %s" % ", ".join(kwargs))
+        call_id = uuid.uuid4().bytes
+        d = defer.Deferred(lambda _: self._forgetCall(call_id))
+        timer = None
+        if timeout is not None:
+            timer = reactor.callLater(timeout, self._expire, call_id)
+        self._calls[call_id] = (event, d, timer)
+        logger.debug("Calling event: (%s, %s)" % (event, args))
+        self._dealer.send([
+            wire.RPC_REQUEST, call_id, event.label_topic,
+            self._codec.encode(args)])
+        return d
+
+    def respond(self, event, handler, concurrency=1, backlog=100):
+        """
+        Respond to the calls of an event.
+
+        :param event: The event to respond to.
+        :type event: Event
+        :param handler: The handler of the calls. It may return a deferred.
+        :type handler: callable(event, *args)
+        :param concurrency: How many calls may be handled at the same time.
+        :type concurrency: int
+        :param backlog: How many calls may wait for their turn. Further calls
+                        fail with ResponderBusyError.
+        :type backlog: int
+        """
+        logger.debug("Responding to event: %s" % event)
+        self._responders[event] = _Responder(handler, concurrency, backlog)
+        self._dealer.send([wire.RPC_READY, event.label_topic])
+
+    def unrespond(self, event):
+        """
+        Stop responding to the calls of an event.
+
+        Calls already received are still answered.
+
+        :param event: The event.
+        :type event: Event
+        """
+        if self._responders.pop(event, None) is not None:
+            self._dealer.send([wire.RPC_GONE, event.label_topic])
+
+    def _onMessage(self, message):
+        """
+        Handle a message from the server's RPC socket.
+
+        :param message: The frames of the message.
+        :type message: list of str
+        """
+        kind, frames = message[0], message[1:]
+        if kind == wire.RPC_REPLY and len(frames) == 3:
+            self._onReply(*frames)
+        elif kind == wire.RPC_REQUEST and len(frames) == 4:
+            self._onRequest(*frames)
+        else:
+            logger.warning("Dropping malformed RPC message: %r" % (kind,))
+
+    def _onReply(self, call_id, status, body):
+        """
+        Fire the deferred of a call with its reply.
+
+        :param call_id: The id of the call.
+        :type call_id: str
+        :param status: The status of the reply.
+        :type status: str
+        :param body: The encoded result, or error message.
+        :type body: str
+        """
+        call = self._forgetCall(call_id)
+        if call is None:
+            # expired or cancelled
+            return
+        event, d, _ = call
+        if status == wire.RPC_NO_RESPONDER:
+            d.errback(NoResponderError("Nobody responds to %s." % event))
+            return
+        if status == wire.RPC_BUSY:
+            d.errback(ResponderBusyError("Responder of %s is busy." % event))
+            return
+        try:
+            result = codecs.decode(body, accept=self._accept_codecs)[0]
+        except (CodecError, IndexError, TypeError) as e:
+            d.errback(RpcError("Malformed reply to %s: %s" % (event, e)))
+            return
+        if status == wire.RPC_OK:
+            d.callback(result)
+        else:
+            d.errback(RpcError(result))
+
+    def _expire(self, call_id):
+        """
+        Fail a call that was not answered in time.
+
+        :param call_id: The id of the call.
+        :type call_id: str
+        """
+        call = self._calls.pop(call_id, None)
+        if call is not None:
+            event, d, _ = call
+            d.errback(RpcTimeoutError("Call to %s timed out." % event))
+
+    def _forgetCall(self, call_id):
+        """
+        Stop waiting for the reply to a call.
+
+        :param call_id: The id of the call.
+        :type call_id: str
+
+        :return: The event, deferred and timeout call of the call, or None
+                 if it is not waiting anymore.
+        :rtype: tuple
+        """
+        call = self._calls.pop(call_id, None)
+        if call is not None and call[2] is not None and call[2].active():
+            call[2].cancel()
+        return call
+
+    def _onRequest(self, caller, call_id, topic, body):
+        """
+        Handle a call routed to this client.
+
+        :param caller: The identity of the caller.
+        :type caller: str
+        :param call_id: The id of the call.
+        :type call_id: str
+        :param topic: The topic of the called event.
+        :type topic: str
+        :param body: The encoded arguments of the call.
+        :type body: str
+        """
+        def reply(status, result):
+            try:
+                encoded = self._codec.encode((result,))
+            except Exception as e:
+                # codecs raise different errors for what they can't encode,
+                # and the caller must hear of it instead of timing out
+                logger.debug("Can't encode reply to %s: %s" % (event, e))
+                status = wire.RPC_ERROR
+                error = "Can't encode result: %s: %s" % (
+                    e.__class__.__name__, e)
+                encoded = self._codec.encode((error,))
+            self._dealer.send([
+                wire.RPC_REPLY, caller, call_id, status, encoded])
+
+        event = catalog.get_event(topic)
+        responder = self._responders.get(event)
+        if responder is None:
+            # stopped responding while the call was being routed
+            reply(wire.RPC_NO_RESPONDER, None)
+            return
+        if responder.busy:
+            reply(wire.RPC_BUSY, None)
+            return
+        try:
+            args = codecs.decode(body, accept=self._accept_codecs)
+        except CodecError as e:
+            reply(wire.RPC_ERROR, "Malformed call: %s" % e)
+            return
+
+        def failed(failure):
+            logger.debug("Handler of %s failed: %s" % (event, failure.value))
+            reply(wire.RPC_ERROR, "%s: %s" % (
+                failure.type.__name__, failure.getErrorMessage()))
+
+        d = responder.semaphore.run(responder.handler, event, *args)
+        d.addCallbacks(lambda result: reply(wire.RPC_OK, result), failed)
+        d.addErrback(lambda failure: logger.error(
+            "Could not reply to %s: %s" % (event, failure.value)))
+
+    def shutdown(self):
+        """
+        Stop responding, fail the calls waiting for replies, and close the
+        client's connection.
+        """
+        for event in list(self._responders):
+            self.unrespond(event)
+        for call_id in list(self._calls):
+            event, d, _ = self._forgetCall(call_id)
+            d.errback(RpcError("Client shut down before %s replied." % event))
+        self._dealer.shutdown()
+        self.reset()
+
+
+def call(event, *args, **kwargs):
+    """
+    Call an event.
+
+    :param event: The called event.
+    :type event: Event
+    :param args: The arguments of the call.
+    :type args: list
+    :param timeout: The maximum time, in seconds, to wait for the reply, or
+                    None to wait forever. Passed as a keyword.
+    :type timeout: float
+
+    :return: A deferred that fires with the result of the call.
+    :rtype: twisted.internet.defer.Deferred
+    """
+    return EventsRpcClient.instance().call(event, *args, **kwargs)
+
+
+def respond(event, handler, concurrency=1, backlog=100):
+    """
+    Respond to the calls of an event.
+
+    :param event: The event to respond to.
+    :type event: Event
+    :param handler: The handler of the calls. It may return a deferred.
+    :type handler: callable(event, *args)
+    :param concurrency: How many calls may be handled at the same time.
+    :type concurrency: int
+    :param backlog: How many calls may wait for their turn.
+    :type backlog: int
+    """
+    return EventsRpcClient.instance().respond(
+        event, handler, concurrency=concurrency, backlog=backlog)
+
+
+def unrespond(event):
+    """
+    Stop responding to the calls of an event.
+
+    :param event: The event.
+    :type event: Event
+    """
+    return EventsRpcClient.instance().unrespond(event)
+
+
+def shutdown():
+    """
+    Shutdown the RPC client.
+    """
+    EventsRpcClient.instance().shutdown()
+
+
+def instance():
+    """
+    Return an instance of the RPC client.
+
+    :return: An instance of the RPC client.
+    :rtype: EventsRpcClient
+    """
+    return EventsRpcClient.instance()
@@ -17,28 +17,67 @@
 """
 The server for the events mechanism.
 """
+import collections
 import logging
-import platform
+import os
+import struct
+import threading
+import uuid
 
 import txzmq
+import zmq
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from zmq import constants
 
 from leap.common.zmq_utils import zmq_has_curve
+from leap.common.zmq_utils import zmq_capabilities
 from leap.common.events.zmq_components import TxZmqServerComponent
+from leap.common.events.errors import CodecError
+from leap.common.events.metrics import Metrics
+from leap.common.events.metrics import UNKNOWN_LABEL
+from leap.common.events import blobs
+from leap.common.events import catalog
+from leap.common.events import codec as codecs
+from leap.common.events import journal
+from leap.common.events import wire
 
 
-if zmq_has_curve() or platform.system() == "Windows":
-    # Windows doesn't have ipc sockets, we need to use always tcp
+if zmq_has_curve() or not zmq_capabilities().ipc:
+    # some platforms (e.g. Windows) don't have ipc sockets, we need to use
+    # always tcp there
     EMIT_ADDR = "tcp://127.0.0.1:9000"
     REG_ADDR = "tcp://127.0.0.1:9001"
+    RPC_ADDR = "tcp://127.0.0.1:9002"
+    PRIORITY_EMIT_ADDR = "tcp://127.0.0.1:9003"
+    PRIORITY_REG_ADDR = "tcp://127.0.0.1:9004"
 else:
     EMIT_ADDR = "ipc:///tmp/leap.common.events.socket.0"
     REG_ADDR = "ipc:///tmp/leap.common.events.socket.1"
+    RPC_ADDR = "ipc:///tmp/leap.common.events.socket.2"
+    PRIORITY_EMIT_ADDR = "ipc:///tmp/leap.common.events.socket.3"
+    PRIORITY_REG_ADDR = "ipc:///tmp/leap.common.events.socket.4"
 
 logger = logging.getLogger(__name__)
 
 
+# the counts in the replies to the STATISTICS command of zmq proxies
+_STATISTIC = struct.Struct('=Q')
+
+# how long, in seconds, the reactor waits for the proxy to report its counts
+STATISTICS_TIMEOUT = 0.5
+
+# the commands that steer zmq proxies
+_PROXY_COMMANDS = frozenset([b'PAUSE', b'RESUME', b'TERMINATE', b'STATISTICS'])
+
+
 def ensure_server(emit_addr=EMIT_ADDR, reg_addr=REG_ADDR, path_prefix=None,
-                  factory=None, enable_curve=True):
+                  factory=None, enable_curve=True, legacy_wire=False,
+                  proxy=False, metrics=False, stats_interval=None,
+                  replay_size=None, replay_bytes=None, last_values=None,
+                  rpc_addr=None, journal_dir=None, priority_emit_addr=None,
+                  priority_reg_addr=None):
     """
     Make sure the server is running in the given addresses.
 
@@ -46,23 +85,249 @@ def ensure_server(emit_addr=EMIT_ADDR, reg_addr=REG_ADDR, path_prefix=None,
     :type emit_addr: str
     :param reg_addr: The address to which publish events to clients.
     :type reg_addr: str
+    :param rpc_addr: If not None, the address in which to route remote calls
+                     between clients, see rpc.py.
+    :type rpc_addr: str
+    :param journal_dir: If not None, the directory of a journal in which to
+                        append the relayed messages, see journal.py.
+    :type journal_dir: str
+    :param priority_emit_addr: If not None, the address in which to listen
+                               for high priority events, see
+                               catalog.PRIORITIES.
+    :type priority_emit_addr: str
+    :param priority_reg_addr: If not None, the address to which publish
+                              high priority events.
+    :type priority_reg_addr: str
+    :param legacy_wire: Whether to publish single frame messages, for
+                        clients that predate multipart messages.
+    :type legacy_wire: bool
+    :param proxy: Whether to relay events with a native zmq proxy running in
+                  its own thread, instead of through the reactor. It keeps
+                  metrics and the journal, but no other option.
+    :type proxy: bool
+    :param metrics: Whether to keep traffic and latency metrics.
+    :type metrics: bool
+    :param stats_interval: If not None, publish the metrics as an
+                           EVENTS_SERVER_STATS event every this many
+                           seconds.
+    :type stats_interval: float
+    :param replay_size: If not None, keep this many recent messages to
+                        replay to clients that ask for them.
+    :type replay_size: int
+    :param replay_bytes: If not None, the maximum size, in bytes, of the
+                         recent messages kept.
+    :type replay_bytes: int
+    :param last_values: If not None, keep the last message of up to this
+                        many events (or states of coalesced events) to
+                        replay to clients that ask for them.
+    :type last_values: int
 
     :return: an events server instance
-    :rtype: EventsServer
+    :rtype: EventsServer or EventsProxyServer
     """
+    if proxy:
+        if legacy_wire:
+            raise ValueError(
+                "The proxy server relays messages as they are received.")
+        if (replay_size is not None or replay_bytes is not None
+                or last_values is not None):
+            raise ValueError(
+                "The proxy server does not keep relayed messages.")
+        if rpc_addr is not None:
+            raise ValueError("The proxy server does not route remote calls.")
+        if priority_emit_addr is not None or priority_reg_addr is not None:
+            raise ValueError("The proxy server has a single lane.")
+        return EventsProxyServer(
+            emit_addr, reg_addr, path_prefix, factory=factory,
+            enable_curve=enable_curve, metrics=metrics,
+            stats_interval=stats_interval, journal_dir=journal_dir)
     _server = EventsServer(emit_addr, reg_addr, path_prefix, factory=factory,
-                           enable_curve=enable_curve)
+                           enable_curve=enable_curve, legacy_wire=legacy_wire,
+                           metrics=metrics, stats_interval=stats_interval,
+                           replay_size=replay_size, replay_bytes=replay_bytes,
+                           last_values=last_values, rpc_addr=rpc_addr,
+                           journal_dir=journal_dir,
+                           priority_emit_addr=priority_emit_addr,
+                           priority_reg_addr=priority_reg_addr)
     return _server
 
 
+def _eventLabel(topic):
+    """
+    Return the label under which the metrics of a topic are kept. Topics
+    of unknown events share a single label.
+
+    :param topic: The topic of a message.
+    :type topic: str
+
+    :rtype: str
+    """
+    event = catalog.get_event(topic)
+    return event.label if event is not None else UNKNOWN_LABEL
+
+
+class ZmqFramePullConnection(txzmq.ZmqPullConnection):
+    """
+    A PULL connection that receives zmq frames instead of copying each part
+    of a message into a new string.
+
+    Set :attr:`beforeRead` to be called before each batch of messages.
+    """
+
+    beforeRead = None
+
+    def doRead(self):
+        """
+        Read the messages waiting in the socket.
+        """
+        if self.beforeRead is not None:
+            self.beforeRead()
+        txzmq.ZmqPullConnection.doRead(self)
+
+    def _readMultipart(self):
+        """
+        Read a multipart message without copying its frames.
+
+        :return: The frames of the message.
+        :rtype: list of zmq.Frame
+        """
+        while True:
+            self.recv_parts.append(
+                self.socket.recv(constants.NOBLOCK, copy=False))
+            if not self.socket.get(constants.RCVMORE):
+                result, self.recv_parts = self.recv_parts, []
+                return result
+
+
+class ZmqCaptureConnection(ZmqFramePullConnection):
+    """
+    A connection that receives, without copying them, the messages
+    published in the capture socket of a native zmq proxy.
+    """
+
+    socketType = constants.SUB
+
+    def __init__(self, factory, address):
+        """
+        Initialize the connection and connect it to the capture socket.
+
+        :param factory: The factory of the connection.
+        :type factory: txzmq.ZmqFactory
+        :param address: The address of the capture socket.
+        :type address: str
+        """
+        ZmqFramePullConnection.__init__(self, factory)
+        self.socket.setsockopt(constants.SUBSCRIBE, b'')
+        self.addEndpoints([txzmq.ZmqEndpoint(
+            txzmq.ZmqEndpointType.connect, address)])
+        # the descriptor may not signal what arrived while connecting
+        self.doRead()
+
+
+class ZmqXPubConnection(txzmq.ZmqPubConnection):
+    """
+    A publishing connection that is told about its subscribers'
+    subscriptions.
+
+    Subclass or override :meth:`onSubscription`.
+    """
+
+    socketType = constants.XPUB
+
+    def messageReceived(self, message):
+        """
+        Handle a subscription message.
+
+        :param message: The subscription message.
+        :type message: list of str
+        """
+        data = message[0]
+        self.onSubscription(data[:1] == b'\x01', data[1:])
+
+    def onSubscription(self, subscribed, topic):
+        """
+        Called when a topic is subscribed or unsubscribed.
+
+        :param subscribed: Whether the topic was subscribed.
+        :type subscribed: bool
+        :param topic: The topic.
+        :type topic: str
+        """
+        raise NotImplementedError(self)
+
+
+class ZmqRouterConnection(txzmq.ZmqConnection):
+    """
+    A ROUTER connection, that hands over the raw frames of the messages it
+    receives, starting with the identity of the sender.
+
+    Subclass or override :meth:`onMessage`.
+    """
+
+    socketType = constants.ROUTER
+
+    def __init__(self, *args, **kwargs):
+        txzmq.ZmqConnection.__init__(self, *args, **kwargs)
+        # fail, instead of dropping, messages to unknown peers
+        self.socket.setsockopt(constants.ROUTER_MANDATORY, 1)
+
+    def messageReceived(self, message):
+        self.onMessage(message)
+
+    def onMessage(self, message):
+        """
+        Called when a message is received.
+
+        :param message: The frames of the message, the first one being the
+                        identity of the sender.
+        :type message: list of str
+        """
+        raise NotImplementedError(self)
+
+    def sendTo(self, message):
+        """
+        Send a message to a peer.
+
+        :param message: The frames of the message, the first one being the
+                        identity of the recipient.
+        :type message: list of str
+
+        :return: Whether the peer is connected.
+        :rtype: bool
+        """
+        try:
+            self.send(message)
+        except zmq.ZMQError as e:
+            if e.errno != zmq.EHOSTUNREACH:
+                raise
+            return False
+        return True
+
+
 class EventsServer(TxZmqServerComponent):
     """
     An events server that listens for events in one address and publishes those
     events in another address.
+
+    The server may keep recent messages, and the last message of each event,
+    to replay them to clients that start after the events were emitted, see
+    wire.replay_request(). Messages are kept as they were received, so
+    replaying them does not encode anything again.
+
+    The server may also route remote calls from callers to responders, see
+    rpc.py.
+
+    High priority events may go through a second pair of sockets, a lane of
+    their own. Messages waiting in the high priority lane are relayed before
+    each message of the normal one, so control events are not delayed by
+    floods of other events.
     """
 
     def __init__(self, emit_addr, reg_addr, path_prefix=None, factory=None,
-                 enable_curve=True):
+                 enable_curve=True, legacy_wire=False, metrics=False,
+                 stats_interval=None, replay_size=None, replay_bytes=None,
+                 last_values=None, rpc_addr=None, journal_dir=None,
+                 priority_emit_addr=None, priority_reg_addr=None):
         """
         Initialize the events server.
 
@@ -70,25 +335,831 @@ class EventsServer(TxZmqServerComponent):
         :type emit_addr: str
         :param reg_addr: The address to which publish events to clients.
         :type reg_addr: str
+        :param legacy_wire: Whether to publish single frame messages, for
+                            clients that predate multipart messages.
+        :type legacy_wire: bool
+        :param metrics: Whether to keep traffic and latency metrics. The
+                        latency is the time from emission to arrival at the
+                        server, for messages that carry their emission time.
+        :type metrics: bool
+        :param stats_interval: If not None, publish the metrics as an
+                               EVENTS_SERVER_STATS event every this many
+                               seconds, if anyone is subscribed to it.
+        :type stats_interval: float
+        :param replay_size: If not None, keep this many recent messages to
+                            replay to clients that ask for them.
+        :type replay_size: int
+        :param replay_bytes: If not None, the maximum size, in bytes, of the
+                             recent messages kept.
+        :type replay_bytes: int
+        :param last_values: If not None, keep the last message of up to this
+                            many events to replay to clients that ask for
+                            them. Coalesced events keep the last message of
+                            each of their states, see
+                            catalog.COALESCED_EVENTS.
+        :type last_values: int
+        :param rpc_addr: If not None, the address in which to route remote
+                         calls between clients.
+        :type rpc_addr: str
+        :param journal_dir: If not None, the directory of a journal in which
+                            to append the relayed messages. They are written
+                            in batches, at least every
+                            journal.FLUSH_INTERVAL seconds.
+        :type journal_dir: str
+        :param priority_emit_addr: If not None, the address in which to
+                                   receive high priority events from
+                                   clients.
+        :type priority_emit_addr: str
+        :param priority_reg_addr: If not None, the address to which publish
+                                  high priority events to clients.
+        :type priority_reg_addr: str
+
+        :raises ValueError: if only one of the high priority addresses is
+                            given.
         """
+        if (priority_emit_addr is None) != (priority_reg_addr is None):
+            raise ValueError(
+                "The high priority lane needs both of its addresses.")
         TxZmqServerComponent.__init__(self, path_prefix=path_prefix,
                                       factory=factory,
                                       enable_curve=enable_curve)
+        self._legacy_wire = legacy_wire
         # bind PULL and PUB sockets
         self._pull, self.pull_port = self._zmq_bind(
-            txzmq.ZmqPullConnection, emit_addr)
+            ZmqFramePullConnection, emit_addr)
         self._pub, self.pub_port = self._zmq_bind(
-            txzmq.ZmqPubConnection, reg_addr)
-        # set a handler for arriving messages
+            ZmqXPubConnection, reg_addr)
+        # also report repeated subscriptions, so every new listener of the
+        # subscriptions topic gets a snapshot
+        if zmq_capabilities().xpub_verbose:
+            self._pub.socket.setsockopt(zmq.XPUB_VERBOSE, 1)
+        self._subscriptions = set()
+        self._subscriptions_call = None
+        # the filter topics subscribed, indexed by the topic of their event
+        # and the positions they look at, so filtering a message costs a
+        # lookup per kind of filter of its event, however many subscribers
+        self._filters = {}
+        # the store of the blobs of large events, created on first use
+        self._blobs = None
+        # the content of messages from any client is only decoded with these,
+        # messages encoded with other codecs are relayed as they are
+        self._accept_codecs = codecs.safe_codecs()
+        # set handlers for arriving messages and subscriptions
         self._pull.onPull = self._onPull
+        # libzmq only processes the subscriptions that arrive at the PUB
+        # socket once in a while when sending, so a subscription sent right
+        # before an event might not match it yet. Read them before each
+        # batch of messages, instead of before each message
+        self._pull.beforeRead = self._pub.doRead
+        self._pub.onSubscription = self._onSubscription
+        # the high priority lane, and its subscriptions
+        self._priority_pull = None
+        self._priority_pub = None
+        self.priority_pull_port = None
+        self.priority_pub_port = None
+        self._priority_subscriptions = set()
+        self._priority_filters = {}
+        if priority_emit_addr is not None:
+            self._priority_pull, self.priority_pull_port = self._zmq_bind(
+                ZmqFramePullConnection, priority_emit_addr)
+            self._priority_pub, self.priority_pub_port = self._zmq_bind(
+                ZmqXPubConnection, priority_reg_addr)
+            self._priority_pull.onPull = self._onPriorityPull
+            self._priority_pub.onSubscription = self._onPrioritySubscription
+        # metrics, and the number of subscriptions matching each topic
+        self._metrics = None
+        self._fanout = {}
+        if metrics or stats_interval is not None:
+            self._metrics = Metrics()
+        self._stats_call = None
+        if stats_interval is not None:
+            self._stats_call = LoopingCall(self._publishStats)
+            self._stats_call.start(stats_interval, now=False)
+        # replay: the recent messages, oldest first, as (topic, frames, size)
+        # tuples, and the last message of each event by (topic, state key)
+        self._replay_size = replay_size
+        self._replay_bytes = replay_bytes
+        self._recent = None
+        self._recent_bytes = 0
+        if replay_size is not None or replay_bytes is not None:
+            self._recent = collections.deque()
+        self._last_values_size = last_values
+        self._last_values = None
+        if last_values is not None:
+            self._last_values = collections.OrderedDict()
+        # remote calls: the identities of the responders ready for each
+        # topic, in the order they get requests
+        self._rpc = None
+        self.rpc_port = None
+        self._responders = {}
+        if rpc_addr is not None:
+            self._rpc, self.rpc_port = self._zmq_bind(
+                ZmqRouterConnection, rpc_addr)
+            self._rpc.onMessage = self._onRpc
+        # the journal of relayed messages
+        self._journal = None
+        self._journal_call = None
+        if journal_dir is not None:
+            self._journal = journal.Journal(journal_dir)
+            self._journal_call = LoopingCall(self._journal.flush)
+            self._journal_call.start(journal.FLUSH_INTERVAL, now=False)
+
+    @property
+    def subscriptions(self):
+        """
+        The topics that currently have subscribers.
+
+        :rtype: frozenset of str
+        """
+        return frozenset(self._subscriptions | self._priority_subscriptions)
 
     def _onPull(self, message):
         """
         Callback executed when a message is pulled from a client.
 
-        :param message: The message sent by the client.
-        :type message: str
+        :param message: The frames of the message sent by the client.
+        :type message: list of zmq.Frame
+        """
+        if self._priority_pull is not None:
+            # relay the high priority messages waiting first
+            self._priority_pull.doRead()
+        self._relay(message, self._pub, self._filters)
+
+    def _onPriorityPull(self, message):
+        """
+        Callback executed when a message is pulled from a client in the high
+        priority lane.
+
+        :param message: The frames of the message sent by the client.
+        :type message: list of zmq.Frame
+        """
+        self._relay(message, self._priority_pub, self._priority_filters)
+
+    def _relay(self, message, pub, filters):
+        """
+        Publish a message pulled from a client.
+
+        :param message: The frames of the message sent by the client.
+        :type message: list of zmq.Frame
+        :param pub: The connection in which to publish it.
+        :type pub: ZmqXPubConnection
+        :param filters: The index of the filter topics subscribed in that
+                        connection.
+        :type filters: dict
+        """
+        if self._metrics is not None:
+            self._measure(message)
+        if len(message) == 1:
+            # legacy message, topic and body in a single frame
+            message = list(wire.unpack([message[0].bytes]))
+        elif self._legacy_wire:
+            message = [message[0].bytes, message[1].bytes]
+        else:
+            # relay the frames as they are, without copying the body
+            logger.debug("Publishing event: %s", message[0])
+            pub.send(message)
+            self._publishFiltered(message, pub, filters)
+            self._keep(message)
+            return
+        logger.debug("Publishing event: %s", message[0])
+        pub.send(wire.pack(message[0], message[1], self._legacy_wire))
+        self._publishFiltered(message, pub, filters)
+        self._keep(message)
+
+    def _publishFiltered(self, message, pub, filters):
+        """
+        Publish a copy of a message under each subscribed filter topic its
+        content matches.
+
+        :param message: The frames of the message, with the topic and the
+                        body in separate frames.
+        :type message: list of zmq.Frame or str
+        :param pub: The connection in which to publish the copies.
+        :type pub: ZmqXPubConnection
+        :param filters: The index of the filter topics subscribed in that
+                        connection.
+        :type filters: dict
+        """
+        if not filters:
+            return
+        topic = message[0]
+        if not isinstance(topic, bytes):
+            topic = topic.bytes
+        by_positions = filters.get(topic)
+        if not by_positions:
+            return
+        try:
+            content = self._decode(message[1])
+        except CodecError:
+            return
+        for positions, subscribed in by_positions.items():
+            filtered = wire.content_filter_topic(topic, positions, content)
+            if filtered in subscribed:
+                # always multipart, only filtering clients subscribe to it
+                pub.send([filtered] + list(message[1:]))
+
+    def _keep(self, message):
+        """
+        Keep a relayed message to replay it later, and in the journal, if so
+        configured.
+
+        :param message: The frames of the message, with the topic and the
+                        body in separate frames.
+        :type message: list of zmq.Frame or str
+        """
+        if self._journal is not None:
+            self._journal.append(message)
+        if self._recent is None and self._last_values is None:
+            return
+        topic = message[0]
+        if not isinstance(topic, bytes):
+            topic = topic.bytes
+        frames = tuple(message)
+        if self._recent is not None:
+            size = sum(len(frame) for frame in frames)
+            self._recent.append((topic, frames, size))
+            self._recent_bytes += size
+            while self._recent and (
+                    (self._replay_size is not None
+                     and len(self._recent) > self._replay_size)
+                    or (self._replay_bytes is not None
+                        and self._recent_bytes > self._replay_bytes)):
+                self._recent_bytes -= self._recent.popleft()[2]
+        if self._last_values is not None:
+            state = (topic, self._stateKey(topic, message[1]))
+            # move the state to the end, so the least recently updated
+            # states are dropped first
+            self._last_values.pop(state, None)
+            self._last_values[state] = frames
+            while len(self._last_values) > self._last_values_size:
+                self._last_values.popitem(last=False)
+
+    def _stateKey(self, topic, body):
+        """
+        Return the key of the state carried by a message of a coalesced
+        event.
+
+        :param topic: The topic of the message.
+        :type topic: str
+        :param body: The encoded content of the message.
+        :type body: zmq.Frame or str
+
+        :return: The key of the state, or None if the event is not coalesced
+                 or the key can't be found, as when the content is encoded
+                 with a codec that is not safe.
+        """
+        event = catalog.get_event(topic)
+        if event is None or event.coalesce is None:
+            return None
+        try:
+            key = event.coalesce_key(self._decode(body))
+            hash(key)
+        except (CodecError, LookupError, TypeError):
+            return None
+        return key
+
+    def _decode(self, body):
+        """
+        Decode the content of a message, reading it from its blob if it was
+        sent through shared memory.
+
+        Only codecs that are safe to decode from untrusted peers are
+        accepted, see codec.safe_codecs().
+
+        :param body: The encoded content of the message.
+        :type body: zmq.Frame or str
+
+        :rtype: tuple
+
+        :raises CodecError: if the content can't be decoded, or its codec is
+                            not safe.
+        """
+        if not isinstance(body, bytes):
+            body = body.bytes
+        if not blobs.is_handle(body):
+            return codecs.decode(body, accept=self._accept_codecs)
+        if self._blobs is None:
+            self._blobs = blobs.BlobStore(
+                os.path.join(self._config_prefix, blobs.DIRECTORY))
+        return self._blobs.load(body, accept=self._accept_codecs)
+
+    def _replay(self, request):
+        """
+        Replay the kept messages a client asked for.
+
+        :param request: The topic of the replay request.
+        :type request: str
+        """
+        parsed = wire.parse_replay_request(request)
+        if parsed is None:
+            return
+        head, kind, prefix = parsed
+        entries = ()
+        if kind == wire.REPLAY_RECENT and self._recent is not None:
+            entries = [(topic, frames) for topic, frames, _ in self._recent]
+        elif kind == wire.REPLAY_LAST and self._last_values is not None:
+            entries = [(state[0], frames)
+                       for state, frames in self._last_values.items()]
+        logger.debug("Replaying events: %r", prefix)
+        for topic, frames in entries:
+            if topic.startswith(prefix):
+                self._pub.send([head + topic] + list(frames[1:]))
+        self._pub.send([request])
+
+    def _measure(self, message):
+        """
+        Update the metrics with a message pulled from a client.
+
+        :param message: The frames of the message sent by the client.
+        :type message: list of zmq.Frame
+        """
+        if len(message) == 1:
+            topic, body = wire.unpack([message[0].bytes])
+        else:
+            topic, body = message[0].bytes, message[1]
+        self._metrics.received(
+            _eventLabel(topic), len(body), self._fanoutOf(topic),
+            emitted=wire.timestamp(message))
+
+    def _fanoutOf(self, topic):
+        """
+        Return the number of subscriptions matching a topic.
+
+        :param topic: The topic.
+        :type topic: str
+
+        :rtype: int
+        """
+        try:
+            return self._fanout[topic]
+        except KeyError:
+            # subscriptions are prefixes of the topics they match
+            fanout = sum(
+                1 for t in self.subscriptions if topic.startswith(t))
+            self._fanout[topic] = fanout
+            return fanout
+
+    def stats(self):
+        """
+        Return the traffic and latency metrics of the server.
+
+        Deliveries of each event count the subscriptions matching the
+        messages, as the server can't tell how many clients share them.
+
+        :return: The metrics per event label, or None if the server does
+                 not keep metrics.
+        :rtype: dict
+        """
+        if self._metrics is None:
+            return None
+        depths = {'subscriptions': len(self.subscriptions)}
+        if self._recent is not None:
+            depths['recent'] = len(self._recent)
+            depths['recent_bytes'] = self._recent_bytes
+        if self._last_values is not None:
+            depths['last_values'] = len(self._last_values)
+        return self._metrics.snapshot(depths)
+
+    def _publishStats(self):
+        """
+        Publish the server's metrics to the clients subscribed to them.
+        """
+        event = catalog.EVENTS_SERVER_STATS
+        body = None
+        for topic in (event.label_topic, event.topic):
+            if not self._fanoutOf(topic):
+                continue
+            if body is None:
+                body = codecs.encode((self.stats(),), codecs.JSON)
+            self._pub.send(wire.pack(topic, body, self._legacy_wire))
+
+    def _onRpc(self, message):
+        """
+        Callback executed when a message arrives in the RPC socket.
+
+        :param message: The frames of the message, starting with the identity
+                        of the sender.
+        :type message: list of str
+        """
+        if len(message) < 2:
+            logger.warning("Dropping malformed RPC message.")
+            return
+        sender, kind, frames = message[0], message[1], message[2:]
+        if kind == wire.RPC_REQUEST and len(frames) == 3:
+            call_id, topic, body = frames
+            self._routeRequest(sender, call_id, topic, body)
+        elif kind == wire.RPC_REPLY and len(frames) == 4:
+            caller, call_id, status, body = frames
+            self._rpc.sendTo([caller, wire.RPC_REPLY, call_id, status, body])
+        elif kind == wire.RPC_READY and len(frames) == 1:
+            responders = self._responders.setdefault(
+                frames[0], collections.deque())
+            if sender not in responders:
+                responders.append(sender)
+        elif kind == wire.RPC_GONE and len(frames) == 1:
+            self._forgetResponder(frames[0], sender)
+        else:
+            logger.warning("Dropping malformed RPC message: %r" % (kind,))
+
+    def _routeRequest(self, caller, call_id, topic, body):
+        """
+        Send a request to one of the responders ready for its topic, in turn.
+
+        :param caller: The identity of the caller.
+        :type caller: str
+        :param call_id: The id of the call, unique to the caller.
+        :type call_id: str
+        :param topic: The topic of the called event.
+        :type topic: str
+        :param body: The encoded arguments of the call.
+        :type body: str
+        """
+        responders = self._responders.get(topic)
+        while responders:
+            responder = responders[0]
+            responders.rotate(-1)
+            if self._rpc.sendTo(
+                    [responder, wire.RPC_REQUEST, caller, call_id, topic,
+                     body]):
+                return
+            # the responder went away without telling
+            self._forgetResponder(topic, responder)
+        self._rpc.sendTo(
+            [caller, wire.RPC_REPLY, call_id, wire.RPC_NO_RESPONDER, b''])
+
+    def _forgetResponder(self, topic, responder):
+        """
+        Stop routing requests of a topic to a responder.
+
+        :param topic: The topic.
+        :type topic: str
+        :param responder: The identity of the responder.
+        :type responder: str
+        """
+        responders = self._responders.get(topic)
+        if responders and responder in responders:
+            responders.remove(responder)
+            if not responders:
+                del self._responders[topic]
+
+    def _onSubscription(self, subscribed, topic):
+        """
+        Callback executed when a client subscribes or unsubscribes a topic.
+
+        :param subscribed: Whether the topic was subscribed.
+        :type subscribed: bool
+        :param topic: The topic.
+        :type topic: str
+        """
+        if topic.startswith(wire.REPLAY_TOPIC):
+            if subscribed:
+                self._replay(topic)
+            return
+        if topic == wire.SUBSCRIPTIONS_TOPIC:
+            self._subscriptionsChanged(subscribed)
+            return
+        if topic.startswith(wire.FILTER_TOPIC):
+            self._trackFilter(self._filters, subscribed, topic)
+        self._subscriptionsChanged(
+            self._track(self._subscriptions, subscribed, topic))
+
+    def _onPrioritySubscription(self, subscribed, topic):
+        """
+        Callback executed when a client subscribes or unsubscribes a topic in
+        the high priority lane.
+
+        :param subscribed: Whether the topic was subscribed.
+        :type subscribed: bool
+        :param topic: The topic.
+        :type topic: str
+        """
+        if topic.startswith(wire.FILTER_TOPIC):
+            self._trackFilter(self._priority_filters, subscribed, topic)
+        self._subscriptionsChanged(
+            self._track(self._priority_subscriptions, subscribed, topic))
+
+    def _track(self, subscriptions, subscribed, topic):
+        """
+        Add a subscribed topic to, or remove an unsubscribed one from, a set
+        of subscriptions.
+
+        :return: Whether the set changed.
+        :rtype: bool
+        """
+        if subscribed:
+            changed = topic not in subscriptions
+            subscriptions.add(topic)
+        else:
+            changed = topic in subscriptions
+            subscriptions.discard(topic)
+        return changed
+
+    def _trackFilter(self, filters, subscribed, filtered):
+        """
+        Add a subscribed filter topic to, or remove an unsubscribed one from,
+        an index of filters.
+
+        :param filters: The index of filters.
+        :type filters: dict
+        :param subscribed: Whether the topic was subscribed.
+        :type subscribed: bool
+        :param filtered: The filter topic.
+        :type filtered: str
+        """
+        parsed = wire.parse_filter_topic(filtered)
+        if parsed is None:
+            logger.warning("Ignoring malformed filter: %r" % (filtered,))
+            return
+        topic, fields = parsed
+        positions = tuple(sorted(fields))
+        if subscribed:
+            filters.setdefault(topic, {}).setdefault(
+                positions, set()).add(filtered)
+            return
+        by_positions = filters.get(topic, {})
+        subscribed_topics = by_positions.get(positions)
+        if subscribed_topics is not None:
+            subscribed_topics.discard(filtered)
+            if not subscribed_topics:
+                del by_positions[positions]
+                if not by_positions:
+                    del filters[topic]
+
+    def _subscriptionsChanged(self, changed):
+        """
+        Publish the subscriptions, soon, if they changed.
+
+        :param changed: Whether they changed.
+        :type changed: bool
+        """
+        if changed:
+            self._fanout = {}
+        if changed and self._subscriptions_call is None:
+            # publish once for a burst of subscription changes
+            self._subscriptions_call = reactor.callLater(
+                0, self._publishSubscriptions)
+
+    def _publishSubscriptions(self):
+        """
+        Publish the topics that currently have subscribers.
+        """
+        # take the subscriptions still waiting in the socket into this
+        # snapshot. Reading them processes them right away, while sends
+        # only do so once in a while
+        self._pub.doRead()
+        self._subscriptions_call = None
+        self._pub.send(
+            [wire.SUBSCRIPTIONS_TOPIC] + sorted(self.subscriptions))
+
+    def shutdown(self):
+        """
+        Close the server's connections.
+        """
+        if self._stats_call is not None and self._stats_call.running:
+            self._stats_call.stop()
+        if self._subscriptions_call is not None:
+            self._subscriptions_call.cancel()
+            self._subscriptions_call = None
+        self._pull.shutdown()
+        self._pub.shutdown()
+        if self._priority_pull is not None:
+            self._priority_pull.shutdown()
+            self._priority_pub.shutdown()
+        if self._rpc is not None:
+            self._rpc.shutdown()
+        if self._journal is not None:
+            self._journal_call.stop()
+            self._journal.close()
+
+
+class EventsProxyServer(TxZmqServerComponent):
+    """
+    An events server that relays events with a native zmq proxy.
+
+    Messages are moved from the PULL to the PUB socket by libzmq in a
+    dedicated thread, so neither the reactor nor the GIL are in the way of
+    each message. The reactor is still needed for CURVE authentication, and
+    runs the control of the proxy and, if configured, its metrics and its
+    journal.
+
+    Metrics and the journal are fed by a capture socket, in which the proxy
+    publishes a copy of each message it relays. Copies are dropped, rather
+    than delaying the relay, while the reactor is behind, so they are best
+    effort.
+
+    Messages are relayed unchanged, so the proxy can't convert between
+    legacy and multipart messages, nor serve content filters.
+    """
+
+    def __init__(self, emit_addr, reg_addr, path_prefix=None, factory=None,
+                 enable_curve=True, metrics=False, stats_interval=None,
+                 journal_dir=None):
+        """
+        Initialize the events server and start relaying events.
+
+        :param emit_addr: The address in which to receive events from clients.
+        :type emit_addr: str
+        :param reg_addr: The address to which publish events to clients.
+        :type reg_addr: str
+        :param metrics: Whether to keep traffic and latency metrics. The
+                        proxy can't tell how many subscribers each message
+                        reaches, so deliveries are not counted.
+        :type metrics: bool
+        :param stats_interval: If not None, publish the metrics as an
+                               EVENTS_SERVER_STATS event every this many
+                               seconds.
+        :type stats_interval: float
+        :param journal_dir: If not None, the directory of a journal in which
+                            to append the relayed messages.
+        :type journal_dir: str
+        """
+        TxZmqServerComponent.__init__(self, path_prefix=path_prefix,
+                                      factory=factory,
+                                      enable_curve=enable_curve)
+        context = self._factory.context
+        self._pull, self.pull_port = self._zmq_bind_socket(
+            zmq.PULL, emit_addr)
+        self._pub, self.pub_port = self._zmq_bind_socket(zmq.PUB, reg_addr)
+        prefix = "inproc://leap.common.events.proxy.%s" % uuid.uuid4()
+        # the proxy thread is steered through a control socket
+        self._control = context.socket(zmq.PAIR)
+        self._control.bind(prefix + ".control")
+        # the capture socket, and the reactor's end of it
+        self._capture = None
+        self._captured = None
+        self._metrics = None
+        if metrics or stats_interval is not None:
+            self._metrics = Metrics()
+        self._journal = None
+        self._journal_call = None
+        if journal_dir is not None:
+            self._journal = journal.Journal(journal_dir)
+            self._journal_call = LoopingCall(self._journal.flush)
+            self._journal_call.start(journal.FLUSH_INTERVAL, now=False)
+        if self._metrics is not None or self._journal is not None:
+            self._capture = context.socket(zmq.PUB)
+            self._capture.bind(prefix + ".capture")
+            self._captured = ZmqCaptureConnection(
+                self._factory, prefix + ".capture")
+            self._captured.onPull = self._onCapture
+        # stats are published through the proxy, from a socket connected
+        # to the PULL one in process, which needs no CURVE
+        self._stats_push = None
+        self._stats_call = None
+        if stats_interval is not None:
+            self._pull.bind(prefix + ".pull")
+            self._stats_push = context.socket(zmq.PUSH)
+            self._stats_push.connect(prefix + ".pull")
+            self._stats_call = LoopingCall(self._publishStats)
+            self._stats_call.start(stats_interval, now=False)
+        self._thread = threading.Thread(
+            target=self._run, args=(prefix + ".control",),
+            name="EventsProxyServer")
+        self._thread.daemon = True
+        self._thread.start()
+
+        # the factory terminates its context on reactor shutdown, which
+        # would block forever while our sockets are open
+        self._trigger = reactor.addSystemEventTrigger(
+            'before', 'shutdown', self._onReactorShutdown)
+
+    def _run(self, control_addr):
+        """
+        Relay events until told to stop.
+
+        :param control_addr: The address of the control socket.
+        :type control_addr: str
+        """
+        control = self._factory.context.socket(zmq.PAIR)
+        control.connect(control_addr)
+        try:
+            zmq.proxy_steerable(
+                self._pull, self._pub, self._capture, control)
+        except zmq.ContextTerminated:
+            pass
+        finally:
+            control.close(linger=0)
+            self._pull.close(linger=0)
+            self._pub.close(linger=0)
+            if self._capture is not None:
+                self._capture.close(linger=0)
+        logger.debug("Proxy finished.")
+
+    def pause(self):
+        """
+        Stop relaying events. Clients' messages wait in the sockets, up to
+        their high-water marks, until the proxy is resumed.
+        """
+        self._control.send(b'PAUSE')
+
+    def resume(self):
+        """
+        Resume relaying events.
+        """
+        self._control.send(b'RESUME')
+
+    def _onCapture(self, message):
+        """
+        Callback executed when the copy of a relayed message arrives in the
+        capture socket.
+
+        :param message: The frames of the message.
+        :type message: list of zmq.Frame
+        """
+        if len(message) == 1 and message[0].bytes in _PROXY_COMMANDS:
+            # the proxy captures the commands it is sent, too
+            return
+        if self._journal is not None:
+            self._journal.append(message)
+        if self._metrics is None:
+            return
+        if len(message) == 1:
+            topic, body = wire.unpack([message[0].bytes])
+        else:
+            topic, body = message[0].bytes, message[1]
+        self._metrics.received(
+            _eventLabel(topic), len(body), emitted=wire.timestamp(message))
+
+    def _proxyStatistics(self):
+        """
+        Return the number of messages and bytes that went through each
+        socket of the proxy, as counted by libzmq.
+
+        :return: The counts by name, or None if libzmq does not count them.
+        :rtype: dict
+        """
+        if zmq_capabilities().zmq_version < (4, 3):
+            return None
+        if not self._thread.is_alive():
+            return None
+        # drop the replies that arrived too late for a previous request
+        while self._control.poll(0):
+            self._control.recv_multipart()
+        self._control.send(b'STATISTICS')
+        if not self._control.poll(STATISTICS_TIMEOUT * 1000):
+            return None
+        counts = [_STATISTIC.unpack(frame)[0]
+                  for frame in self._control.recv_multipart()]
+        names = []
+        for side in ('frontend', 'backend'):
+            names.extend('%s_%s' % (side, name) for name in (
+                'messages_in', 'bytes_in', 'messages_out', 'bytes_out'))
+        return dict(zip(names, counts))
+
+    def stats(self):
+        """
+        Return the traffic and latency metrics of the server, with the
+        counts of the proxy's sockets under 'proxy'.
+
+        :return: The metrics per event label, or None if the server does
+                 not keep metrics.
+        :rtype: dict
+        """
+        if self._metrics is None:
+            return None
+        stats = self._metrics.snapshot()
+        statistics = self._proxyStatistics()
+        if statistics is not None:
+            stats['proxy'] = statistics
+        return stats
+
+    def _publishStats(self):
+        """
+        Publish the server's metrics. The proxy does not know the
+        subscriptions, so they are always published.
+        """
+        event = catalog.EVENTS_SERVER_STATS
+        body = codecs.encode((self.stats(),), codecs.JSON)
+        for topic in (event.label_topic, event.topic):
+            try:
+                self._stats_push.send_multipart(
+                    wire.pack(topic, body), zmq.NOBLOCK)
+            except zmq.Again:
+                logger.warning("Dropping stats, the proxy is behind.")
+
+    def _onReactorShutdown(self):
+        # the trigger can't be removed from within itself
+        self._trigger = None
+        self.shutdown()
+
+    def shutdown(self):
+        """
+        Stop relaying events and close the server's sockets.
         """
-        event, content = message[0].split(b"\0", 1)
-        logger.debug("Publishing event: %s" % event)
-        self._pub.publish(content, tag=event)
+        if self._trigger is not None:
+            reactor.removeSystemEventTrigger(self._trigger)
+            self._trigger = None
+        if not self._thread.is_alive():
+            return
+        if self._stats_call is not None and self._stats_call.running:
+            self._stats_call.stop()
+        if self._captured is not None:
+            self._captured.shutdown()
+        self._control.send(b'TERMINATE')
+        self._thread.join()
+        self._control.close(linger=0)
+        if self._stats_push is not None:
+            self._stats_push.close(linger=0)
+        if self._journal is not None:
+            self._journal_call.stop()
+            self._journal.close()
@@ -26,16 +26,21 @@ server that it wants to be notified whenever events of that type are sent by
 some other client.
 """
 import logging
-import pickle
 
 import txzmq
+import zmq
+
+from twisted.internet import reactor
 
 from leap.common.events.zmq_components import TxZmqClientComponent
 from leap.common.events.client import EventsClient
+from leap.common.events.client import EMIT_RETRY_DELAY
 from leap.common.events.client import configure_client
 from leap.common.events.server import EMIT_ADDR
 from leap.common.events.server import REG_ADDR
-from leap.common.events import catalog
+from leap.common.events import codec as codecs
+from leap.common.events import executors
+from leap.common.events import wire
 
 
 logger = logging.getLogger(__name__)
@@ -58,58 +63,172 @@ class EventsTxClient(TxZmqClientComponent, EventsClient):
     """
 
     def __init__(self, emit_addr=EMIT_ADDR, reg_addr=REG_ADDR,
-                 path_prefix=None, factory=None, enable_curve=True):
+                 path_prefix=None, factory=None, enable_curve=True,
+                 codec=codecs.DEFAULT_CODEC, accept_codecs=None,
+                 legacy_wire=False, suppress_unobserved=False,
+                 compact_topics=False, coalesce_window=None,
+                 deliver_locally=False, metrics=False, heartbeat=None,
+                 emit_buffer=None, emit_overflow=executors.DROP_OLDEST,
+                 priority_emit_addr=None, priority_reg_addr=None,
+                 blob_threshold=None):
         """
         Initialize the events client.
+
+        :raises ValueError: if emit_overflow is executors.BLOCK, as waiting
+                            for room in the buffer would block the reactor
+                            that makes room in it.
         """
+        if emit_buffer is not None and emit_overflow == executors.BLOCK:
+            raise ValueError("The twisted client can't block on emit.")
         TxZmqClientComponent.__init__(
             self, path_prefix=path_prefix, factory=factory,
             enable_curve=enable_curve)
-        EventsClient.__init__(self, emit_addr, reg_addr)
+        EventsClient.__init__(
+            self, emit_addr, reg_addr, codec=codec,
+            accept_codecs=accept_codecs, legacy_wire=legacy_wire,
+            suppress_unobserved=suppress_unobserved,
+            compact_topics=compact_topics, coalesce_window=coalesce_window,
+            deliver_locally=deliver_locally, metrics=metrics,
+            heartbeat=heartbeat, emit_buffer=emit_buffer,
+            emit_overflow=emit_overflow,
+            priority_emit_addr=priority_emit_addr,
+            priority_reg_addr=priority_reg_addr,
+            blob_threshold=blob_threshold)
+        self._coalesce_call = None
+        self._flush_call = None
         # connect SUB first, otherwise we might miss some event sent from this
         # same client
-        self._sub = self._zmq_connect(txzmq.ZmqSubConnection, reg_addr)
-        self._sub.gotMessage = self._gotMessage
+        self._priority_sub = self._priority_push = None
+        if priority_reg_addr is not None:
+            self._priority_sub = self._zmq_connect(
+                txzmq.ZmqSubConnection, priority_reg_addr,
+                options=self._socket_options(priority_reg_addr))
+            self._priority_sub.messageReceived = self._on_message
+            self._priority_push = self._zmq_connect(
+                txzmq.ZmqPushConnection, priority_emit_addr,
+                options=self._socket_options(priority_emit_addr))
+        self._sub = self._zmq_connect(
+            txzmq.ZmqSubConnection, reg_addr,
+            options=self._socket_options(reg_addr),
+            monitor=self._monitor_for(reg_addr))
+        # handle the raw frames, txzmq only understands two frame messages
+        if self._priority_sub is not None:
+            self._sub.messageReceived = self._on_normal_message
+        else:
+            self._sub.messageReceived = self._on_message
+        if suppress_unobserved:
+            self._sub.subscribe(wire.SUBSCRIPTIONS_TOPIC)
+
+        self._push = self._zmq_connect(
+            txzmq.ZmqPushConnection, emit_addr,
+            options=self._socket_options(emit_addr),
+            monitor=self._monitor_for(emit_addr))
+
+    def _monitor_for(self, address):
+        """
+        Return the function that tracks the socket connected to an address,
+        or None if the client does not track its connections.
+
+        :param address: The address.
+        :type address: str
 
-        self._push = self._zmq_connect(txzmq.ZmqPushConnection, emit_addr)
+        :rtype: callable(dict)
+        """
+        if not self._monitored:
+            return None
+        return lambda event: self._on_monitor_event(address, event)
 
-    def _gotMessage(self, msg, tag):
+    def _on_normal_message(self, frames):
         """
-        Handle an incoming event.
+        Handle a message of the normal lane, after the messages waiting in
+        the high priority lane.
 
-        :param msg: The incoming message.
-        :type msg: list(str)
+        :param frames: The frames of the received message.
+        :type frames: list of str
         """
-        event = getattr(catalog, tag)
-        content = pickle.loads(msg)
-        self._handle_event(event, content)
+        self._priority_sub.doRead()
+        self._on_message(frames)
 
-    def _subscribe(self, tag):
+    def _subscribe(self, tag, priority=False):
         """
         Subscribe to a tag on the zmq SUB socket.
 
         :param tag: The tag to be subscribed.
         :type tag: str
+        :param priority: Whether to subscribe in the high priority lane.
+        :type priority: bool
         """
-        self._sub.subscribe(tag)
+        sub = self._priority_sub if priority else self._sub
+        sub.subscribe(tag)
 
-    def _unsubscribe(self, tag):
+    def _unsubscribe(self, tag, priority=False):
         """
         Unsubscribe from a tag on the zmq SUB socket.
 
         :param tag: The tag to be unsubscribed.
         :type tag: str
+        :param priority: Whether to unsubscribe in the high priority lane.
+        :type priority: bool
         """
-        self._sub.unsubscribe(tag)
+        sub = self._priority_sub if priority else self._sub
+        sub.unsubscribe(tag)
 
-    def _send(self, data):
+    def _send(self, frames, priority=False):
         """
-        Send data through PUSH socket.
+        Send a message through PUSH socket.
 
-        :param data: The data to be sent.
-        :type event: str
+        :param frames: The frames of the message to be sent.
+        :type frames: list of str
+        :param priority: Whether to send it through the high priority lane,
+                         which is not buffered.
+        :type priority: bool
+        """
+        if priority:
+            self._priority_push.send(frames)
+            return
+        if self._outbox is None:
+            self._push.send(frames)
+            return
+        self._outbox.put(frames)
+        self._flush_outbox()
+
+    def _flush_outbox(self):
+        """
+        Send the events in the outbox through the PUSH socket, while it is
+        connected and has room for them.
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            # already waiting for room
+            return
+        while self._links[self._emit_addr] and len(self._outbox):
+            frames = self._outbox.get(timeout=0)
+            try:
+                self._push.send(frames)
+            except zmq.Again:
+                # no room yet, keep it first in line and try again later
+                self._outbox.put(frames, force=True, front=True)
+                self._flush_call = reactor.callLater(
+                    EMIT_RETRY_DELAY, self._flush_outbox)
+                return
+
+    def _resume_emitting(self):
         """
-        self._push.send(data)
+        Send the events buffered while the client was disconnected.
+        """
+        if self._outbox is not None:
+            self._flush_outbox()
+
+    def _call_later(self, delay, function):
+        """
+        Call a function in the reactor after a delay.
+
+        :param delay: The delay, in seconds.
+        :type delay: float
+        :param function: The function to be called.
+        :type function: callable
+        """
+        # only the coalescing flush is ever scheduled
+        self._coalesce_call = reactor.callLater(delay, function)
 
     def _run_callback(self, callback, event, content):
         """
@@ -125,15 +244,26 @@ class EventsTxClient(TxZmqClientComponent, EventsClient):
         callback(event, *content)
 
     def shutdown(self):
+        if self._coalesce_call is not None and self._coalesce_call.active():
+            self._coalesce_call.cancel()
+        self._flush_coalesced(force=True)
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        if self._outbox is not None and len(self._outbox):
+            logger.warning("Dropped %d buffered events on shutdown."
+                           % self._outbox.clear())
+        self._zmq_unmonitor()
         EventsClient.shutdown(self)
 
 
-def register(event, callback, uid=None, replace=False):
+def register(event, callback, uid=None, replace=False, replay=None,
+             key=None, where=None):
     """
     Register a callback to be executed when an event is received.
 
-    :param event: The event that triggers the callback.
-    :type event: str
+    :param event: The event that triggers the callback, or a wildcard
+                  matching all the events that trigger it.
+    :type event: Event or Prefix
     :param callback: The callback to be executed.
     :type callback: callable(event, content)
     :param uid: The callback uid.
@@ -141,6 +271,15 @@ def register(event, callback, uid=None, replace=False):
     :param replace: Wether an eventual callback with same ID should be
                     replaced.
     :type replace: bool
+    :param replay: The kind of replay of the events kept by the server,
+                   'recent' or 'last', or None for no replay.
+    :type replay: str
+    :param key: If not None, only run the callback for events about this
+                key, usually the uuid or userid of an account.
+    :type key: hashable
+    :param where: If not None, the values the content of an event must have,
+                  by position, for the callback to be run.
+    :type where: dict
 
     :return: The callback uid.
     :rtype: str
@@ -149,7 +288,8 @@ def register(event, callback, uid=None, replace=False):
             identified by the given uid and replace is False.
     """
     return EventsTxClient.instance().register(
-        event, callback, uid=uid, replace=replace)
+        event, callback, uid=uid, replace=replace, replay=replay, key=key,
+        where=where)
 
 
 def unregister(event, uid=None):
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# wire.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Framing of events on the wire.
+
+Events travel as multipart messages, with the topic (the event label) in
+the first frame and the encoded content in the second one. This lets the
+server relay messages without looking into, or copying, the content.
+
+Legacy messages carry both in a single frame, joined by a null byte. They
+are still understood, and can still be produced for peers that predate
+multipart messages.
+
+A third frame, if present, identifies the client that emitted the event, so
+that client can recognize its own events when they come back from the server.
+A fourth frame, if present, carries the time the event was emitted, used to
+measure delivery latency. When a message carries a timestamp but no origin,
+the third frame is empty. Peers that don't know about these frames ignore
+them.
+
+The server also publishes the set of topics that have subscribers under
+SUBSCRIPTIONS_TOPIC, one topic per frame, whenever that set changes.
+
+A client asks the server to replay the messages it keeps by subscribing to a
+request topic, made of REPLAY_TOPIC, the kind of replay, a random token and
+the topic (or topic prefix) of the wanted events. The server publishes each
+replayed message with the head of the request (all but the wanted topic)
+prepended to its topic, so only the requesting client receives it, and then
+a single frame message with the request topic, to mark the end of the replay.
+
+A client may subscribe to the messages of an event whose content has some
+values in some positions, with a filter topic made of FILTER_TOPIC, the
+canonical JSON encoding of the sorted (position, value) pairs, a null byte,
+the topic of the event and another null byte. The server decodes the content
+of the messages of events with filtered subscribers and publishes a copy of
+each one under the filter topics it matches, besides the plain message.
+
+Remote calls go through the server's RPC socket, a zmq ROUTER, to which
+callers and responders connect DEALER sockets. Each message starts with a
+frame telling its kind:
+
+    responder -> server: RPC_READY, topic
+    responder -> server: RPC_GONE, topic
+    caller    -> server: RPC_REQUEST, call id, topic, body
+    server -> responder: RPC_REQUEST, caller, call id, topic, body
+    responder -> server: RPC_REPLY, caller, call id, status, body
+    server    -> caller: RPC_REPLY, call id, status, body
+
+The server routes each request to one of the responders ready for its topic,
+and each reply to the caller only. The body of a request is the encoded
+arguments of the call, and that of a reply the encoded result, or error
+message, as a one element tuple.
+"""
+import json
+import numbers
+import struct
+import uuid
+
+
+SEPARATOR = b'\0'
+
+SUBSCRIPTIONS_TOPIC = b'\0subscriptions'
+
+REPLAY_TOPIC = b'\0replay'
+
+FILTER_TOPIC = b'\0filter'
+
+# kinds of replay: the recent messages, or the last value of each event
+REPLAY_RECENT = b'r'
+REPLAY_LAST = b'l'
+
+_REPLAY_HEAD_SIZE = len(REPLAY_TOPIC) + 1 + 16
+
+RPC_READY = b'\x01'
+RPC_GONE = b'\x02'
+RPC_REQUEST = b'\x03'
+RPC_REPLY = b'\x04'
+
+# statuses of replies
+RPC_OK = b'\x00'
+RPC_ERROR = b'\x01'
+RPC_NO_RESPONDER = b'\x02'
+RPC_BUSY = b'\x03'
+
+
+_TIMESTAMP = struct.Struct('>d')
+
+
+def pack(topic, body, legacy=False, origin=None, timestamp=None):
+    """
+    Build the frames of a message.
+
+    :param topic: The topic of the message.
+    :type topic: str
+    :param body: The encoded content of the event.
+    :type body: str
+    :param legacy: Whether to join topic and body in a single frame.
+    :type legacy: bool
+    :param origin: The id of the emitting client, if it must be able to
+                   recognize the message. Ignored for legacy messages.
+    :type origin: str
+    :param timestamp: When the event was emitted, in seconds since the
+                      epoch. Ignored for legacy messages.
+    :type timestamp: float
+
+    :return: The frames of the message.
+    :rtype: list of str
+    """
+    if legacy:
+        return [topic + SEPARATOR + body]
+    if timestamp is not None:
+        return [topic, body, origin or b'', _TIMESTAMP.pack(timestamp)]
+    if origin is not None:
+        return [topic, body, origin]
+    return [topic, body]
+
+
+def unpack(frames):
+    """
+    Extract topic and body from the frames of a message.
+
+    :param frames: The frames of the message.
+    :type frames: list of str
+
+    :return: The topic and the body of the message.
+    :rtype: (str, str)
+    """
+    if len(frames) > 1:
+        return frames[0], frames[1]
+    topic, body = frames[0].split(SEPARATOR, 1)
+    return topic, body
+
+
+def origin(frames):
+    """
+    Return the id of the client that emitted a message.
+
+    :param frames: The frames of the message.
+    :type frames: list of str
+
+    :return: The id of the emitting client, or None if the message does not
+             carry it.
+    :rtype: str
+    """
+    if len(frames) > 2 and frames[2]:
+        return frames[2]
+    return None
+
+
+def timestamp(frames):
+    """
+    Return the time a message was emitted.
+
+    :param frames: The frames of the message.
+    :type frames: list of str
+
+    :return: The emission time, in seconds since the epoch, or None if the
+             message does not carry it.
+    :rtype: float
+    """
+    if len(frames) > 3:
+        try:
+            return _TIMESTAMP.unpack(bytes(frames[3]))[0]
+        except struct.error:
+            return None
+    return None
+
+
+def replay_request(kind, topic):
+    """
+    Build the topic that requests a replay.
+
+    :param kind: The kind of replay, REPLAY_RECENT or REPLAY_LAST.
+    :type kind: str
+    :param topic: The topic, or topic prefix, of the events to replay.
+    :type topic: str
+
+    :return: The request topic.
+    :rtype: str
+    """
+    return REPLAY_TOPIC + kind + uuid.uuid4().bytes + topic
+
+
+def parse_replay_request(request):
+    """
+    Split a replay request topic.
+
+    :param request: The request topic.
+    :type request: str
+
+    :return: The head of the request, the kind of replay and the topic of
+             the events to replay, or None if the request is malformed.
+    :rtype: (str, str, str)
+    """
+    if len(request) < _REPLAY_HEAD_SIZE:
+        return None
+    head = request[:_REPLAY_HEAD_SIZE]
+    kind = head[len(REPLAY_TOPIC):len(REPLAY_TOPIC) + 1]
+    return head, kind, request[_REPLAY_HEAD_SIZE:]
+
+
+def replay_head(topic):
+    """
+    Return the head of the replay request a replayed message answers.
+
+    :param topic: The topic of the replayed message.
+    :type topic: str
+
+    :return: The head of the request, or None if the topic is not that of a
+             replayed message.
+    :rtype: str
+    """
+    if not topic.startswith(REPLAY_TOPIC) or len(topic) < _REPLAY_HEAD_SIZE:
+        return None
+    return topic[:_REPLAY_HEAD_SIZE]
+
+
+def filter_topic(topic, fields):
+    """
+    Build the topic of the messages of an event whose content matches a
+    filter.
+
+    :param topic: The topic of the event.
+    :type topic: str
+    :param fields: The values the content must have, by position.
+    :type fields: dict
+
+    :return: The filter topic.
+    :rtype: str
+
+    :raises ValueError: if there are no fields, or a position is not a non
+                        negative integer.
+    :raises TypeError: if a value can't be encoded as JSON.
+    """
+    if not fields:
+        raise ValueError("A filter needs at least one field.")
+    for position in fields:
+        if (not isinstance(position, numbers.Integral)
+                or isinstance(position, bool) or position < 0):
+            raise ValueError("Bad position in filter: %r" % (position,))
+    spec = json.dumps(
+        [[position, fields[position]] for position in sorted(fields)],
+        separators=(',', ':'), sort_keys=True)
+    return FILTER_TOPIC + spec.encode('ascii') + SEPARATOR + topic + SEPARATOR
+
+
+def parse_filter_topic(filtered):
+    """
+    Split a filter topic.
+
+    :param filtered: The filter topic.
+    :type filtered: str
+
+    :return: The topic of the event and the values the content must have,
+             by position, or None if the topic is not a well formed filter
+             topic.
+    :rtype: (str, dict)
+    """
+    if (not filtered.startswith(FILTER_TOPIC)
+            or not filtered.endswith(SEPARATOR)):
+        return None
+    spec, _, topic = filtered[len(FILTER_TOPIC):-1].partition(SEPARATOR)
+    try:
+        fields = dict(json.loads(spec.decode('ascii')))
+        # only canonical topics match the ones the server builds
+        if filter_topic(topic, fields) != filtered:
+            return None
+    except (ValueError, TypeError):
+        return None
+    return topic, fields
+
+
+def content_filter_topic(topic, positions, content):
+    """
+    Build the filter topic some content of an event matches, looking at some
+    positions.
+
+    :param topic: The topic of the event.
+    :type topic: str
+    :param positions: The positions the filter looks at.
+    :type positions: tuple of int
+    :param content: The content of the event.
+    :type content: tuple
+
+    :return: The filter topic, or None if the content has no such positions,
+             or values that can't be encoded.
+    :rtype: str
+    """
+    try:
+        return filter_topic(
+            topic, dict((position, content[position])
+                        for position in positions))
+    except (LookupError, TypeError, ValueError):
+        return None
@@ -21,21 +21,24 @@ import os
 import logging
 import txzmq
 import re
+import uuid
 
 from abc import ABCMeta
 
 try:
-    import zmq.auth
     from leap.common.events.auth import TxAuthenticator
     from leap.common.events.auth import TxAuthenticationRequest
 except ImportError:
     pass
 
 from txzmq.connection import ZmqEndpoint, ZmqEndpointType
+from zmq import constants
+from zmq.utils.monitor import parse_monitor_message
 
 from leap.common.config import flags, get_path_prefix
 from leap.common.zmq_utils import zmq_has_curve
-from leap.common.zmq_utils import maybe_create_and_get_certificates
+from leap.common.zmq_utils import get_keyring
+from leap.common.zmq_utils import MONITOR_EVENTS
 from leap.common.zmq_utils import PUBLIC_KEYS_PREFIX
 
 logger = logging.getLogger(__name__)
@@ -45,6 +48,28 @@ ADDRESS_RE = re.compile("^([a-z]+)://([^:]+):?(\d+)?$")
 LOCALHOST_ALLOWED = '127.0.0.1'
 
 
+class ZmqMonitorConnection(txzmq.ZmqConnection):
+    """
+    A PAIR connection that receives the events of a monitored socket.
+
+    Subclass or override :meth:`onEvent`.
+    """
+
+    socketType = constants.PAIR
+
+    def messageReceived(self, message):
+        self.onEvent(parse_monitor_message(message))
+
+    def onEvent(self, event):
+        """
+        Called when the monitored socket reports an event.
+
+        :param event: The event, as returned by parse_monitor_message().
+        :type event: dict
+        """
+        raise NotImplementedError(self)
+
+
 class TxZmqComponent(object):
     """
     A twisted-powered zmq events component.
@@ -67,6 +92,7 @@ class TxZmqComponent(object):
             self._factory = factory
         self._config_prefix = os.path.join(path_prefix, "leap", "events")
         self._connections = []
+        self._monitors = []
         if enable_curve:
             self.use_curve = zmq_has_curve()
         else:
@@ -89,7 +115,8 @@ class TxZmqComponent(object):
         :param address: The address to bind to.
         :type address: str
 
-        :return: The binded connection and port.
+        :return: The binded connection and port (None for non tcp
+                 addresses).
         :rtype: (txzmq.ZmqConnection, int)
         """
         proto, addr, port = ADDRESS_RE.search(address).groups()
@@ -98,13 +125,7 @@ class TxZmqComponent(object):
         connection = connClass(self._factory)
 
         if self.use_curve:
-            socket = connection.socket
-
-            public, secret = maybe_create_and_get_certificates(
-                self._config_prefix, self.component_type)
-            socket.curve_publickey = public
-            socket.curve_secretkey = secret
-            self._start_authentication(connection.socket)
+            self._configure_curve_server(connection.socket)
 
         if proto == 'tcp' and int(port) == 0:
             connection.endpoints.extend([endpoint])
@@ -112,9 +133,50 @@ class TxZmqComponent(object):
         else:
             connection.addEndpoints([endpoint])
 
-        return connection, int(port)
+        return connection, int(port) if port else None
+
+    def _zmq_bind_socket(self, socktype, address):
+        """
+        Bind a plain zmq socket, not managed by the reactor, to an address.
+
+        The socket is created in the factory's context, so CURVE
+        authentication is still handled by the reactor's authenticator.
+
+        :param socktype: The ZMQ socket type.
+        :type socktype: int
+        :param address: The address to bind to.
+        :type address: str
 
-    def _zmq_connect(self, connClass, address):
+        :return: The binded socket and port (None for non tcp addresses).
+        :rtype: (zmq.Socket, int)
+        """
+        proto, addr, port = ADDRESS_RE.search(address).groups()
+        socket = self._factory.context.socket(socktype)
+
+        if self.use_curve:
+            self._configure_curve_server(socket)
+
+        if proto == 'tcp' and int(port) == 0:
+            port = socket.bind_to_random_port('tcp://%s' % addr)
+        else:
+            socket.bind(address)
+
+        return socket, int(port) if port else None
+
+    def _configure_curve_server(self, socket):
+        """
+        Set the component's keys on a socket and authenticate its peers.
+
+        :param socket: The socket to be configured.
+        :type socket: zmq.Socket
+        """
+        public, secret = get_keyring(self._config_prefix).keypair(
+            self.component_type)
+        socket.curve_publickey = public
+        socket.curve_secretkey = secret
+        self._start_authentication(socket)
+
+    def _zmq_connect(self, connClass, address, options=(), monitor=None):
         """
         Connect to an address.
 
@@ -122,6 +184,11 @@ class TxZmqComponent(object):
         :type connClass: txzmq.ZmqConnection
         :param address: The address to connect to.
         :type address: str
+        :param options: Socket options to set before connecting.
+        :type options: list of (int, int)
+        :param monitor: If not None, a function called with each connection
+                        event of the socket, see MONITOR_EVENTS.
+        :type monitor: callable(dict)
 
         :return: The binded connection.
         :rtype: txzmq.ZmqConnection
@@ -131,19 +198,47 @@ class TxZmqComponent(object):
 
         if self.use_curve:
             socket = connection.socket
-            public, secret = maybe_create_and_get_certificates(
-                self._config_prefix, self.component_type)
-            server_public_file = os.path.join(
-                self._config_prefix, PUBLIC_KEYS_PREFIX, "server.key")
-
-            server_public, _ = zmq.auth.load_certificate(server_public_file)
+            keyring = get_keyring(self._config_prefix)
+            public, secret = keyring.keypair(self.component_type)
             socket.curve_publickey = public
             socket.curve_secretkey = secret
-            socket.curve_serverkey = server_public
+            socket.curve_serverkey = keyring.public_key("server")
 
+        for option, value in options:
+            connection.socket.setsockopt(option, value)
+        if monitor is not None:
+            # before connecting, so no event is missed
+            self._zmq_monitor(connection, monitor)
         connection.addEndpoints([endpoint])
         return connection
 
+    def _zmq_monitor(self, connection, callback):
+        """
+        Report the connection events of a connection's socket.
+
+        :param connection: The monitored connection.
+        :type connection: txzmq.ZmqConnection
+        :param callback: The function called with each event.
+        :type callback: callable(dict)
+        """
+        address = "inproc://events-monitor-%s" % uuid.uuid4().hex
+        connection.socket.monitor(address, MONITOR_EVENTS)
+        monitor = ZmqMonitorConnection(self._factory)
+        monitor.onEvent = callback
+        monitor.addEndpoints([ZmqEndpoint(ZmqEndpointType.connect, address)])
+        # the descriptor may not signal what arrived while connecting, and
+        # then it would not signal the later events either
+        monitor.doRead()
+        self._monitors.append(monitor)
+
+    def _zmq_unmonitor(self):
+        """
+        Close the connections that receive socket events.
+        """
+        for monitor in self._monitors:
+            monitor.shutdown()
+        self._monitors = []
+
     def _start_authentication(self, socket):
 
         if not TxZmqComponent._auth:
@@ -17,11 +17,13 @@
 """
 Utilities to handle ZMQ certificates.
 """
+import collections
 import os
 import logging
 import platform
 import stat
 import shutil
+import threading
 
 import zmq
 
@@ -40,8 +42,71 @@ KEYS_PREFIX = "zmq_certificates"
 PUBLIC_KEYS_PREFIX = os.path.join(KEYS_PREFIX, "public_keys")
 PRIVATE_KEYS_PREFIX = os.path.join(KEYS_PREFIX, "private_keys")
 
+# the socket events reported to monitors of connections to the events server
+MONITOR_EVENTS = zmq.EVENT_CONNECTED | zmq.EVENT_DISCONNECTED
 
-def zmq_has_curve():
+
+ZmqCapabilities = collections.namedtuple(
+    'ZmqCapabilities', [
+        'zmq_version',  # libzmq version, as a tuple
+        'pyzmq_version',  # pyzmq version, as a tuple
+        'curve',  # auth and CurveZMQ security
+        'ipc',  # ipc:// transport
+        'heartbeat',  # ZMTP heartbeats (ZMQ_HEARTBEAT_IVL and friends)
+        'xpub_verbose',  # XPUB sockets reporting repeated subscriptions
+    ])
+
+
+_capabilities = None
+_capabilities_lock = threading.Lock()
+
+
+def zmq_capabilities(refresh=False):
+    """
+    Return the features of the ZMQ library in use.
+
+    The library is probed once per process, on the first call.
+
+    :param refresh: Whether to probe the library again.
+    :type refresh: bool
+
+    :rtype: ZmqCapabilities
+    """
+    global _capabilities
+    with _capabilities_lock:
+        if _capabilities is None or refresh:
+            _capabilities = _probe_capabilities()
+            logger.debug("ZMQ capabilities: %s" % (_capabilities,))
+        return _capabilities
+
+
+def _probe_capabilities():
+    """
+    Probe the features of the ZMQ library in use.
+
+    :rtype: ZmqCapabilities
+    """
+    zmq_version = zmq.zmq_version_info()
+    pyzmq_version = zmq.pyzmq_version_info()
+    has = None
+    if pyzmq_version >= (14, 1, 0) and zmq_version >= (4, 1):
+        has = zmq.has
+    if has is not None:
+        ipc = has('ipc')
+    else:
+        ipc = platform.system() != "Windows"
+    return ZmqCapabilities(
+        zmq_version=zmq_version,
+        pyzmq_version=pyzmq_version,
+        curve=_probe_curve(zmq_version, pyzmq_version, has),
+        ipc=ipc,
+        heartbeat=(zmq_version >= (4, 2)
+                   and hasattr(zmq, 'HEARTBEAT_IVL')),
+        xpub_verbose=(zmq_version >= (4, 0)
+                      and hasattr(zmq, 'XPUB_VERBOSE')))
+
+
+def _probe_curve(zmq_version, pyzmq_version, has):
     """
     Return whether the current ZMQ has support for auth and CurveZMQ security.
 
@@ -57,11 +122,8 @@ def zmq_has_curve():
         # TODO: curve is not working on windows #7919
         return False
 
-    zmq_version = zmq.zmq_version_info()
-    pyzmq_version = zmq.pyzmq_version_info()
-
-    if pyzmq_version >= (14, 1, 0) and zmq_version >= (4, 1):
-        return zmq.has('curve')
+    if has is not None:
+        return has('curve')
 
     if pyzmq_version < (14, 1, 0):
         return False
@@ -79,8 +141,17 @@ def zmq_has_curve():
     return True
 
 
+def zmq_has_curve():
+    """
+    Return whether the current ZMQ has support for auth and CurveZMQ security.
+
+    :rtype: bool
+    """
+    return zmq_capabilities().curve
+
+
 def assert_zmq_has_curve():
-    leap_assert(zmq_has_curve, "CurveZMQ not supported!")
+    leap_assert(zmq_has_curve(), "CurveZMQ not supported!")
 
 
 def maybe_create_and_get_certificates(basedir, name):
@@ -88,21 +159,135 @@ def maybe_create_and_get_certificates(basedir, name):
     Generate the needed ZMQ certificates for backend/frontend communication if
     needed.
     """
-    assert_zmq_has_curve()
-    private_keys_dir = os.path.join(basedir, PRIVATE_KEYS_PREFIX)
-    private_key = os.path.join(
-        private_keys_dir, name + ".key_secret")
-    if not os.path.isfile(private_key):
-        mkdir_p(private_keys_dir)
-        zmq.auth.create_certificates(private_keys_dir, name)
+    return get_keyring(basedir).keypair(name)
+
+
+def _signature(path):
+    """
+    Return what tells whether a file changed since it was last read.
+    """
+    st = os.stat(path)
+    return st.st_mtime, st.st_size, st.st_ino
+
+
+class Keyring(object):
+    """
+    An in-memory cache of the ZMQ certificates under a directory.
+
+    Keys are read from disk the first time they are needed, and read again
+    only if their files change.
+    """
+
+    def __init__(self, basedir):
+        """
+        Initialize the keyring.
+
+        :param basedir: The directory holding the certificates.
+        :type basedir: str
+        """
+        self.basedir = basedir
+        self.private_keys_dir = os.path.join(basedir, PRIVATE_KEYS_PREFIX)
+        self.public_keys_dir = os.path.join(basedir, PUBLIC_KEYS_PREFIX)
+        self._lock = threading.Lock()
+        # path -> (signature, certificate)
+        self._cache = {}
+        self._public_keys = (None, {})
+
+    def _load(self, path):
+        signature = _signature(path)
+        cached = self._cache.get(path)
+        if cached is None or cached[0] != signature:
+            cached = (signature, zmq.auth.load_certificate(path))
+            self._cache[path] = cached
+        return cached[1]
+
+    def keypair(self, name):
+        """
+        Return a keypair, generating it if needed.
+
+        :param name: The name of the keypair (e.g. "client" or "server").
+        :type name: str
+
+        :return: The public and secret keys.
+        :rtype: (str, str)
+        """
+        assert_zmq_has_curve()
+        private_key = os.path.join(
+            self.private_keys_dir, name + ".key_secret")
+        with self._lock:
+            if not os.path.isfile(private_key):
+                self._create(name, private_key)
+            return self._load(private_key)
+
+    def _create(self, name, private_key):
+        mkdir_p(self.private_keys_dir)
+        zmq.auth.create_certificates(self.private_keys_dir, name)
         # set permissions to: 0700 (U:rwx G:--- O:---)
         os.chmod(private_key, stat.S_IRUSR | stat.S_IWUSR)
         # move public key to public keys directory
-        public_keys_dir = os.path.join(basedir, PUBLIC_KEYS_PREFIX)
         old_public_key = os.path.join(
-            private_keys_dir, name + ".key")
+            self.private_keys_dir, name + ".key")
         new_public_key = os.path.join(
-            public_keys_dir, name + ".key")
-        mkdir_p(public_keys_dir)
+            self.public_keys_dir, name + ".key")
+        mkdir_p(self.public_keys_dir)
         shutil.move(old_public_key, new_public_key)
-    return zmq.auth.load_certificate(private_key)
+
+    def public_key(self, name):
+        """
+        Return a public key from the public keys directory.
+
+        :param name: The name of the key (e.g. "server").
+        :type name: str
+
+        :return: The public key.
+        :rtype: str
+        """
+        path = os.path.join(self.public_keys_dir, name + ".key")
+        with self._lock:
+            return self._load(path)[0]
+
+    def public_keys(self):
+        """
+        Return all the keys in the public keys directory, in the format
+        used by zmq.auth.
+
+        :return: A dict mapping each public key to True.
+        :rtype: dict
+        """
+        with self._lock:
+            try:
+                names = sorted(
+                    name for name in os.listdir(self.public_keys_dir)
+                    if name.endswith(".key"))
+            except OSError:
+                names = []
+            paths = [os.path.join(self.public_keys_dir, name)
+                     for name in names]
+            signature = tuple(
+                (path, _signature(path)) for path in paths)
+            if signature != self._public_keys[0]:
+                keys = dict(
+                    (self._load(path)[0], True) for path in paths)
+                self._public_keys = (signature, keys)
+            return self._public_keys[1]
+
+
+_keyrings = {}
+_keyrings_lock = threading.Lock()
+
+
+def get_keyring(basedir):
+    """
+    Return the keyring shared by all users of a certificates directory.
+
+    :param basedir: The directory holding the certificates.
+    :type basedir: str
+
+    :rtype: Keyring
+    """
+    basedir = os.path.abspath(basedir)
+    with _keyrings_lock:
+        keyring = _keyrings.get(basedir)
+        if keyring is None:
+            keyring = _keyrings[basedir] = Keyring(basedir)
+        return keyring
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# test_asyncioclient.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the asyncio events client.
+"""
+import shutil
+import tempfile
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import zmq
+
+from txzmq import ZmqFactory
+
+from leap.common.events import catalog
+from leap.common.events import executors
+from leap.common.events import server
+from leap.common.events import wire
+
+try:
+    import asyncio
+    from leap.common.events import asyncioclient
+except ImportError:
+    asyncioclient = None
+
+
+@unittest.skipIf(asyncioclient is None, "asyncio is not available")
+class EventsAsyncioClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.factory = ZmqFactory()
+        # the proxy server runs without the reactor
+        self.server = server.ensure_server(
+            emit_addr="tcp://127.0.0.1:0",
+            reg_addr="tcp://127.0.0.1:0",
+            factory=self.factory, enable_curve=False, proxy=True)
+        self.servers = [self.server]
+        self.clients = []
+        self.client = self._client()
+
+    def tearDown(self):
+        for client in self.clients:
+            self._call(client.shutdown)
+        for running in self.servers:
+            running.shutdown()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def _client(self, **options):
+        client = self._call(
+            asyncioclient.EventsAsyncioClient,
+            emit_addr="tcp://127.0.0.1:%d" % self.server.pull_port,
+            reg_addr="tcp://127.0.0.1:%d" % self.server.pub_port,
+            enable_curve=False, **options)
+        self.clients.append(client)
+        return client
+
+    def _wait(self, awaitable):
+        return self.loop.run_until_complete(asyncio.wait_for(awaitable, 5))
+
+    def _call(self, function, *args, **kwargs):
+        """
+        Call a function from within the running loop, as zmq.asyncio
+        sockets require, and return its result.
+        """
+        result = self.loop.create_future()
+
+        def call():
+            try:
+                result.set_result(function(*args, **kwargs))
+            except Exception as e:
+                result.set_exception(e)
+
+        self.loop.call_soon(call)
+        return self._wait(result)
+
+    def _subscribed(self, event, client=None):
+        # the proxy server does not report subscriptions, so this just
+        # gives the subscription some time to reach it
+        client = client or self.client
+        subscribed = self._call(client.subscribed, event, timeout=0.2)
+        self.assertFalse(self._wait(subscribed))
+
+    def _register(self, event, callback, client=None):
+        client = client or self.client
+        # likewise, registering waits for the timeout
+        return self._wait(
+            self._call(client.register, event, callback, timeout=0.2))
+
+    def test_callbacks_run_in_loop_thread(self):
+        event = catalog.CLIENT_UID
+        received = self.loop.create_future()
+
+        def cbk(event, *content):
+            received.set_result((event, content, threading.current_thread()))
+
+        self._register(event, cbk)
+        self._wait(self._call(self.client.emit, event, "some-uid"))
+        self.assertEqual(
+            self._wait(received),
+            (event, ("some-uid",), threading.current_thread()))
+
+    def test_subscribe_iterates_over_events(self):
+        event = catalog.MAIL_UNREAD_MESSAGES
+        subscription = self.client.subscribe(event)
+        self._subscribed(event)
+        for i in range(3):
+            self._call(self.client.emit, event, "user@example.org", i)
+        items = [self._wait(self._call(subscription.__anext__))
+                 for _ in range(3)]
+        self.assertEqual(
+            items, [(event, ("user@example.org", i)) for i in range(3)])
+        subscription.close()
+        self.assertNotIn(event, self.client.callbacks)
+        self.assertRaises(StopAsyncIteration, subscription.__anext__)
+
+    def test_subscribed_resolves_on_server_report(self):
+        event = catalog.CLIENT_UID
+        self.client.register(event, lambda *_: None)
+        subscribed = self._call(self.client.subscribed, event, timeout=5)
+        self.assertFalse(subscribed.done())
+        # as published by the events server when subscriptions change
+        self._call(self.client._on_message,
+                   [wire.SUBSCRIPTIONS_TOPIC, event.label_topic])
+        self.assertTrue(self._wait(subscribed))
+
+    def test_register_waits_for_server_report(self):
+        event = catalog.CLIENT_UID
+        registered = self._call(
+            self.client.register, event, lambda *_: None, uid="uid",
+            timeout=5)
+        self.assertIn(event, self.client.callbacks)
+        self.assertFalse(registered.done())
+        self._call(self.client._on_message,
+                   [wire.SUBSCRIPTIONS_TOPIC, event.label_topic])
+        self.assertEqual(self._wait(registered), "uid")
+
+    def test_callback_errors_dont_stop_other_callbacks(self):
+        event = catalog.CLIENT_UID
+        received = self.loop.create_future()
+
+        def failing(event, *content):
+            raise ValueError("boom")
+
+        self.client.register(event, failing, uid="failing")
+        self.client.register(
+            event, lambda *_: received.set_result(True), uid="other")
+        self._call(
+            self.client._handle_event, event, ("some-uid",))
+        self.assertTrue(self._wait(received))
+
+    def test_priority_lane(self):
+        lane = server.ensure_server(
+            emit_addr="tcp://127.0.0.1:0",
+            reg_addr="tcp://127.0.0.1:0",
+            factory=self.factory, enable_curve=False, proxy=True)
+        self.servers.append(lane)
+        client = self._client(
+            priority_emit_addr="tcp://127.0.0.1:%d" % lane.pull_port,
+            priority_reg_addr="tcp://127.0.0.1:%d" % lane.pub_port)
+        self.assertTrue(client._on_priority_lane(catalog.RAISE_WINDOW))
+        received = self.loop.create_future()
+        self._register(
+            catalog.RAISE_WINDOW,
+            lambda event, *content: received.set_result(content),
+            client=client)
+        self._wait(self._call(client.emit, catalog.RAISE_WINDOW, "now"))
+        self.assertEqual(self._wait(received), ("now",))
+
+    def test_heartbeat(self):
+        client = self._client(heartbeat=0.5)
+        self.assertEqual(client._push.getsockopt(zmq.HEARTBEAT_IVL), 500)
+        self.assertEqual(client._sub.getsockopt(zmq.HEARTBEAT_IVL), 500)
+
+    def test_emit_buffer(self):
+        # nothing listens on the server's addresses
+        self.server.shutdown()
+        self.servers = []
+        client = self._client(emit_buffer=2)
+        for i in range(3):
+            self._wait(self._call(client.emit, catalog.CLIENT_UID, str(i)))
+        self.assertFalse(client.connected)
+        self.assertEqual(len(client._outbox), 2)
+        self.assertEqual(client._outbox.dropped, 1)
+
+    def test_block_overflow_is_refused(self):
+        self.assertRaises(
+            ValueError, self._client, emit_buffer=1,
+            emit_overflow=executors.BLOCK)
+
+    def test_blob_threshold(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        client = self._client(path_prefix=tempdir, blob_threshold=100)
+        received = self.loop.create_future()
+        self._register(
+            catalog.CLIENT_UID,
+            lambda event, *content: received.set_result(content),
+            client=client)
+        self._wait(self._call(client.emit, catalog.CLIENT_UID, "x" * 1000))
+        self.assertEqual(self._wait(received), ("x" * 1000,))
+        self.assertIsNotNone(client._blobs)
+
+    def test_shutdown_terminates_context(self):
+        client = self.clients.pop()
+        self._call(client.shutdown)
+        self.assertTrue(client._context.closed)
+
+    def test_close_ends_pending_iteration(self):
+        subscription = self.client.subscribe(catalog.CLIENT_UID)
+        pending = self._call(subscription.__anext__)
+        subscription.close()
+        self.assertRaises(StopAsyncIteration, self._wait, pending)
+
+
+if __name__ == "__main__":
+    unittest.main()
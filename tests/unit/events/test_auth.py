@@ -59,3 +59,19 @@ class ZmqAuthTestCase(unittest.TestCase, BaseLeapTest):
             self.failUnlessEqual(certs[certs.keys()[0]], True)
 
         return _wait(0.1).addCallback(check)
+
+    def test_curve_auth_sees_new_keys(self):
+        self.auth_req.start()
+        public_keys_dir = os.path.join(self._config_prefix, PUBLIC_KEYS_PREFIX)
+        self.auth_req.configure_curve(domain="*", location=public_keys_dir)
+
+        def check(ignored):
+            certs = self.authenticator.authenticator.certs['*']
+            self.assertTrue(certs.get(self.public))
+            # keys created after configuring are accepted too
+            client, _ = maybe_create_and_get_certificates(
+                self._config_prefix, 'client')
+            self.assertTrue(certs.get(client))
+            self.assertFalse(certs.get(b'unknown'))
+
+        return _wait(0.1).addCallback(check)
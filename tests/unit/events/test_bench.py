@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+# test_bench.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the events load benchmark.
+"""
+import json
+
+from twisted.trial import unittest
+
+from leap.common.events import bench
+
+
+class BenchLoadTestCase(unittest.TestCase):
+
+    def _check(self, result, emitters=1, subscribers=1, count=200):
+        self.assertEqual(result['emitted'], emitters * count)
+        self.assertEqual(result['delivered'], emitters * count * subscribers)
+        self.assertEqual(result['lost'], 0)
+        self.assertTrue(result['throughput'] > 0)
+        self.assertTrue(
+            0 <= result['latency']['p50'] <= result['latency']['p99'])
+        self.assertTrue(result['cpu_per_message'] > 0)
+        # results must be machine readable
+        json.dumps(result)
+
+    def test_threaded_client(self):
+        self._check(bench.bench_load(
+            transport=bench.TCP, client=bench.THREADED, count=200,
+            timeout=10))
+
+    def test_twisted_client_processes(self):
+        self._check(bench.bench_load(
+            transport=bench.IPC, client=bench.TWISTED, emitters=2,
+            subscribers=2, count=200, processes=True, timeout=10),
+            emitters=2, subscribers=2)
+
+    def test_receive(self):
+        sizes = (100, 100 * 1024)
+        for zero_copy in (False, True):
+            results = bench.bench_receive(
+                sizes=sizes, volume=100 * 1024, zero_copy=zero_copy,
+                timeout=10)
+            self.assertEqual(sorted(results), list(sizes))
+            for rate, throughput in results.values():
+                self.assertTrue(rate > 0 and throughput > 0)
+
+    def test_format_results(self):
+        result = bench.bench_load(count=10, timeout=10)
+        self.assertIn("msg/s", bench.format_results([result]))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+# test_blobs.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the shared memory side channel of large events.
+"""
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from leap.common.events import blobs
+from leap.common.events import codec as codecs
+from leap.common.events.errors import CodecError
+
+
+class BlobStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tempdir, blobs.DIRECTORY)
+        self.store = blobs.BlobStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_roundtrip(self):
+        content = (u'x' * 100000, 1)
+        handle = self.store.put(codecs.encode(content))
+        self.assertTrue(blobs.is_handle(handle))
+        self.assertTrue(blobs.is_handle(memoryview(handle)))
+        self.assertTrue(len(handle) < 64)
+        self.assertEqual(self.store.load(handle), content)
+        # other stores of the directory read it too
+        other = blobs.BlobStore(self.directory)
+        self.assertEqual(other.load(memoryview(handle)), content)
+
+    def test_not_a_handle(self):
+        for name in (codecs.PICKLE, codecs.MARSHAL):
+            self.assertFalse(blobs.is_handle(
+                codecs.encode(('a',), codec=name)))
+
+    def test_accept(self):
+        handle = self.store.put(codecs.encode(('a',), codec=codecs.PICKLE))
+        self.assertRaises(
+            CodecError, self.store.load, handle, accept={codecs.JSON})
+
+    def test_malformed_handle(self):
+        self.assertRaises(CodecError, self.store.load, blobs.TAG + b'../x')
+        self.assertRaises(CodecError, self.store.load, blobs.TAG)
+
+    def test_expired(self):
+        handle = self.store.put(codecs.encode(('a',)))
+        self.assertEqual(self.store.sweep(time.time() + blobs.TTL + 1), 1)
+        self.assertRaises(CodecError, self.store.load, handle)
+
+    def test_sweep_keeps_recent(self):
+        handle = self.store.put(codecs.encode(('a',)))
+        self.assertEqual(self.store.sweep(), 0)
+        self.assertEqual(self.store.load(handle), ('a',))
+
+    def test_sweep_missing_directory(self):
+        store = blobs.BlobStore(os.path.join(self.tempdir, 'missing'))
+        self.assertEqual(store.sweep(), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
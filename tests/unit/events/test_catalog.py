@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# test_catalog.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the events catalog.
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from leap.common.events import catalog
+
+
+class CatalogTestCase(unittest.TestCase):
+
+    def test_all_events_are_registered(self):
+        for label in catalog.EVENTS:
+            event = getattr(catalog, label)
+            self.assertEqual(event.label, label)
+            self.assertIs(catalog.get_event(label), event)
+            self.assertIs(catalog.get_event(event.topic), event)
+            self.assertIs(catalog.get_event_by_id(event.id), event)
+
+    def test_ids_are_stable(self):
+        # ids go on the wire, they must not change between releases
+        self.assertEqual(catalog.CLIENT_UID.id, 0xdf9227a3)
+        self.assertEqual(catalog.CLIENT_UID.topic, b'\x01\xdf\x92\x27\xa3')
+
+    def test_events_compare_by_id(self):
+        event = catalog.Event("CLIENT_UID")
+        self.assertEqual(event, catalog.CLIENT_UID)
+        self.assertEqual(hash(event), hash(catalog.CLIENT_UID))
+        self.assertNotEqual(event, catalog.CLIENT_SESSION_ID)
+        self.assertEqual({event: 1}[catalog.CLIENT_UID], 1)
+
+    def test_duplicate_event(self):
+        self.assertRaises(ValueError, catalog.add_event, "CLIENT_UID")
+
+    def test_unknown_topic(self):
+        self.assertIsNone(catalog.get_event(b"NOT_AN_EVENT"))
+
+    def test_coalesce_key(self):
+        event = catalog.SOLEDAD_SYNC_RECEIVE_STATUS
+        content = ({"uuid": "some-uuid", "userid": "user@example.org"},
+                   {"received": 1, "total": 2})
+        self.assertEqual(event.coalesce_key(content), "some-uuid")
+        self.assertEqual(catalog.VPN_STATUS_CHANGED.coalesce_key(("on",)),
+                         ("on",))
+        self.assertRaises(LookupError, event.coalesce_key, ())
+        self.assertIsNone(catalog.CLIENT_UID.coalesce)
+
+    def test_content_key(self):
+        content = ({"uuid": "some-uuid", "userid": "user@example.org"},)
+        self.assertEqual(
+            catalog.SOLEDAD_DONE_DATA_SYNC.content_key(content), "some-uuid")
+        self.assertEqual(
+            catalog.MAIL_UNREAD_MESSAGES.content_key(("user@example.org", 3)),
+            "user@example.org")
+        self.assertRaises(
+            LookupError, catalog.MAIL_UNREAD_MESSAGES.content_key, ())
+
+    def test_priority(self):
+        self.assertEqual(
+            catalog.PRIORITY_HIGH, catalog.RAISE_WINDOW.priority)
+        self.assertEqual(
+            catalog.PRIORITY_NORMAL, catalog.CLIENT_UID.priority)
+        self.assertRaises(
+            ValueError, catalog.add_event, "SOME_EVENT", priority="urgent")
+
+    def test_match(self):
+        self.assertIs(catalog.match("CLIENT_UID"), catalog.CLIENT_UID)
+        prefix = catalog.match("SMTP_*")
+        self.assertEqual(prefix, catalog.Prefix("SMTP_"))
+        self.assertEqual(prefix.label_topic, b"SMTP_")
+        self.assertTrue(prefix.matches(catalog.SMTP_START_SIGN))
+        self.assertFalse(prefix.matches(catalog.IMAP_SERVICE_STARTED))
+        self.assertEqual(
+            prefix.events(),
+            sorted([getattr(catalog, label) for label in catalog.EVENTS
+                    if label.startswith("SMTP_")],
+                   key=lambda event: event.label))
+        self.assertRaises(KeyError, catalog.match, "NOT_AN_EVENT")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# test_codec.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the events codec module.
+"""
+import pickle
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from leap.common.events import codec
+from leap.common.events.errors import CodecError
+
+
+class CodecTestCase(unittest.TestCase):
+
+    def test_roundtrip(self):
+        content = ("user@example.org", 42)
+        for name in codec.available_codecs():
+            data = codec.encode(content, name)
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(data[:1], codec.get_codec(name).tag)
+            self.assertEqual(codec.decode(data), content)
+
+    def test_json_non_ascii(self):
+        content = (u"caf\xe9", u"\u2603")
+        data = codec.encode(content, codec.JSON)
+        self.assertIsInstance(data, bytes)
+        self.assertEqual(codec.decode(data), content)
+
+    def test_decode_memoryview(self):
+        # received frames are decoded without copying them out
+        content = ("user@example.org", 42)
+        for name in codec.available_codecs():
+            data = codec.encode(content, name)
+            self.assertEqual(codec.decode(memoryview(data)), content)
+        self.assertRaises(CodecError, codec.decode, memoryview(b'\x00foo'))
+
+    def test_pickle_is_compatible_with_plain_pickle(self):
+        content = ("uuid", "user@example.org")
+        # old clients must be able to load what new clients send...
+        self.assertEqual(
+            pickle.loads(codec.encode(content, codec.PICKLE)), content)
+        # ... and new clients must be able to load what old clients send
+        self.assertEqual(codec.decode(pickle.dumps(content)), content)
+
+    def test_accept(self):
+        data = codec.encode((1, 2), codec.PICKLE)
+        self.assertRaises(
+            CodecError, codec.decode, data, accept=set([codec.JSON]))
+        self.assertEqual(
+            codec.decode(data, accept=set([codec.PICKLE])), (1, 2))
+
+    def test_safe_codecs(self):
+        safe = codec.safe_codecs()
+        self.assertIn(codec.JSON, safe)
+        self.assertNotIn(codec.PICKLE, safe)
+        self.assertNotIn(codec.MARSHAL, safe)
+        data = codec.encode((1, 2), codec.PICKLE)
+        self.assertRaises(CodecError, codec.decode, data, accept=safe)
+
+    def test_unknown(self):
+        self.assertRaises(CodecError, codec.decode, b'\x00foo')
+        self.assertRaises(CodecError, codec.get_codec, "nope")
+
+    def test_register_duplicate_tag(self):
+        self.assertRaises(
+            CodecError, codec.register_codec,
+            codec.Codec("other", b'J', repr, eval))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -19,26 +19,60 @@ Tests for the events framework
 """
 import os
 import logging
+import shutil
+import tempfile
+import threading
+
+from mock import Mock
+from mock import patch
 
 from twisted.internet.reactor import callFromThread
 from twisted.trial import unittest
 from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
 
+import txzmq
 from txzmq import ZmqFactory
 
+from leap.common.events import blobs
 from leap.common.events import server
 from leap.common.events import client
 from leap.common.events import flags
 from leap.common.events import txclient
+from leap.common.events import wire
 from leap.common.events import catalog
+from leap.common.events import codec
+from leap.common.events import executors
+from leap.common.events import journal
 from leap.common.events.errors import CallbackAlreadyRegisteredError
+from leap.common.events.metrics import UNKNOWN_LABEL
 
 
 if 'DEBUG' in os.environ:
     logging.basicConfig(level=logging.DEBUG)
 
 
-class EventsGenericClientTestCase(object):
+@defer.inlineCallbacks
+def wait_until(condition, timeout=5):
+    """
+    Wait until a condition is true, polling it from the reactor.
+    """
+    waited = 0
+    while not condition():
+        if waited > timeout:
+            raise AssertionError("Timed out waiting for condition.")
+        yield task.deferLater(reactor, 0.01, lambda: None)
+        waited += 0.01
+
+
+class EventsBaseTestCase(object):
+    """
+    Run a server and configure a client, with the options of the test case.
+    """
+
+    _client_options = {}
+    _server_options = {}
 
     def setUp(self):
         flags.set_events_enabled(True)
@@ -47,17 +81,42 @@ class EventsGenericClientTestCase(object):
             emit_addr="tcp://127.0.0.1:0",
             reg_addr="tcp://127.0.0.1:0",
             factory=self.factory,
-            enable_curve=False)
+            enable_curve=False,
+            **self._server_options)
 
         self._client.configure_client(
             emit_addr="tcp://127.0.0.1:%d" % self._server.pull_port,
             reg_addr="tcp://127.0.0.1:%d" % self._server.pub_port,
-            factory=self.factory, enable_curve=False)
+            factory=self.factory, enable_curve=False,
+            **self._client_options)
 
     def tearDown(self):
         flags.set_events_enabled(False)
+        # stop the client thread too, instead of leaving it connected to a
+        # port a later server might reuse
+        self._client.shutdown()
+        self._server.shutdown()
         self.factory.shutdown()
-        self._client.instance().reset()
+
+    def _subscribed(self, event):
+        """
+        Wait until the server knows of the subscriptions of the callbacks of
+        an event, so the events emitted from now on reach them. The proxy
+        server does not report its subscriptions, so they are just given
+        some time to reach it.
+        """
+        if self._server_options.get('proxy'):
+            return task.deferLater(reactor, 0.1, lambda: None)
+        topics = set(topic for topic, _ in
+                     self._client.instance()._wanted_topics(event))
+        return wait_until(lambda: topics <= self._server.subscriptions)
+
+
+class EventsGenericClientTestCase(EventsBaseTestCase):
+    """
+    The behaviour every client has, whatever its options. Test cases of the
+    options that change how events are sent or received run it too.
+    """
 
     def test_client_register(self):
         """
@@ -119,6 +178,7 @@ class EventsGenericClientTestCase(object):
             self._client.register,
             event, lambda event, _: None, uid=1, replace=False)
 
+    @defer.inlineCallbacks
     def test_register_more_than_one_callback_works(self):
         """
         Make sure clients can replace already registered callbacks.
@@ -132,14 +192,15 @@ class EventsGenericClientTestCase(object):
         d2 = defer.Deferred()
 
         def cbk2(event, _):
-            return d2.callback(event)
+            return callFromThread(d2.callback, event)
 
         self._client.register(event, cbk1)
         self._client.register(event, cbk2)
+        yield self._subscribed(event)
         self._client.emit(event, None)
-        d = defer.gatherResults([d1, d2])
-        return d
+        yield defer.gatherResults([d1, d2])
 
+    @defer.inlineCallbacks
     def test_client_receives_signal(self):
         """
         Ensure clients can receive signals.
@@ -151,9 +212,11 @@ class EventsGenericClientTestCase(object):
             callFromThread(d.callback, event)
 
         self._client.register(event, cbk)
+        yield self._subscribed(event)
         self._client.emit(event, None)
-        return d
+        yield d
 
+    @defer.inlineCallbacks
     def test_client_unregister_all(self):
         """
         Test that the client can unregister all events for one signal.
@@ -172,9 +235,11 @@ class EventsGenericClientTestCase(object):
         event2 = catalog.CLIENT_SESSION_ID
         self._client.register(
             event2, lambda ev, _: callFromThread(d.callback, None))
+        yield self._subscribed(event2)
         self._client.emit(event2, None)
-        return d
+        yield d
 
+    @defer.inlineCallbacks
     def test_client_unregister_by_uid(self):
         """
         Test that the client can unregister an event by uid.
@@ -189,8 +254,124 @@ class EventsGenericClientTestCase(object):
             event, lambda ev, _: callFromThread(d.callback, None))
         # unregister by uid and emit the event
         self._client.unregister(event, uid=uid)
+        yield self._subscribed(event)
         self._client.emit(event, None)
-        return d
+        yield d
+
+    @defer.inlineCallbacks
+    def test_client_receives_prefix(self):
+        """
+        Ensure callbacks registered for a prefix receive all matching events.
+        """
+        prefix = catalog.match("SMTP_*")
+        received = []
+        d = defer.Deferred()
+
+        def receive(event):
+            received.append(event)
+            if len(received) == 2:
+                d.callback(received)
+
+        def cbk(event, _):
+            callFromThread(receive, event)
+
+        self._client.register(prefix, cbk)
+        yield self._subscribed(prefix)
+        self._client.emit(catalog.CLIENT_UID, None)
+        self._client.emit(catalog.SMTP_START_SIGN, None)
+        self._client.emit(catalog.SMTP_END_SIGN, None)
+        # executors may run the callbacks of different events concurrently
+        self.assertEqual(
+            set((yield d)),
+            set([catalog.SMTP_START_SIGN, catalog.SMTP_END_SIGN]))
+
+    def test_prefix_and_exact_callbacks(self):
+        """
+        Ensure an event runs both exact and prefix callbacks, and that
+        unregistering a prefix keeps the exact ones.
+        """
+        instance = self._client.instance()
+        event = catalog.SMTP_START_SIGN
+
+        def cbk(event, _):
+            pass
+
+        self._client.register(event, cbk, uid="exact")
+        self._client.register(catalog.match("SMTP_*"), cbk, uid="prefix")
+        self._client.register(catalog.match("SMTP_START_*"), cbk,
+                              uid="longer")
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(event, ())],
+            ["exact", "longer", "prefix"])
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(
+                catalog.SMTP_END_SIGN, ())],
+            ["prefix"])
+        self._client.unregister(catalog.match("SMTP_*"))
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(event, ())],
+            ["exact", "longer"])
+        self.assertEqual(
+            instance._callbacks_for(catalog.SMTP_END_SIGN, ()), ())
+
+    @defer.inlineCallbacks
+    def test_client_receives_keyed(self):
+        """
+        Ensure callbacks registered for a key only run for events about it.
+        """
+        event = catalog.SOLEDAD_DONE_DATA_SYNC
+        received = []
+        d = defer.Deferred()
+
+        def cbk(event, account):
+            received.append(account['userid'])
+            callFromThread(d.callback, received)
+
+        self._client.register(event, cbk, key='uuid-b')
+        yield self._subscribed(event)
+        self._client.emit(event, {'uuid': 'uuid-a', 'userid': 'a'})
+        self._client.emit(event, {'uuid': 'uuid-b', 'userid': 'b'})
+        self.assertEqual((yield d), ['b'])
+
+    def test_keyed_callbacks(self):
+        """
+        Ensure keyed callbacks are indexed by the key of the content.
+        """
+        instance = self._client.instance()
+        event = catalog.MAIL_UNREAD_MESSAGES
+
+        def cbk(event, *content):
+            pass
+
+        self._client.register(event, cbk, uid="any")
+        self._client.register(event, cbk, uid="a", key="a@example.org")
+        self._client.register(
+            catalog.match("MAIL_*"), cbk, uid="b", key="b@example.org")
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(
+                event, ("a@example.org", 1))],
+            ["any", "a"])
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(
+                event, ("b@example.org", 1))],
+            ["any", "b"])
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(event, ())],
+            ["any"])
+        # replacing without a key runs it for any content
+        self._client.register(event, cbk, uid="a", replace=True)
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(
+                event, ("c@example.org", 1))],
+            ["any", "a"])
+        # keyed callbacks run after the ones for any content, even if they
+        # were registered before them
+        self._client.register(event, cbk, uid="c", key="c@example.org")
+        self._client.register(event, cbk, uid="later")
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(
+                event, ("c@example.org", 1))],
+            ["any", "a", "later", "c"])
 
 
 class EventsTxClientTestCase(EventsGenericClientTestCase, unittest.TestCase):
@@ -201,3 +382,898 @@ class EventsTxClientTestCase(EventsGenericClientTestCase, unittest.TestCase):
 class EventsClientTestCase(EventsGenericClientTestCase, unittest.TestCase):
 
     _client = client
+
+    def test_shutdown_runs_queued_callbacks(self):
+        """
+        Ensure shutting down runs the queued callbacks, and stops the thread.
+        """
+        instance = self._client.instance()
+        instance.ensure_client()
+        ran = []
+        for i in range(10):
+            instance._loop.add_callback(ran.append, i)
+        self.assertEqual(instance.shutdown(timeout=5), 0)
+        self.assertEqual(ran, list(range(10)))
+        self.assertFalse(instance.is_alive())
+
+
+class EventsClientBatchingTestCase(
+        EventsGenericClientTestCase, unittest.TestCase):
+
+    _client = client
+    _client_options = {'batch_size': 10, 'batch_linger': 0.01}
+
+    def test_batched_events_keep_order(self):
+        """
+        Ensure batched events are all delivered, in emission order.
+        """
+        event = catalog.SOLEDAD_SYNC_SEND_STATUS
+        received = []
+        d = defer.Deferred()
+
+        def cbk(event, i):
+            received.append(i)
+            if len(received) == 25:
+                callFromThread(d.callback, received)
+
+        self._client.register(event, cbk)
+        for i in range(25):
+            self._client.emit(event, i)
+        d.addCallback(self.assertEqual, list(range(25)))
+        return d
+
+    def test_full_batch_is_flushed_right_away(self):
+        """
+        Ensure a full batch is flushed without waiting for the linger
+        timeout, and that a single flush is scheduled for it.
+        """
+        scheduled = []
+
+        class Loop(object):
+
+            def add_callback(self, callback, *args):
+                scheduled.append((callback, args))
+
+            def call_later(self, delay, callback):
+                pass
+
+        instance = client.EventsClientThread(
+            "tcp://127.0.0.1:0", "tcp://127.0.0.1:0", enable_curve=False,
+            batch_size=2, batch_linger=60)
+        loop = instance._loop = Loop()
+        instance._send([b'topic', b'0'])
+        # another thread queued an event in between
+        instance._pending.append([b'topic', b'1'])
+        for i in range(2, 5):
+            instance._send([b'topic', b'%d' % i])
+        self.assertEqual(
+            [(loop.call_later, (60, instance._flush)),
+             (instance._flush, ())],
+            scheduled)
+
+
+class EventsClientJsonCodecTestCase(
+        EventsGenericClientTestCase, unittest.TestCase):
+
+    _client = client
+    _client_options = {'codec': 'json', 'accept_codecs': ['json']}
+
+
+class EventsTxClientLegacyWireTestCase(
+        EventsGenericClientTestCase, unittest.TestCase):
+
+    _client = txclient
+    _client_options = {'legacy_wire': True}
+    _server_options = {'legacy_wire': True}
+
+
+class EventsClientLegacyWireTestCase(
+        EventsGenericClientTestCase, unittest.TestCase):
+
+    _client = client
+    _client_options = {'legacy_wire': True}
+    _server_options = {'legacy_wire': True}
+
+
+class EventsTxClientProxyServerTestCase(
+        EventsGenericClientTestCase, unittest.TestCase):
+
+    _client = txclient
+    _server_options = {'proxy': True, 'metrics': True, 'stats_interval': 0.05}
+
+    @defer.inlineCallbacks
+    def test_proxy_metrics(self):
+        """
+        Ensure the proxy server counts the events it relays.
+        """
+        event = catalog.CLIENT_UID
+        received = []
+        self._client.register(event, lambda ev, n: received.append(n))
+        # the proxy server does not report subscriptions
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        for i in range(3):
+            self._client.emit(event, i)
+        yield wait_until(lambda: len(received) == 3)
+        yield wait_until(
+            lambda: event.label in self._server.stats()['events'])
+        stats = self._server.stats()
+        self.assertEqual(stats['events'][event.label]['received'], 3)
+        if 'proxy' in stats:
+            self.assertTrue(stats['proxy']['frontend_messages_in'] >= 3)
+
+    def test_proxy_stats_event(self):
+        """
+        Ensure the proxy server publishes its metrics.
+        """
+        d = defer.Deferred()
+
+        def cbk(event, stats):
+            if not d.called:
+                d.callback(stats)
+
+        self._client.register(catalog.EVENTS_SERVER_STATS, cbk)
+        d.addCallback(lambda stats: self.assertIn('events', stats))
+        return d
+
+    @defer.inlineCallbacks
+    def test_pause(self):
+        """
+        Ensure events wait while the proxy is paused.
+        """
+        event = catalog.CLIENT_UID
+        received = []
+        self._client.register(event, lambda ev, n: received.append(n))
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self._server.pause()
+        self._client.emit(event, 1)
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual([], received)
+        self._server.resume()
+        yield wait_until(lambda: received == [1])
+
+    def test_shutdown_removes_trigger(self):
+        self._server.shutdown()
+        self.assertIsNone(self._server._trigger)
+        self.assertEqual([], self.flushWarnings())
+
+
+class EventsClientProxyServerTestCase(
+        EventsGenericClientTestCase, unittest.TestCase):
+
+    _client = client
+    _server_options = {'proxy': True}
+
+
+class EventsSuppressionTestCase(EventsBaseTestCase):
+
+    _client_options = {'suppress_unobserved': True}
+
+    @defer.inlineCallbacks
+    def test_unobserved_events_are_not_sent(self):
+        """
+        Ensure events nobody is subscribed to are not sent to the server.
+        """
+        instance = self._client.instance()
+        if hasattr(instance, 'ensure_client'):
+            instance.ensure_client()
+        yield wait_until(lambda: instance._observed is not None)
+
+        sent = []
+        send = instance._send
+        instance._send = (
+            lambda frames, priority=False:
+            sent.append(frames) or send(frames, priority))
+
+        event = catalog.CLIENT_UID
+        self._client.emit(event, None)
+        self.assertEqual(sent, [])
+
+        d = defer.Deferred()
+        self._client.register(
+            event, lambda ev, _: callFromThread(d.callback, None))
+        yield wait_until(lambda: b'CLIENT_UID' in self._server.subscriptions)
+        self._client.emit(event, None)
+        self.assertEqual(len(sent), 1)
+        yield d
+
+
+class EventsTxClientSuppressionTestCase(
+        EventsSuppressionTestCase, unittest.TestCase):
+
+    _client = txclient
+
+
+class EventsClientSuppressionTestCase(
+        EventsSuppressionTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsCoalescingTestCase(EventsBaseTestCase):
+
+    _client_options = {'coalesce_window': 0.2}
+
+    def test_state_values_are_coalesced(self):
+        """
+        Ensure that only the first and latest values of each state are
+        delivered when values are emitted faster than the coalescing window.
+        """
+        event = catalog.SOLEDAD_SYNC_RECEIVE_STATUS
+        received = {'a': [], 'b': []}
+        d = defer.Deferred()
+
+        def cbk(event, user_data, status):
+            received[user_data['uuid']].append(status)
+            if all(values[-1:] == [49] for values in received.values()):
+                callFromThread(d.callback, None)
+
+        self._client.register(event, cbk)
+        for i in range(50):
+            for uuid in received:
+                self._client.emit(event, {'uuid': uuid}, i)
+
+        def check(_):
+            self.assertEqual(received, {'a': [0, 49], 'b': [0, 49]})
+
+        d.addCallback(check)
+        return d
+
+
+class EventsTxClientCoalescingTestCase(
+        EventsCoalescingTestCase, unittest.TestCase):
+
+    _client = txclient
+
+
+class EventsClientCoalescingTestCase(
+        EventsCoalescingTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsLocalDeliveryTestCase(EventsGenericClientTestCase):
+
+    _client_options = {'deliver_locally': True}
+
+    @defer.inlineCallbacks
+    def test_local_delivery(self):
+        """
+        Ensure local callbacks get the emitted objects once, and that other
+        clients still get the event.
+        """
+        event = catalog.CLIENT_UID
+        remote = txzmq.ZmqSubConnection(self.factory, txzmq.ZmqEndpoint(
+            txzmq.ZmqEndpointType.connect,
+            "tcp://127.0.0.1:%d" % self._server.pub_port))
+        self.addCleanup(remote.shutdown)
+        remote_d = defer.Deferred()
+        remote.messageReceived = remote_d.callback
+        remote.subscribe(event.label_topic)
+        yield wait_until(lambda: event.label in self._server.subscriptions)
+
+        received = []
+        self._client.register(event, lambda ev, obj: received.append(obj))
+        obj = {'some': 'content'}
+        self._client.emit(event, obj)
+        frames = yield remote_d
+        self.assertEqual(codec.decode(frames[1]), (obj,))
+        self.assertEqual(wire.origin(frames), self._client.instance()._origin)
+        yield wait_until(lambda: received)
+        self.assertIs(received[0], obj)
+        # give the server the time to send the event back
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(len(received), 1)
+
+
+class EventsTxClientLocalDeliveryTestCase(
+        EventsLocalDeliveryTestCase, unittest.TestCase):
+
+    _client = txclient
+
+
+class EventsClientLocalDeliveryTestCase(
+        EventsLocalDeliveryTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsMetricsTestCase(EventsBaseTestCase):
+
+    _client_options = {'metrics': True}
+    _server_options = {'metrics': True, 'stats_interval': 0.05}
+
+    @defer.inlineCallbacks
+    def test_metrics(self):
+        """
+        Ensure clients and server count the events they handle.
+        """
+        event = catalog.CLIENT_UID
+        received = []
+        self._client.register(event, lambda ev, n: received.append(n))
+        self._client.register(event, lambda ev, n: None)
+        yield wait_until(lambda: event.label in self._server.subscriptions)
+        for i in range(3):
+            self._client.emit(event, i)
+        yield wait_until(lambda: len(received) == 3)
+
+        stats = self._client.instance().stats()['events'][event.label]
+        self.assertEqual(stats['sent'], 3)
+        self.assertEqual(stats['received'], 3)
+        self.assertEqual(stats['deliveries'], 6)
+        self.assertEqual(stats['sent_bytes'], stats['received_bytes'])
+        self.assertEqual(stats['latency']['count'], 3)
+        stats = self._server.stats()['events'][event.label]
+        self.assertEqual(stats['received'], 3)
+        self.assertEqual(stats['deliveries'], 3)
+        self.assertEqual(stats['latency']['count'], 3)
+
+    @defer.inlineCallbacks
+    def test_unknown_topics_share_metrics(self):
+        """
+        Ensure the server keeps the metrics of unknown events together.
+        """
+        push = txzmq.ZmqPushConnection(self.factory, txzmq.ZmqEndpoint(
+            txzmq.ZmqEndpointType.connect,
+            "tcp://127.0.0.1:%d" % self._server.pull_port))
+        self.addCleanup(push.shutdown)
+        for i in range(3):
+            push.send([("unknown-event-%d" % i).encode("ascii"),
+                       codec.encode(())])
+
+        def received():
+            stats = self._server.stats()['events']
+            return stats.get(UNKNOWN_LABEL, {}).get('received') == 3
+
+        yield wait_until(received)
+        self.assertEqual(
+            [label for label in self._server.stats()['events']
+             if 'unknown' in label],
+            [UNKNOWN_LABEL])
+
+    @defer.inlineCallbacks
+    def test_stats_event(self):
+        """
+        Ensure the server publishes its metrics.
+        """
+        d = defer.Deferred()
+
+        def cbk(event, stats):
+            if not d.called:
+                callFromThread(d.callback, stats)
+
+        self._client.register(catalog.EVENTS_SERVER_STATS, cbk)
+        stats = yield d
+        self.assertIn('events', stats)
+        self.assertEqual(stats['queues']['subscriptions'], 1)
+
+
+class EventsTxClientMetricsTestCase(
+        EventsMetricsTestCase, unittest.TestCase):
+
+    _client = txclient
+
+
+class EventsClientMetricsTestCase(
+        EventsMetricsTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsReplayTestCase(EventsBaseTestCase):
+
+    # the server only tells states apart in the content of safe codecs
+    _client_options = {'codec': 'json'}
+    _server_options = {'replay_size': 10, 'last_values': 10}
+
+    @defer.inlineCallbacks
+    def test_replay_recent(self):
+        """
+        Ensure a callback can ask for the recent events kept by the server.
+        """
+        event = catalog.CLIENT_UID
+        self._client.emit(event, 1)
+        self._client.emit(event, 2)
+        yield wait_until(lambda: len(self._server._recent) == 2)
+
+        received = []
+        self._client.register(
+            event, lambda ev, i: received.append(i), replay='recent')
+        yield wait_until(lambda: received == [1, 2])
+        yield wait_until(lambda: not self._client.instance()._replays)
+
+    @defer.inlineCallbacks
+    def test_replay_last_values(self):
+        """
+        Ensure a callback can ask for the last value of each state.
+        """
+        event = catalog.SOLEDAD_SYNC_SEND_STATUS
+        self._client.emit(event, {'uuid': 'a'}, 1)
+        self._client.emit(event, {'uuid': 'b'}, 2)
+        self._client.emit(event, {'uuid': 'a'}, 3)
+        yield wait_until(lambda: len(self._server._recent) == 3)
+
+        received = []
+        self._client.register(
+            catalog.match("SOLEDAD_*"),
+            lambda ev, state, i: received.append(i), replay='last')
+        yield wait_until(lambda: received == [2, 3])
+
+    def test_unsafe_codecs_are_opaque(self):
+        """
+        Ensure the server doesn't decode content encoded with unsafe codecs
+        to tell states apart.
+        """
+        event = catalog.SOLEDAD_SYNC_SEND_STATUS
+        content = ({'uuid': 'a'}, 1)
+        self.assertEqual(
+            self._server._stateKey(
+                event.label_topic, codec.encode(content, codec=codec.JSON)),
+            event.coalesce_key(content))
+        self.assertIsNone(self._server._stateKey(
+            event.label_topic, codec.encode(content, codec=codec.PICKLE)))
+
+    def test_unknown_replay(self):
+        self.assertRaises(
+            ValueError, self._client.register, catalog.CLIENT_UID,
+            lambda ev, _: None, replay='all')
+
+
+class EventsTxClientReplayTestCase(
+        EventsReplayTestCase, unittest.TestCase):
+
+    _client = txclient
+
+
+class EventsClientReplayTestCase(
+        EventsReplayTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsJournalTestCase(EventsBaseTestCase):
+
+    def setUp(self):
+        self._journal_dir = tempfile.mkdtemp()
+        self._server_options = {'journal_dir': self._journal_dir}
+        EventsBaseTestCase.setUp(self)
+
+    def tearDown(self):
+        EventsBaseTestCase.tearDown(self)
+        shutil.rmtree(self._journal_dir)
+
+    @defer.inlineCallbacks
+    def test_relayed_events_are_journaled(self):
+        """
+        Ensure the server appends the events it relays to its journal.
+        """
+        self._client.emit(catalog.CLIENT_UID, 'foo')
+        yield wait_until(lambda: self._server._journal.records == 1)
+        self._server._journal.flush()
+        records = list(journal.JournalReader(self._journal_dir).read())
+        self.assertEqual(catalog.CLIENT_UID, records[0].event)
+        self.assertEqual(('foo',), records[0].content())
+
+
+class EventsTxClientJournalTestCase(
+        EventsJournalTestCase, unittest.TestCase):
+
+    _client = txclient
+
+
+class EventsClientJournalTestCase(
+        EventsJournalTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsPriorityLaneTestCase(EventsBaseTestCase):
+
+    _server_options = {
+        'priority_emit_addr': "tcp://127.0.0.1:0",
+        'priority_reg_addr': "tcp://127.0.0.1:0"}
+
+    def setUp(self):
+        EventsBaseTestCase.setUp(self)
+        # configure again, now that the ports of the lane are known
+        self._client.configure_client(
+            emit_addr="tcp://127.0.0.1:%d" % self._server.pull_port,
+            reg_addr="tcp://127.0.0.1:%d" % self._server.pub_port,
+            factory=self.factory, enable_curve=False,
+            priority_emit_addr="tcp://127.0.0.1:%d" % (
+                self._server.priority_pull_port),
+            priority_reg_addr="tcp://127.0.0.1:%d" % (
+                self._server.priority_pub_port))
+
+    @defer.inlineCallbacks
+    def test_events_are_delivered_in_their_lanes(self):
+        """
+        Ensure high priority events go through their own lane, and both
+        lanes deliver their events.
+        """
+        received = []
+        self._client.register(
+            catalog.RAISE_WINDOW, lambda ev, i: received.append(i))
+        self._client.register(
+            catalog.CLIENT_UID, lambda ev, i: received.append(i))
+        yield wait_until(lambda: len(self._server.subscriptions) == 2)
+        self.assertEqual(
+            set([catalog.RAISE_WINDOW.label_topic]),
+            self._server._priority_subscriptions)
+
+        self._client.emit(catalog.CLIENT_UID, 1)
+        self._client.emit(catalog.RAISE_WINDOW, 2)
+        yield wait_until(lambda: sorted(received) == [1, 2])
+
+    def test_lane_needs_both_addresses(self):
+        self.assertRaises(
+            ValueError, server.ensure_server,
+            emit_addr="tcp://127.0.0.1:0", reg_addr="tcp://127.0.0.1:0",
+            priority_emit_addr="tcp://127.0.0.1:0", factory=self.factory,
+            enable_curve=False)
+
+
+class EventsTxClientPriorityLaneTestCase(
+        EventsPriorityLaneTestCase, unittest.TestCase):
+
+    _client = txclient
+
+
+class EventsClientPriorityLaneTestCase(
+        EventsPriorityLaneTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsFilterTestCase(EventsBaseTestCase):
+
+    # the server only filters the content of safe codecs
+    _client_options = {'codec': 'json'}
+
+    @defer.inlineCallbacks
+    def test_server_filters_content(self):
+        """
+        Ensure the server only sends filtered callbacks the events whose
+        content matches, and other callbacks all of them.
+        """
+        event = catalog.MAIL_UNREAD_MESSAGES
+        received = []
+        filtered = []
+        self._client.register(
+            event, lambda ev, user, n: received.append(user))
+        self._client.register(
+            event, lambda ev, user, n: filtered.append(user),
+            where={0: 'b@example.org'})
+        yield wait_until(lambda: event.label_topic in self._server._filters)
+
+        self._client.emit(event, 'a@example.org', 1)
+        self._client.emit(event, 'b@example.org', 2)
+        yield wait_until(lambda: len(received) == 2)
+        yield wait_until(lambda: filtered)
+        # give the server the time to send anything else
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual(['b@example.org'], filtered)
+
+    @defer.inlineCallbacks
+    def test_server_indexes_filters(self):
+        """
+        Ensure the server indexes filters by event and positions, and
+        forgets them when they are unsubscribed.
+        """
+        event = catalog.MAIL_UNREAD_MESSAGES
+        uid = self._client.register(
+            event, lambda ev, user, n: None, where={0: 'a@example.org'})
+        topic = wire.filter_topic(event.label_topic, {0: 'a@example.org'})
+        yield wait_until(lambda: self._server._filters)
+        self.assertEqual(
+            {event.label_topic: {(0,): set([topic])}}, self._server._filters)
+        self._client.unregister(event, uid)
+        yield wait_until(lambda: not self._server._filters)
+
+    def test_unsafe_codecs_are_opaque(self):
+        """
+        Ensure the server doesn't decode content encoded with unsafe codecs
+        to filter it.
+        """
+        event = catalog.MAIL_UNREAD_MESSAGES
+        where = {0: 'a@example.org'}
+        topic = wire.filter_topic(event.label_topic, where)
+        filters = {event.label_topic: {(0,): set([topic])}}
+        pub = Mock()
+        content = ('a@example.org', 1)
+        for name in (codec.JSON, codec.PICKLE):
+            self._server._publishFiltered(
+                [event.label_topic, codec.encode(content, codec=name)],
+                pub, filters)
+        pub.send.assert_called_once_with(
+            [topic, codec.encode(content, codec=codec.JSON)])
+
+    def test_filtered_callbacks(self):
+        """
+        Ensure filtered callbacks only run for the copies sent under their
+        filter topic, or for matching events delivered locally.
+        """
+        instance = self._client.instance()
+        event = catalog.MAIL_UNREAD_MESSAGES
+        topic = wire.filter_topic(event.label_topic, {0: 'a@example.org'})
+
+        def cbk(event, *content):
+            pass
+
+        self._client.register(event, cbk, uid="any")
+        self._client.register(
+            event, cbk, uid="a", where={0: 'a@example.org'})
+        content = ('a@example.org', 1)
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(
+                event, content, event.label_topic)],
+            ["any"])
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(
+                event, content, topic)],
+            ["a"])
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(event, content)],
+            ["any", "a"])
+        self.assertEqual(
+            [uid for uid, _ in instance._callbacks_for(
+                event, ('b@example.org', 1))],
+            ["any"])
+
+    def test_bad_filters(self):
+        def cbk(event, *content):
+            pass
+
+        self.assertRaises(
+            ValueError, self._client.register, catalog.match("MAIL_*"), cbk,
+            where={0: 'a@example.org'})
+        self.assertRaises(
+            ValueError, self._client.register, catalog.MAIL_UNREAD_MESSAGES,
+            cbk, key='a@example.org', where={0: 'a@example.org'})
+        self.assertRaises(
+            ValueError, self._client.register, catalog.MAIL_UNREAD_MESSAGES,
+            cbk, where={'user': 'a@example.org'})
+
+
+class EventsTxClientFilterTestCase(
+        EventsFilterTestCase, unittest.TestCase):
+
+    _client = txclient
+
+
+class EventsClientFilterTestCase(
+        EventsFilterTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsDefaultCodecFilterTestCase(EventsBaseTestCase):
+
+    @defer.inlineCallbacks
+    def test_filters_need_a_safe_codec(self):
+        """
+        Ensure clients warn about filtered callbacks when they emit with the
+        default codec, whose events the server never filters.
+        """
+        event = catalog.MAIL_UNREAD_MESSAGES
+        received = []
+        filtered = []
+        self._client.register(
+            event, lambda ev, user, n: received.append(user))
+        with patch.object(client.logger, 'warning') as warning:
+            self._client.register(
+                event, lambda ev, user, n: filtered.append(user),
+                where={0: 'a@example.org'})
+        self.assertEqual(1, warning.call_count)
+        yield wait_until(lambda: event.label_topic in self._server._filters)
+
+        self._client.emit(event, 'a@example.org', 1)
+        yield wait_until(lambda: received)
+        # give the server the time to send anything else
+        yield task.deferLater(reactor, 0.1, lambda: None)
+        self.assertEqual([], filtered)
+
+
+class EventsTxClientDefaultCodecFilterTestCase(
+        EventsDefaultCodecFilterTestCase, unittest.TestCase):
+
+    _client = txclient
+
+
+class EventsClientDefaultCodecFilterTestCase(
+        EventsDefaultCodecFilterTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsBlobTestCase(EventsBaseTestCase):
+
+    _client_options = {'blob_threshold': 100}
+
+    def setUp(self):
+        EventsBaseTestCase.setUp(self)
+        self._blob_dir = tempfile.mkdtemp()
+        self._client.instance()._blobs = blobs.BlobStore(self._blob_dir)
+
+    def tearDown(self):
+        EventsBaseTestCase.tearDown(self)
+        shutil.rmtree(self._blob_dir)
+
+    @defer.inlineCallbacks
+    def test_large_content_is_sent_as_blob(self):
+        """
+        Ensure the content of events above the blob threshold is written to
+        a blob, and read back by the receivers.
+        """
+        event = catalog.CLIENT_UID
+        received = []
+        self._client.register(
+            event, lambda ev, *content: received.append(content))
+        self._client.emit(event, 'small')
+        self._client.emit(event, 'x' * 1000)
+        yield wait_until(lambda: len(received) == 2)
+        self.assertEqual([('small',), ('x' * 1000,)], received)
+        self.assertEqual(1, len(os.listdir(self._blob_dir)))
+
+
+class EventsTxClientBlobTestCase(
+        EventsBlobTestCase, unittest.TestCase):
+
+    _client = txclient
+
+
+class EventsClientBlobTestCase(
+        EventsBlobTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsReconnectionTestCase(EventsBaseTestCase):
+
+    _client_options = {'heartbeat': 0.5, 'emit_buffer': 2}
+    _server_options = {'replay_size': 10}
+
+    @defer.inlineCallbacks
+    def _stop_server(self):
+        """
+        Shutdown the server and wait for the client to notice.
+        """
+        instance = self._client.instance()
+        yield wait_until(lambda: instance.connected)
+        self._ports = (self._server.pull_port, self._server.pub_port)
+        self._server.shutdown()
+        yield wait_until(lambda: not instance.connected)
+
+    def _start_server(self):
+        """
+        Start a new server in the addresses of the stopped one.
+        """
+        self._server = server.ensure_server(
+            emit_addr="tcp://127.0.0.1:%d" % self._ports[0],
+            reg_addr="tcp://127.0.0.1:%d" % self._ports[1],
+            factory=self.factory,
+            enable_curve=False,
+            **self._server_options)
+
+    def _received(self):
+        # the server keeps the frames it pulled
+        return [codec.decode(frames[1].bytes)
+                for _, frames, _ in self._server._recent]
+
+    @defer.inlineCallbacks
+    def test_buffered_events_are_sent_after_restart(self):
+        """
+        Ensure events emitted while the server is down are sent when it is
+        back, dropping the oldest ones when the buffer is full.
+        """
+        instance = self._client.instance()
+        self._client.emit(catalog.CLIENT_UID, 0)
+        yield wait_until(lambda: self._received() == [(0,)])
+        yield self._stop_server()
+
+        for i in range(1, 4):
+            self._client.emit(catalog.CLIENT_UID, i)
+        self.assertEqual(2, len(instance._outbox))
+        self.assertEqual(1, instance._outbox.dropped)
+
+        self._start_server()
+        yield wait_until(lambda: self._received() == [(2,), (3,)])
+        self.assertEqual(0, len(instance._outbox))
+        self.assertEqual(1, instance._disconnects)
+
+    @defer.inlineCallbacks
+    def test_callbacks_are_run_after_restart(self):
+        """
+        Ensure registered callbacks get events again after the server is
+        restarted.
+        """
+        received = []
+        self._client.register(
+            catalog.CLIENT_UID, lambda ev, i: received.append(i))
+        yield wait_until(lambda: self._server.subscriptions)
+        yield self._stop_server()
+
+        self._start_server()
+        yield wait_until(lambda: self._client.instance().connected)
+        yield wait_until(lambda: self._server.subscriptions)
+        self._client.emit(catalog.CLIENT_UID, 1)
+        yield wait_until(lambda: received == [1])
+
+
+class EventsTxClientReconnectionTestCase(
+        EventsReconnectionTestCase, unittest.TestCase):
+
+    _client = txclient
+
+    def test_blocking_overflow_is_refused(self):
+        self.assertRaises(
+            ValueError, txclient.EventsTxClient, factory=self.factory,
+            enable_curve=False, emit_buffer=1,
+            emit_overflow=executors.BLOCK)
+
+
+class EventsClientReconnectionTestCase(
+        EventsReconnectionTestCase, unittest.TestCase):
+
+    _client = client
+
+
+class EventsTxClientCompactTopicsTestCase(
+        EventsGenericClientTestCase, unittest.TestCase):
+
+    _client = txclient
+    _client_options = {'compact_topics': True}
+
+
+class EventsClientCompactTopicsTestCase(
+        EventsGenericClientTestCase, unittest.TestCase):
+
+    _client = client
+    _client_options = {'compact_topics': True}
+
+
+class EventsClientExecutorTestCase(
+        EventsGenericClientTestCase, unittest.TestCase):
+
+    _client = client
+
+    def setUp(self):
+        # shutting down the client shuts down its executor
+        self._client_options = {
+            'executor': executors.SerialExecutor(workers=2)}
+        EventsGenericClientTestCase.setUp(self)
+
+
+class EventsClientBlockingExecutorTestCase(
+        EventsBaseTestCase, unittest.TestCase):
+
+    _client = client
+
+    def setUp(self):
+        self._executor = executors.SerialExecutor(
+            workers=1, max_queue=1, overflow=executors.BLOCK)
+        self._client_options = {'executor': self._executor}
+        EventsBaseTestCase.setUp(self)
+
+    @defer.inlineCallbacks
+    def test_full_executor_does_not_block_the_ioloop(self):
+        """
+        Ensure the ioloop keeps receiving events while a slow callback
+        holds the executor with a full queue.
+        """
+        event = catalog.CLIENT_UID
+        release = threading.Event()
+        received = []
+
+        def slow(ev, value):
+            received.append(value)
+            release.wait(5)
+
+        self._client.register(event, slow)
+        yield self._subscribed(event)
+        for i in range(4):
+            self._client.emit(event, i)
+        # the callback of the first event is running and, had the ioloop
+        # waited for room in the queue, only one more would be queued
+        yield wait_until(lambda: self._executor.depth == 3)
+        release.set()
+        yield wait_until(lambda: received == [0, 1, 2, 3])
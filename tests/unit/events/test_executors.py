@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# test_executors.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the events callback executors.
+"""
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from leap.common.events import executors
+
+
+class BoundedQueueTestCase(unittest.TestCase):
+
+    def _full_queue(self, overflow):
+        queue = executors.BoundedQueue(2, overflow)
+        queue.put(1)
+        queue.put(2)
+        return queue
+
+    def test_drop_newest(self):
+        queue = self._full_queue(executors.DROP_NEWEST)
+        self.assertFalse(queue.put(3))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual([queue.get(0), queue.get(0)], [1, 2])
+
+    def test_drop_oldest(self):
+        queue = self._full_queue(executors.DROP_OLDEST)
+        self.assertTrue(queue.put(3))
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual([queue.get(0), queue.get(0)], [2, 3])
+
+    def test_block_waits_for_room(self):
+        queue = self._full_queue(executors.BLOCK)
+        putter = threading.Thread(target=queue.put, args=(3,))
+        putter.start()
+        putter.join(0.1)
+        self.assertTrue(putter.is_alive())
+        self.assertEqual(queue.get(0), 1)
+        putter.join(1)
+        self.assertFalse(putter.is_alive())
+        self.assertEqual([queue.get(0), queue.get(0)], [2, 3])
+        self.assertEqual(queue.dropped, 0)
+
+    def test_get_timeout(self):
+        queue = executors.BoundedQueue(1)
+        self.assertIsNone(queue.get(0.01))
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, executors.BoundedQueue, 1, "nope")
+
+
+class ExecutorTestCase(unittest.TestCase):
+
+    def test_serial_executor_keeps_order_per_key(self):
+        executor = executors.SerialExecutor(workers=3)
+        results = {'a': [], 'b': []}
+        for i in range(100):
+            for key in results:
+                executor.submit(key, results[key].append, i)
+        executor.shutdown(wait=True)
+        self.assertEqual(results['a'], list(range(100)))
+        self.assertEqual(results['b'], list(range(100)))
+
+    def test_pool_executor_runs_every_callback(self):
+        executor = executors.PoolExecutor(workers=3)
+        results = []
+        lock = threading.Lock()
+
+        def append(i):
+            with lock:
+                results.append(i)
+
+        for i in range(100):
+            executor.submit(None, append, i)
+        executor.shutdown(wait=True)
+        self.assertEqual(sorted(results), list(range(100)))
+        self.assertEqual(executor.depth, 0)
+
+    def test_failing_callback_does_not_stop_worker(self):
+        executor = executors.SerialExecutor(workers=1)
+        results = []
+        executor.submit(None, lambda: 1 / 0)
+        executor.submit(None, results.append, 1)
+        executor.shutdown(wait=True)
+        self.assertEqual(results, [1])
+
+    def _blocked_executor(self, **kwargs):
+        """
+        Return an executor with a full queue, whose only worker is busy
+        with a slow callback, and the event that lets the callback finish.
+        """
+        executor = executors.SerialExecutor(workers=1, max_queue=1, **kwargs)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow():
+            started.set()
+            release.wait(5)
+
+        executor.submit(None, slow)
+        started.wait(1)
+        executor.submit(None, lambda: None)
+        self.assertEqual(executor.depth, 1)
+        return executor, release
+
+    def test_full_queue_drops_oldest_by_default(self):
+        executor, release = self._blocked_executor()
+        results = []
+        self.assertTrue(executor.submit(None, results.append, 1))
+        self.assertEqual(executor.dropped, 1)
+        release.set()
+        executor.shutdown(wait=True)
+        self.assertEqual(results, [1])
+
+    def test_submit_nowait_does_not_block(self):
+        executor, release = self._blocked_executor(overflow=executors.BLOCK)
+        results = []
+        submitter = threading.Thread(
+            target=executor.submit_nowait, args=(None, results.append, 1))
+        submitter.start()
+        submitter.join(1)
+        self.assertFalse(submitter.is_alive())
+        self.assertEqual(executor.depth, 2)
+        self.assertEqual(executor.dropped, 0)
+        release.set()
+        executor.shutdown(wait=True)
+        self.assertEqual(results, [1])
+
+    def test_executor_restarts_after_shutdown(self):
+        executor = executors.SerialExecutor(workers=1)
+        results = []
+        executor.submit(None, results.append, 1)
+        executor.shutdown(wait=True)
+        executor.submit(None, results.append, 2)
+        executor.shutdown(wait=True)
+        self.assertEqual(results, [1, 2])
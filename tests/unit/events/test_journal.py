@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# test_journal.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the events journal.
+"""
+import os
+import shutil
+import tempfile
+import zmq
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from leap.common.events import catalog
+from leap.common.events import codec
+from leap.common.events import journal
+from leap.common.events import wire
+
+
+class JournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.reader = journal.JournalReader(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _append(self, journal_, event, value, timestamp):
+        journal_.append(
+            wire.pack(event.label_topic, codec.encode((value,))),
+            timestamp=timestamp)
+
+    def _values(self, **kwargs):
+        return [record.content()[0] for record in self.reader.read(**kwargs)]
+
+    def test_roundtrip(self):
+        j = journal.Journal(self.directory)
+        self._append(j, catalog.CLIENT_UID, "foo", 1000)
+        j.close()
+        records = list(self.reader.read())
+        self.assertEqual(1, len(records))
+        self.assertEqual(1000, records[0].timestamp)
+        self.assertEqual(catalog.CLIENT_UID, records[0].event)
+        self.assertEqual(("foo",), records[0].content())
+
+    def test_frames_are_written_from_their_buffers(self):
+        j = journal.Journal(self.directory)
+        message = wire.pack(
+            catalog.CLIENT_UID.label_topic, codec.encode(("foo",)))
+        j.append([zmq.Frame(frame) for frame in message], timestamp=1000)
+        j.close()
+        records = list(self.reader.read())
+        self.assertEqual(1, len(records))
+        self.assertEqual(catalog.CLIENT_UID, records[0].event)
+        self.assertEqual(("foo",), records[0].content())
+
+    def test_records_are_written_in_batches(self):
+        j = journal.Journal(self.directory, batch_bytes=1024 * 1024)
+        self._append(j, catalog.CLIENT_UID, 1, 1000)
+        self.assertEqual([], self._values())
+        j.flush()
+        self.assertEqual([1], self._values())
+        j.close()
+
+    def test_segments_roll_over(self):
+        j = journal.Journal(self.directory, segment_size=200, batch_bytes=1)
+        for i in range(10):
+            self._append(j, catalog.CLIENT_UID, i, 1000 + i)
+        j.close()
+        logs = [name for name in os.listdir(self.directory)
+                if name.endswith('.log')]
+        self.assertTrue(len(logs) > 1)
+        self.assertEqual(list(range(10)), self._values())
+
+    def test_reopening_starts_a_new_segment(self):
+        for i in range(2):
+            j = journal.Journal(self.directory)
+            self._append(j, catalog.CLIENT_UID, i, 1000 + i)
+            j.close()
+        self.assertEqual([0, 1], self._values())
+
+    def test_query_by_time_and_event(self):
+        j = journal.Journal(self.directory, segment_size=300)
+        for i in range(20):
+            event = catalog.CLIENT_UID if i % 2 else catalog.CLIENT_SESSION_ID
+            self._append(j, event, i, 1000 + i)
+        j.close()
+        self.assertEqual([5, 6, 7], self._values(since=1005, until=1007))
+        self.assertEqual(
+            [7, 9, 11],
+            self._values(since=1006.5, until=1012,
+                         events=[catalog.CLIENT_UID]))
+        self.assertEqual([], self._values(since=2000))
+
+    def test_half_written_entries_are_ignored(self):
+        j = journal.Journal(self.directory)
+        self._append(j, catalog.CLIENT_UID, 1, 1000)
+        j.close()
+        index = [name for name in os.listdir(self.directory)
+                 if name.endswith('.idx')][0]
+        with open(os.path.join(self.directory, index), 'ab') as f:
+            f.write(b'\0' * 7)
+        self.assertEqual([1], self._values())
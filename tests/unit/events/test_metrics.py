@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# test_metrics.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the events metrics.
+"""
+import time
+
+from twisted.trial import unittest
+
+from leap.common.events import metrics
+from leap.common.events import wire
+
+
+class HistogramTestCase(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = metrics.Histogram(bounds=(1, 2, 3))
+        for value in (0.5, 0.5, 1.5, 2.5):
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 4)
+        self.assertEqual(snapshot['counts'], [2, 1, 1, 0])
+        self.assertEqual(snapshot['mean'], 1.25)
+        self.assertEqual(snapshot['p50'], 1)
+        # bounded by the maximum observed value
+        self.assertEqual(snapshot['p99'], 2.5)
+
+    def test_overflow_bucket(self):
+        histogram = metrics.Histogram(bounds=(1,))
+        histogram.observe(10)
+        self.assertEqual(histogram.counts, [0, 1])
+        self.assertEqual(histogram.percentile(0.5), 10)
+
+    def test_empty(self):
+        self.assertEqual(metrics.Histogram().percentile(0.99), 0.0)
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_counters(self):
+        m = metrics.Metrics()
+        m.sent('EVENT', 10)
+        m.received('EVENT', 10, deliveries=2, emitted=time.time())
+        m.received('EVENT', 5, deliveries=1)
+        snapshot = m.snapshot({'queue': 3})
+        self.assertEqual(snapshot['queues'], {'queue': 3})
+        event = snapshot['events']['EVENT']
+        self.assertEqual(event['sent'], 1)
+        self.assertEqual(event['sent_bytes'], 10)
+        self.assertEqual(event['received'], 2)
+        self.assertEqual(event['received_bytes'], 15)
+        self.assertEqual(event['deliveries'], 3)
+        self.assertEqual(event['latency']['count'], 1)
+        m.reset()
+        self.assertEqual(m.snapshot()['events'], {})
+
+
+class WireTimestampTestCase(unittest.TestCase):
+
+    def test_timestamp_frame(self):
+        frames = wire.pack(b'topic', b'body', timestamp=1234.5)
+        self.assertEqual(wire.unpack(frames), (b'topic', b'body'))
+        self.assertEqual(wire.timestamp(frames), 1234.5)
+        self.assertIsNone(wire.origin(frames))
+
+    def test_timestamp_and_origin(self):
+        frames = wire.pack(b'topic', b'body', origin=b'me', timestamp=1.0)
+        self.assertEqual(wire.origin(frames), b'me')
+        self.assertEqual(wire.timestamp(frames), 1.0)
+
+    def test_no_timestamp(self):
+        self.assertIsNone(wire.timestamp(wire.pack(b'topic', b'body')))
+        self.assertIsNone(wire.timestamp([b'topic', b'body', b'', b'x']))
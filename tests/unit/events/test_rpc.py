@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# test_rpc.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for remote calls through the events server.
+"""
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet import reactor
+from twisted.internet import task
+
+from txzmq import ZmqFactory
+
+from leap.common.events import catalog
+from leap.common.events import rpc
+from leap.common.events import server
+from leap.common.events.errors import NoResponderError
+from leap.common.events.errors import ResponderBusyError
+from leap.common.events.errors import RpcError
+from leap.common.events.errors import RpcTimeoutError
+
+
+class EventsRpcTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = ZmqFactory()
+        self._server = server.ensure_server(
+            emit_addr="tcp://127.0.0.1:0",
+            reg_addr="tcp://127.0.0.1:0",
+            rpc_addr="tcp://127.0.0.1:0",
+            factory=self.factory,
+            enable_curve=False)
+        rpc_addr = "tcp://127.0.0.1:%d" % self._server.rpc_port
+        self.caller = rpc.EventsRpcClient(
+            rpc_addr, factory=self.factory, enable_curve=False)
+        self.responder = rpc.EventsRpcClient(
+            rpc_addr, factory=self.factory, enable_curve=False)
+
+    def tearDown(self):
+        self.caller.shutdown()
+        self.responder.shutdown()
+        self._server.shutdown()
+        self.factory.shutdown()
+
+    @defer.inlineCallbacks
+    def _respond(self, event, handler, **kwargs):
+        self.responder.respond(event, handler, **kwargs)
+        # let the server know about the responder before calling
+        while not self._server._responders.get(event.label_topic):
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_call_returns_result(self):
+        yield self._respond(
+            catalog.CLIENT_UID, lambda event, name: (event.label, name))
+        result = yield self.caller.call(catalog.CLIENT_UID, "foo", timeout=5)
+        self.assertEqual(("CLIENT_UID", "foo"), tuple(result))
+
+    @defer.inlineCallbacks
+    def test_call_waits_for_deferred_result(self):
+        yield self._respond(
+            catalog.CLIENT_UID,
+            lambda event, n: task.deferLater(reactor, 0.01, lambda: n + 1))
+        result = yield self.caller.call(catalog.CLIENT_UID, 1, timeout=5)
+        self.assertEqual(2, result)
+
+    def test_call_without_responder_fails(self):
+        d = self.caller.call(catalog.CLIENT_UID, timeout=5)
+        return self.assertFailure(d, NoResponderError)
+
+    @defer.inlineCallbacks
+    def test_call_times_out(self):
+        yield self._respond(
+            catalog.CLIENT_UID, lambda event: defer.Deferred())
+        d = self.caller.call(catalog.CLIENT_UID, timeout=0.1)
+        yield self.assertFailure(d, RpcTimeoutError)
+        self.assertEqual({}, self.caller._calls)
+
+    @defer.inlineCallbacks
+    def test_handler_error_is_propagated(self):
+        def handler(event):
+            raise ValueError("bad call")
+
+        yield self._respond(catalog.CLIENT_UID, handler)
+        d = self.caller.call(catalog.CLIENT_UID, timeout=5)
+        error = yield self.assertFailure(d, RpcError)
+        self.assertIn("ValueError: bad call", str(error))
+
+    @defer.inlineCallbacks
+    def test_unencodable_result_is_an_error(self):
+        yield self._respond(
+            catalog.CLIENT_UID, lambda event: threading.Lock())
+        d = self.caller.call(catalog.CLIENT_UID, timeout=5)
+        error = yield self.assertFailure(d, RpcError)
+        self.assertIn("Can't encode result", str(error))
+
+    @defer.inlineCallbacks
+    def test_busy_responder_rejects_calls(self):
+        pending = []
+
+        def handler(event):
+            pending.append(defer.Deferred())
+            return pending[-1]
+
+        yield self._respond(
+            catalog.CLIENT_UID, handler, concurrency=1, backlog=1)
+        first = self.caller.call(catalog.CLIENT_UID, timeout=5)
+        second = self.caller.call(catalog.CLIENT_UID, timeout=5)
+        third = self.caller.call(catalog.CLIENT_UID, timeout=5)
+        yield self.assertFailure(third, ResponderBusyError)
+        # only one call is handled at a time
+        self.assertEqual(1, len(pending))
+        pending[0].callback("first")
+        self.assertEqual(2, len(pending))
+        pending[1].callback("second")
+        results = yield defer.gatherResults([first, second])
+        self.assertEqual(["first", "second"], results)
+
+    @defer.inlineCallbacks
+    def test_unrespond_stops_routing(self):
+        yield self._respond(catalog.CLIENT_UID, lambda event: True)
+        self.responder.unrespond(catalog.CLIENT_UID)
+        while self._server._responders:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        d = self.caller.call(catalog.CLIENT_UID, timeout=5)
+        yield self.assertFailure(d, NoResponderError)
+
+    def test_call_rejects_unknown_keywords(self):
+        self.assertRaises(
+            TypeError, self.caller.call, catalog.CLIENT_UID, bogus=1)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# test_wire.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for the framing of events on the wire.
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from leap.common.events import wire
+
+
+class FilterTopicTestCase(unittest.TestCase):
+
+    def test_roundtrip(self):
+        topic = wire.filter_topic(b'MAIL_UNREAD_MESSAGES', {1: 3, 0: u'a'})
+        self.assertTrue(topic.startswith(wire.FILTER_TOPIC))
+        self.assertEqual(
+            wire.parse_filter_topic(topic),
+            (b'MAIL_UNREAD_MESSAGES', {0: u'a', 1: 3}))
+
+    def test_content_matches(self):
+        topic = wire.filter_topic(
+            b'SOLEDAD_DONE_DATA_SYNC', {0: {'uuid': 'a'}})
+        self.assertEqual(
+            wire.content_filter_topic(
+                b'SOLEDAD_DONE_DATA_SYNC', (0,), ({'uuid': 'a'}, 'extra')),
+            topic)
+        self.assertNotEqual(
+            wire.content_filter_topic(
+                b'SOLEDAD_DONE_DATA_SYNC', (0,), ({'uuid': 'b'},)),
+            topic)
+        self.assertIsNone(
+            wire.content_filter_topic(b'SOLEDAD_DONE_DATA_SYNC', (0,), ()))
+        self.assertIsNone(
+            wire.content_filter_topic(
+                b'SOLEDAD_DONE_DATA_SYNC', (0,), (object(),)))
+
+    def test_topics_are_not_prefixes(self):
+        # subscriptions match by prefix, so a filter of an event must not
+        # match the events whose labels start with its label
+        short = wire.filter_topic(b'SMTP_START', {0: 'a'})
+        longer = wire.filter_topic(b'SMTP_START_SIGN', {0: 'a'})
+        self.assertFalse(longer.startswith(short))
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, wire.filter_topic, b'CLIENT_UID', {})
+        self.assertRaises(
+            ValueError, wire.filter_topic, b'CLIENT_UID', {-1: 'a'})
+        self.assertRaises(
+            ValueError, wire.filter_topic, b'CLIENT_UID', {True: 'a'})
+        self.assertRaises(
+            TypeError, wire.filter_topic, b'CLIENT_UID', {0: object()})
+        self.assertIsNone(wire.parse_filter_topic(b'CLIENT_UID'))
+        self.assertIsNone(wire.parse_filter_topic(
+            wire.FILTER_TOPIC + b'[[0, "a"]]\0CLIENT_UID\0'))
+        self.assertIsNone(wire.parse_filter_topic(
+            wire.FILTER_TOPIC + b'{"0":"a"}\0CLIENT_UID\0'))
+
+
+if __name__ == "__main__":
+    unittest.main()
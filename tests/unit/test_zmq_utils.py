@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# test_zmq_utils.py
+# Copyright (C) 2017 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for:
+    * leap/common/zmq_utils.Keyring
+    * leap/common/zmq_utils.zmq_capabilities
+"""
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import os
+import shutil
+import tempfile
+
+import mock
+import zmq
+
+from leap.common import zmq_utils
+
+
+@unittest.skipUnless(zmq_utils.zmq_has_curve(), "CurveZMQ not supported")
+class KeyringTests(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.keyring = zmq_utils.Keyring(self.basedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_keypair_is_created_and_cached(self):
+        public, secret = self.keyring.keypair("client")
+        self.assertEqual(self.keyring.public_key("client"), public)
+        with mock.patch.object(zmq.auth, "load_certificate") as load:
+            self.assertEqual(
+                self.keyring.keypair("client"), (public, secret))
+            self.assertEqual(self.keyring.public_key("client"), public)
+            self.assertEqual(load.call_count, 0)
+
+    def test_changed_keys_are_reloaded(self):
+        public, _ = self.keyring.keypair("server")
+        # regenerate the keys in place
+        os.remove(os.path.join(
+            self.keyring.private_keys_dir, "server.key_secret"))
+        other = zmq_utils.Keyring(self.basedir)
+        new_public, _ = other.keypair("server")
+        self.assertNotEqual(public, new_public)
+        self.assertEqual(self.keyring.keypair("server")[0], new_public)
+        self.assertEqual(self.keyring.public_key("server"), new_public)
+
+    def test_public_keys(self):
+        self.assertEqual(self.keyring.public_keys(), {})
+        client, _ = self.keyring.keypair("client")
+        self.assertEqual(self.keyring.public_keys(), {client: True})
+        server, _ = self.keyring.keypair("server")
+        self.assertEqual(
+            self.keyring.public_keys(), {client: True, server: True})
+
+    def test_get_keyring_is_shared(self):
+        keyring = zmq_utils.get_keyring(self.basedir)
+        self.assertIs(
+            zmq_utils.get_keyring(os.path.join(self.basedir, ".")), keyring)
+        self.assertIsNot(
+            zmq_utils.get_keyring(os.path.join(self.basedir, "x")), keyring)
+
+
+class ZmqCapabilitiesTests(unittest.TestCase):
+
+    def test_capabilities_are_probed_once(self):
+        capabilities = zmq_utils.zmq_capabilities()
+        with mock.patch.object(zmq_utils, "_probe_capabilities") as probe:
+            self.assertIs(zmq_utils.zmq_capabilities(), capabilities)
+            self.assertEqual(zmq_utils.zmq_has_curve(), capabilities.curve)
+            self.assertEqual(probe.call_count, 0)
+
+    def test_refresh_probes_again(self):
+        with mock.patch.object(zmq_utils, "_probe_capabilities") as probe:
+            self.assertIs(
+                zmq_utils.zmq_capabilities(refresh=True), probe.return_value)
+            self.assertEqual(probe.call_count, 1)
+        zmq_utils.zmq_capabilities(refresh=True)
+
+    def test_versions(self):
+        capabilities = zmq_utils.zmq_capabilities()
+        self.assertEqual(capabilities.zmq_version, zmq.zmq_version_info())
+        self.assertEqual(
+            capabilities.pyzmq_version, zmq.pyzmq_version_info())